@@ -0,0 +1,86 @@
+'''
+Benchmark of the tile alignment modes available in `Piece.align_tiles`
+
+Synthetic tiles are cut from a larger image so the true offset between tiles
+is known. The extents of the tiles are then perturbed (to simulate error in
+the stage coordinates) and the time required to realign the tiles as well as
+the residual error are reported for each mode.
+
+    python benchmarks/align_tiles.py --size 2048 --tiles 3
+'''
+import argparse
+import time
+
+import numpy as np
+from scipy import ndimage
+
+from cochleogram.model import Piece, Tile
+
+
+def make_tiles(size, n_tiles, overlap, voxel_size, error, seed=0):
+    rng = np.random.default_rng(seed)
+    step = int(size * (1 - overlap))
+    nx = size + step * (n_tiles - 1)
+    image = np.zeros((nx, size), dtype='float32')
+    n_blobs = int(nx * size / 2000)
+    image[rng.integers(0, nx, n_blobs), rng.integers(0, size, n_blobs)] = 1
+    image = ndimage.gaussian_filter(image, 3)
+    image = (image / image.max() * 255).astype('uint8')
+
+    tiles = []
+    for i in range(n_tiles):
+        lb = i * step
+        tile_image = image[lb:lb+size, :, np.newaxis, np.newaxis]
+        tile_image = np.repeat(tile_image, 4, axis=2)
+        info = {
+            'lower': [lb * voxel_size, 0, 0],
+            'voxel_size': [voxel_size, voxel_size, 1],
+            'channels': [{'name': 'MyosinVIIa'}],
+            'rotation': 0,
+        }
+        tiles.append(Tile(info, tile_image, f'tile_{i}'))
+
+    truth = [t.extent[:] for t in tiles]
+    for tile in tiles[1:]:
+        extent = np.array(tile.extent)
+        extent[0:4] += np.repeat(rng.uniform(-error, error, 2), 2)
+        tile.extent = extent.tolist()
+    return tiles, truth
+
+
+def residual_error(tiles, truth):
+    # Error is measured relative to the first tile since alignment only
+    # determines the relative position of the tiles.
+    offset = np.array(tiles[0].extent[:4:2]) - np.array(truth[0][:4:2])
+    error = []
+    for tile, t in zip(tiles[1:], truth[1:]):
+        d = np.array(tile.extent[:4:2]) - np.array(t[:4:2]) - offset
+        error.append(np.sqrt(np.sum(d ** 2)))
+    return np.max(error)
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark tile alignment')
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--tiles', type=int, default=3)
+    parser.add_argument('--overlap', type=float, default=0.2)
+    parser.add_argument('--voxel-size', type=float, default=0.1)
+    parser.add_argument('--error', type=float, default=5, help='Stage error (um)')
+    parser.add_argument('--modes', nargs='+', default=['full', 'overlap', 'global'])
+    args = parser.parse_args()
+
+    print(f'{"mode":>10} {"time (s)":>10} {"error (um)":>12}')
+    for mode in args.modes:
+        tiles, truth = make_tiles(args.size, args.tiles, args.overlap,
+                                  args.voxel_size, args.error)
+        piece = Piece(tiles, 1, copied_from='')
+        initial_error = residual_error(tiles, truth)
+        t0 = time.time()
+        piece.align_tiles('MyosinVIIa', mode=mode)
+        elapsed = time.time() - t0
+        error = residual_error(tiles, truth)
+        print(f'{mode:>10} {elapsed:>10.2f} {error:>12.3f}  (initial error {initial_error:.3f} um)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Benchmark of the circle fit used to find the origin and direction of arcs
+
+Synthetic arcs (sampled as densely as an interpolated spiral) with a known
+center are generated for a range of sweep angles and levels of noise. The
+time required to find the center, the error in the estimated center (relative
+to the radius) and the fraction of arcs for which the direction was correct
+(or could not be determined) are reported for the previous approach
+(numerical minimization of the absolute deviation of the radius starting at
+the centroid) and each of the closed-form circle fits in `util.fit_circle`.
+
+    python benchmarks/arc_fit.py --arcs 100 --points 1001
+'''
+import argparse
+import time
+
+import numpy as np
+from scipy import optimize
+
+from cochleogram import util
+
+
+def optimize_origin(x, y):
+    # Approach used prior to `util.fit_circle`.
+    def _fn(origin, xa, ya):
+        xo, yo = origin
+        d = np.sqrt((xa - xo) ** 2 + (ya - yo) ** 2)
+        return np.sum(np.abs(d - d.mean()))
+    result = optimize.minimize(_fn, (x.mean(), y.mean()), (x, y))
+    return result.x
+
+
+def optimize_direction(x, y):
+    xo, yo = optimize_origin(x, y)
+    angles = np.unwrap(np.arctan2(y-yo, x-xo))
+    sign = np.sign(np.diff(angles))
+    if np.any(sign != sign[0]):
+        raise ValueError('Cannot determine direction of arc')
+    return sign[0]
+
+
+METHODS = {
+    'optimize': (optimize_origin, optimize_direction),
+    'kasa': (lambda x, y: util.fit_circle(x, y, 'kasa')[:2], util.arc_direction),
+    'taubin': (lambda x, y: util.fit_circle(x, y, 'taubin')[:2], util.arc_direction),
+    'taubin (robust)': (lambda x, y: util.arc_origin(x, y, robust=True), util.arc_direction),
+}
+
+
+def make_arcs(n_arcs, n_points, sweep, noise, outliers, radius=1000, seed=0):
+    '''
+    Generate arcs with smooth, low-frequency deviations from a circle (similar
+    to a hand-traced spiral). A fraction of the points can be moved outward by
+    20% of the radius to simulate outliers.
+    '''
+    rng = np.random.default_rng(seed)
+    for _ in range(n_arcs):
+        center = rng.uniform(-5000, 5000, 2)
+        start = rng.uniform(0, 2 * np.pi)
+        direction = rng.choice([-1, 1])
+        theta = start + direction * np.linspace(0, np.deg2rad(sweep), n_points)
+        knots = rng.normal(0, noise * radius, 8)
+        r = radius + np.interp(np.linspace(0, 1, n_points), np.linspace(0, 1, 8), knots)
+        r[rng.random(n_points) < outliers] += 0.2 * radius
+        x = center[0] + r * np.cos(theta)
+        y = center[1] + r * np.sin(theta)
+        yield x, y, center, radius, direction
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark circle fits used for arcs')
+    parser.add_argument('--arcs', type=int, default=100)
+    parser.add_argument('--points', type=int, default=1001,
+                        help='Points per arc (1001 for an interpolated spiral)')
+    parser.add_argument('--sweeps', type=float, nargs='+',
+                        default=[5, 30, 90, 180], help='Sweep of arcs (deg)')
+    parser.add_argument('--noise', type=float, nargs='+', default=[0, 0.01, 0.05],
+                        help='Deviation from circle (fraction of radius)')
+    parser.add_argument('--outliers', type=float, default=0,
+                        help='Fraction of points that are outliers')
+    args = parser.parse_args()
+
+    print(f'{"sweep":>6} {"noise":>6} {"method":>16} {"time (ms)":>10} '
+          f'{"center error":>13} {"direction ok":>13} {"failed":>7}')
+    for sweep in args.sweeps:
+        for noise in args.noise:
+            arcs = list(make_arcs(args.arcs, args.points, sweep, noise,
+                                  args.outliers))
+            for name, (origin_fn, direction_fn) in METHODS.items():
+                errors, correct, failed, elapsed = [], 0, 0, 0
+                for x, y, center, radius, direction in arcs:
+                    t0 = time.perf_counter()
+                    xo, yo = origin_fn(x, y)
+                    elapsed += time.perf_counter() - t0
+                    errors.append(np.hypot(xo - center[0], yo - center[1]) / radius)
+                    try:
+                        correct += direction_fn(x, y) == direction
+                    except ValueError:
+                        failed += 1
+                elapsed /= len(arcs)
+                print(f'{sweep:>6g} {noise:>6g} {name:>16} {elapsed * 1e3:>10.2f} '
+                      f'{np.median(errors):>13.4f} {correct / len(arcs):>13.2f} '
+                      f'{failed / len(arcs):>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
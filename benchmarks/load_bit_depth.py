@@ -0,0 +1,49 @@
+'''
+Benchmark of loading a stack as 8-bit (rescaled) vs. 16-bit (raw counts)
+
+Reports the time required to load the stack, the peak memory allocated while
+loading (as tracked by tracemalloc) and the size of the loaded stack for each
+data type. Requires the reader for the file format (readlif or aicspylibczi).
+
+    python benchmarks/load_bit_depth.py B009-8L-GluR2-CtBP2-MyosinVIIa.lif --stack piece_1
+    python benchmarks/load_bit_depth.py BP1-FL-CtBP2-MyosinVIIa/BP1-FL_piece_1.czi
+'''
+import argparse
+from pathlib import Path
+import time
+import tracemalloc
+
+from cochleogram import util
+
+
+def load(path, stack, dtype):
+    if path.suffix.lower() == '.lif':
+        return util.load_lif(path, stack, dtype=dtype)
+    elif path.suffix.lower() == '.czi':
+        return util.load_czi(path, dtype=dtype)
+    raise ValueError(f'Unrecognized format for {path}')
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark loading stacks at different bit depths')
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--stack', help='Name of stack (LIF files only)')
+    parser.add_argument('--dtypes', nargs='+', default=['uint8', 'uint16'])
+    args = parser.parse_args()
+
+    print(f'{"dtype":>8} {"time (s)":>10} {"peak (MB)":>10} {"stack (MB)":>11} '
+          f'{"peak (B/voxel)":>15}')
+    for dtype in args.dtypes:
+        tracemalloc.start()
+        t0 = time.time()
+        info, img = load(args.path, args.stack, dtype)
+        elapsed = time.time() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{dtype:>8} {elapsed:>10.2f} {peak * 1e-6:>10.1f} '
+              f'{img.nbytes * 1e-6:>11.1f} {peak / img.size:>15.1f}')
+        del img
+
+
+if __name__ == '__main__':
+    main()
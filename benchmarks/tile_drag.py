@@ -0,0 +1,148 @@
+'''
+Benchmark of the cost of each mouse-motion event while dragging a tile
+
+The presenter is created offscreen with an Agg canvas so that the timings
+include the Matplotlib redraw (the time spent outside of the redraw is also
+reported). Cells are added to the piece so that the
+analysis state is a realistic size. Three modes are compared:
+
+* uncached: the tile extent is written on every event and the tile image is
+  re-rendered (the behavior before rendered images were cached).
+* commit: the tile extent is written on every event.
+* preview: only the displayed position of the tile is updated on every event
+  and the extent is written when the mouse button is released.
+
+    python benchmarks/tile_drag.py --size 2048 --tiles 4
+'''
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from enaml.qt.qt_application import QtApplication
+from enaml.qt.QtWidgets import QApplication
+from matplotlib.backend_bases import MouseButton
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+
+from cochleogram.model import Piece, Tile
+from cochleogram.readers import ProcessedCochleaReader
+
+
+def make_tiles(size, n_tiles, n_slices, voxel_size, seed=0):
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for i in range(n_tiles):
+        image = rng.integers(0, 255, (size, size, n_slices, 2), dtype='uint8')
+        info = {
+            'lower': [i * size * voxel_size * 0.8, 0, 0],
+            'voxel_size': [voxel_size, voxel_size, 1],
+            'channels': [{'name': 'CtBP2'}, {'name': 'MyosinVIIa'}],
+            'rotation': 15,
+        }
+        tiles.append(Tile(info, image, f'tile_{i}'))
+    return tiles
+
+
+def process_events():
+    QApplication.processEvents()
+
+
+def time_draw(canvas):
+    '''
+    Wrap canvas.draw to accumulate the time spent drawing
+    '''
+    draw = canvas.draw
+    elapsed = [0]
+
+    def timed_draw(*args, **kwargs):
+        t0 = time.perf_counter()
+        draw(*args, **kwargs)
+        elapsed[0] += time.perf_counter() - t0
+
+    canvas.draw = timed_draw
+    return elapsed
+
+
+def run(presenter, mode, n_events):
+    draw_time = time_draw(presenter.figure.canvas)
+    artist = presenter.current_artist
+    x, y = np.mean(artist.ndimage.get_image_extent()[:2]), 0
+    presenter.tool = 'tile'
+    process_events()
+
+    event = SimpleNamespace(xdata=x, ydata=y, button=MouseButton.RIGHT, key=None)
+    presenter.right_button_press(event)
+    timings = []
+    handler_timings = []
+    for i in range(n_events):
+        draw_time[0] = 0
+        t0 = time.perf_counter()
+        event = SimpleNamespace(xdata=x + i + 1, ydata=y + i + 1)
+        if mode == 'preview':
+            presenter.motion(event)
+        else:
+            # Emulate writing the extent on every event.
+            if mode == 'uncached':
+                artist.clear_render_cache()
+            artist.drag_image(1, 1)
+            presenter.update_state()
+        process_events()
+        process_events()
+        timings.append(time.perf_counter() - t0)
+        handler_timings.append(timings[-1] - draw_time[0])
+
+    t0 = time.perf_counter()
+    event = SimpleNamespace(xdata=x + n_events, ydata=y + n_events, button=MouseButton.RIGHT, key=None)
+    presenter.button_release(event)
+    # Redraw of the tile is deferred and then triggers a deferred redraw of
+    # the figure.
+    process_events()
+    process_events()
+    release = time.perf_counter() - t0
+    return np.array(timings) * 1e3, np.array(handler_timings) * 1e3, release * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark tile dragging')
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--tiles', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=16)
+    parser.add_argument('--voxel-size', type=float, default=0.1)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--cells', type=int, default=1000, help='Number of cells of each type')
+    parser.add_argument('--modes', nargs='+', default=['uncached', 'commit', 'preview'])
+    args = parser.parse_args()
+
+    # Must be imported after creating the application.
+    app = QtApplication()
+    from cochleogram.presenter import CochleogramPresenter
+
+    print(f'{"mode":>10} {"median (ms)":>12} {"max (ms)":>10} '
+          f'{"excl. draw (ms)":>16} {"release (ms)":>13}')
+    for mode in args.modes:
+        tiles = make_tiles(args.size, args.tiles, args.slices, args.voxel_size)
+        piece = Piece(tiles, 1, copied_from='')
+        rng = np.random.default_rng(0)
+        extent = piece.get_image_extent()
+        for cells in piece.cells.values():
+            x = rng.uniform(extent[0], extent[1], args.cells)
+            y = rng.uniform(extent[2], extent[3], args.cells)
+            cells.set_nodes(x.tolist(), y.tolist())
+        reader = ProcessedCochleaReader(Path(tempfile.mkdtemp()))
+        presenter = CochleogramPresenter(piece, reader)
+        # Don't limit the frame rate so that each event is drawn immediately.
+        presenter.scheduler.max_fps = 1e6
+        FigureCanvasAgg(presenter.figure)
+        process_events()
+        timings, handler_timings, release = run(presenter, mode, args.events)
+        print(f'{mode:>10} {np.median(timings):>12.1f} {timings.max():>10.1f} '
+              f'{np.median(handler_timings):>16.1f} {release:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,472 @@
+'''
+Aggregate cell counts per frequency band across a cohort of cochleae
+
+Scans a folder (and its subfolders) for saved analyses of entire cochleae,
+maps each cell onto the IHC spiral to determine its frequency (see
+`Cochlea.calculate_distance`) and counts the cells in each frequency band.
+Only the saved analysis is needed (the images are not loaded).
+
+For each cell type, cells that fall in a region excluded from the spiral of
+that cell type are not counted and the excluded length is reported.
+Missing cells are estimated from gaps in each row of cells that are larger
+than the typical spacing of the cells in the row.
+
+The results are saved to a SQLite database with the following tables:
+
+    cochleae
+        One row per cochlea, including the status (ok or failed) and the
+        modification times of the analysis files used.
+    bands
+        Counts for each cell type in each frequency band of each cochlea.
+    cells
+        Position, distance from the base and frequency of each cell.
+
+On subsequent runs, only cochleae whose analysis files have changed are
+processed again.
+
+    cochleogram-aggregate <folder> --species mouse
+'''
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+import re
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from psiaudio.util import octave_space
+from scipy.spatial import cKDTree
+
+from cochleogram import analysis_file, model
+from cochleogram.config import CELLS, SPECIES_SETTINGS
+
+
+P_ANALYSIS = re.compile(r'^(.*)_piece_(\d+)_analysis\.(json|npz)$')
+
+TABLES = ('cochleae', 'bands', 'cells')
+
+
+def find_analyses(root):
+    '''
+    Find saved analysis of each cochlea in root (including subfolders)
+
+    Returns
+    -------
+    analyses : dict
+        Mapping of cochlea (the name of the dataset, including its folder
+        relative to root) to a dictionary mapping piece number to the
+        analysis file. If the analysis of a piece has been saved in more than
+        one format, the most recently modified file is used.
+    '''
+    root = Path(root)
+    analyses = {}
+    for filename in root.rglob('*_piece_*_analysis.*'):
+        if (m := P_ANALYSIS.match(filename.name)) is None:
+            continue
+        name, piece = m.group(1), int(m.group(2))
+        cochlea = (filename.parent / name).relative_to(root).as_posix()
+        pieces = analyses.setdefault(cochlea, {})
+        if piece not in pieces or \
+                filename.stat().st_mtime > pieces[piece].stat().st_mtime:
+            pieces[piece] = filename
+    return {c: dict(sorted(p.items())) for c, p in sorted(analyses.items())}
+
+
+def get_signature(pieces):
+    '''
+    Return string that changes whenever any of the analysis files change
+    '''
+    signature = []
+    for piece, filename in pieces.items():
+        stat = filename.stat()
+        signature.append([piece, filename.name, stat.st_mtime_ns, stat.st_size])
+    return json.dumps(signature)
+
+
+def load_cochlea(pieces):
+    '''
+    Create cochlea from the saved analysis of each piece (without the images)
+    '''
+    result = []
+    for piece, filename in pieces.items():
+        state = analysis_file.load(filename)['data']
+        p = model.Piece([], piece, copied_from=state.get('copied_from') or '')
+        p.set_state(state)
+        result.append(p)
+    return model.Cochlea(result)
+
+
+def _spiral_position(spiral):
+    # Interpolated points along the spiral, cumulative distance (in microns)
+    # along the spiral and a mask of the points in excluded regions.
+    xi, yi = spiral.interpolate(resolution=0.001)
+    xi, yi = np.asarray(xi), np.asarray(yi)
+    if len(xi) == 0:
+        return None
+    s = np.r_[0, np.sqrt(np.diff(xi) ** 2 + np.diff(yi) ** 2).cumsum()]
+    excluded = np.zeros(len(xi), dtype=bool)
+    if len(spiral.exclude):
+        v = xi + yi * 1j
+        ends = np.asarray(spiral.exclude, dtype=float).reshape((-1, 2, 2))
+        ends = ends[..., 0] + ends[..., 1] * 1j
+        i = np.abs(ends[..., np.newaxis] - v).argmin(axis=-1)
+        for lb, ub in zip(i.min(axis=1), i.max(axis=1)):
+            excluded[lb:ub+1] = True
+    return np.c_[xi, yi], s, excluded
+
+
+def estimate_missing(s, excluded_s, max_gap=1.5):
+    '''
+    Estimate positions of missing cells in a row of cells
+
+    Parameters
+    ----------
+    s : array
+        Sorted positions of the cells along the spiral.
+    excluded_s : array
+        Positions along the spiral that are in excluded regions. Gaps that
+        contain an excluded position are ignored.
+    max_gap : float
+        Gaps larger than this multiple of the median spacing of the cells
+        are assumed to contain missing cells.
+
+    Returns
+    -------
+    missing : array
+        Estimated positions of the missing cells along the spiral.
+    '''
+    if len(s) < 3:
+        return np.array([])
+    gaps = np.diff(s)
+    spacing = np.median(gaps)
+    missing = []
+    for lb, gap in zip(s[:-1], gaps):
+        if gap <= max_gap * spacing:
+            continue
+        if np.any((excluded_s > lb) & (excluded_s < lb + gap)):
+            continue
+        n = int(np.round(gap / spacing)) - 1
+        missing.extend(lb + gap * np.arange(1, n + 1) / (n + 1))
+    return np.array(missing)
+
+
+def summarize_cochlea(cochlea, species='mouse', freq_start=None,
+                      freq_end=None, band_width=1):
+    '''
+    Count cells in each frequency band
+
+    Parameters
+    ----------
+    cochlea : Cochlea
+        Cochlea to summarize. The IHC spiral must be complete.
+    species : str
+        Species used to map distance along the IHC spiral to frequency.
+    freq_start, freq_end : {None, float}
+        Range of frequencies (in kHz) to bin. If None, the default for the
+        species is used.
+    band_width : float
+        Width of the frequency bands in octaves.
+
+    Returns
+    -------
+    bands : DataFrame
+        Length of the spiral analyzed (excluding excluded regions), length
+        excluded, and number of cells, supernumerary cells and estimated
+        missing cells in each frequency band for each cell type.
+    cells : DataFrame
+        Position, distance from the base and frequency of each cell.
+    '''
+    settings = SPECIES_SETTINGS[species]
+    if freq_start is None:
+        freq_start = settings['freq_lb']
+    if freq_end is None:
+        freq_end = settings['freq_ub']
+    edges = octave_space(freq_start, freq_end, band_width)
+    distance = cochlea.get_spiral_distance()
+    spiral_frequency = distance.get_frequency(species)
+
+    band_rows = []
+    cell_rows = []
+    for piece in cochlea.pieces:
+        b = distance.bounds[piece.piece]
+        ihc_tree = cKDTree(np.c_[distance.x_orig[b], distance.y_orig[b]])
+        ihc_frequency = spiral_frequency[b]
+        ihc_distance = distance.distance_mm[b]
+        ihc_distance_norm = distance.distance_norm[b]
+
+        for cell_type in CELLS:
+            spiral = _spiral_position(piece.spirals[cell_type])
+            cells = piece.cells[cell_type]
+            xy = np.c_[cells.x, cells.y].reshape((-1, 2))
+            supernumerary = {tuple(c) for c in zip(*cells.get_labeled_nodes('supernumerary'))}
+
+            # Frequency of each cell is set by the nearest point on the IHC
+            # spiral.
+            _, i = ihc_tree.query(xy)
+            frequency = ihc_frequency[i] if len(xy) else np.array([])
+            if spiral is not None:
+                spiral_xy, spiral_s, spiral_excluded = spiral
+                _, j = cKDTree(spiral_xy).query(xy)
+                excluded = spiral_excluded[j] if len(xy) else np.array([], dtype=bool)
+                s = spiral_s[j] if len(xy) else np.array([])
+            else:
+                excluded = np.zeros(len(xy), dtype=bool)
+                s = None
+
+            for k, (x, y) in enumerate(xy):
+                cell_rows.append({
+                    'piece': piece.piece,
+                    'cell_type': cell_type,
+                    'x': x,
+                    'y': y,
+                    'distance_mm': ihc_distance[i[k]],
+                    'distance_norm': ihc_distance_norm[i[k]],
+                    'frequency': frequency[k],
+                    'excluded': bool(excluded[k]),
+                    'supernumerary': (x, y) in supernumerary,
+                })
+
+            # Length of the spiral (analyzed and excluded) in each band. Each
+            # segment is assigned to the band of its starting point.
+            if spiral is not None:
+                _, si = ihc_tree.query(spiral_xy[:-1])
+                seg_frequency = ihc_frequency[si]
+                seg_length = np.diff(spiral_s) * 1e-3
+                seg_excluded = spiral_excluded[:-1]
+                s_sorted = np.sort(s[~excluded])
+                missing_s = estimate_missing(s_sorted, spiral_s[spiral_excluded])
+                _, mi = ihc_tree.query(np.c_[
+                    np.interp(missing_s, spiral_s, spiral_xy[:, 0]),
+                    np.interp(missing_s, spiral_s, spiral_xy[:, 1]),
+                ].reshape((-1, 2)))
+                missing_frequency = ihc_frequency[mi] if len(missing_s) else np.array([])
+            else:
+                seg_frequency = seg_length = missing_frequency = np.array([])
+                seg_excluded = np.array([], dtype=bool)
+
+            n_super = np.array([(x, y) in supernumerary for x, y in xy], dtype=bool)
+            for lb, ub in zip(edges[:-1], edges[1:]):
+                m_cell = (frequency >= lb) & (frequency < ub)
+                m_seg = (seg_frequency >= lb) & (seg_frequency < ub)
+                m_missing = (missing_frequency >= lb) & (missing_frequency < ub)
+                band_rows.append({
+                    'piece': piece.piece,
+                    'cell_type': cell_type,
+                    'freq_lb': lb,
+                    'freq_ub': ub,
+                    'length_mm': seg_length[m_seg & ~seg_excluded].sum(),
+                    'excluded_mm': seg_length[m_seg & seg_excluded].sum(),
+                    'n_cells': int((m_cell & ~excluded).sum()),
+                    'n_supernumerary': int((m_cell & ~excluded & n_super).sum()),
+                    'n_missing': int(m_missing.sum()) if spiral is not None else np.nan,
+                })
+
+    bands = pd.DataFrame(band_rows)
+    bands = bands.groupby(['cell_type', 'freq_lb', 'freq_ub'], sort=False).sum(min_count=1) \
+        .drop(columns='piece').reset_index()
+    bands['freq_center'] = np.sqrt(bands['freq_lb'] * bands['freq_ub'])
+    bands['percent_missing'] = 100 * bands['n_missing'] / (bands['n_cells'] + bands['n_missing'])
+    bands['cells_per_100um'] = (bands['n_cells'] / (bands['length_mm'] * 10)) \
+        .where(bands['length_mm'] > 0)
+    cells = pd.DataFrame(cell_rows, columns=['piece', 'cell_type', 'x', 'y',
+                                             'distance_mm', 'distance_norm',
+                                             'frequency', 'excluded',
+                                             'supernumerary'])
+    return bands, cells
+
+
+def process_cochlea(cochlea, pieces, **kwargs):
+    '''
+    Load and summarize the analysis of a single cochlea (see
+    `summarize_cochlea`)
+
+    Returns
+    -------
+    result : dict
+        Summary of the cochlea and the bands and cells tables (None if the
+        cochlea could not be summarized).
+    '''
+    t0 = time.time()
+    summary = {
+        'cochlea': cochlea,
+        'name': Path(cochlea).name,
+        'n_pieces': len(pieces),
+        'signature': get_signature(pieces),
+        'status': 'ok',
+        'error': None,
+        'length_mm': np.nan,
+    }
+    bands = cells = None
+    try:
+        obj = load_cochlea(pieces)
+        bands, cells = summarize_cochlea(obj, **kwargs)
+        summary['length_mm'] = obj.get_spiral_distance().distance_mm[-1]
+        bands.insert(0, 'cochlea', cochlea)
+        cells.insert(0, 'cochlea', cochlea)
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = f'{type(e).__name__}: {e}'
+    summary['elapsed'] = time.time() - t0
+    return {'summary': summary, 'bands': bands, 'cells': cells}
+
+
+class CohortDatabase:
+    '''
+    SQLite database of the cohort summary
+
+    The options used to generate the summary (e.g., species and frequency
+    bands) are saved in the `meta` table. If the options change, the existing
+    results are discarded.
+    '''
+
+    def __init__(self, filename, options):
+        self.filename = Path(filename)
+        self.conn = sqlite3.connect(self.filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        options = json.dumps(options, sort_keys=True)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'options'").fetchone()
+        if row is None or row[0] != options:
+            for table in TABLES:
+                self.conn.execute(f'DROP TABLE IF EXISTS {table}')
+            self.conn.execute("REPLACE INTO meta VALUES ('options', ?)", (options,))
+            self.conn.commit()
+
+    def has_table(self, table):
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return self.conn.execute(query, (table,)).fetchone() is not None
+
+    def get_signatures(self):
+        '''
+        Return signature of the analysis files used for each cochlea
+        '''
+        if not self.has_table('cochleae'):
+            return {}
+        return dict(self.conn.execute('SELECT cochlea, signature FROM cochleae'))
+
+    def remove(self, cochlea):
+        for table in TABLES:
+            if self.has_table(table):
+                self.conn.execute(f'DELETE FROM {table} WHERE cochlea = ?', (cochlea,))
+
+    def update(self, result):
+        '''
+        Replace the rows for the cochlea with the result of `process_cochlea`
+        '''
+        cochlea = result['summary']['cochlea']
+        with self.conn:
+            self.remove(cochlea)
+            pd.DataFrame([result['summary']]).to_sql('cochleae', self.conn,
+                                                     if_exists='append',
+                                                     index=False)
+            for table in ('bands', 'cells'):
+                if result[table] is not None:
+                    result[table].to_sql(table, self.conn, if_exists='append',
+                                         index=False)
+
+    def close(self):
+        self.conn.close()
+
+
+def aggregate(root, filename=None, jobs=None, force=False, callback=None,
+              **kwargs):
+    '''
+    Summarize all cochleae in root and save the results to a SQLite database
+
+    Parameters
+    ----------
+    root : {str, Path}
+        Folder to search (including subfolders) for saved analyses.
+    filename : {None, str, Path}
+        Database to save the results to. Defaults to `cochleogram.db` in
+        root.
+    jobs : {None, int}
+        Number of cochleae to process in parallel.
+    force : bool
+        If True, process all cochleae even if their analysis is unchanged.
+    callback : {None, callable}
+        Called with the result of `process_cochlea` as each cochlea is
+        completed.
+    **kwargs
+        Options passed to `summarize_cochlea`.
+
+    Returns
+    -------
+    n : dict
+        Number of cochleae processed, skipped (unchanged) and failed.
+    '''
+    root = Path(root)
+    if filename is None:
+        filename = root / 'cochleogram.db'
+    db = CohortDatabase(filename, kwargs)
+    n = {'ok': 0, 'skipped': 0, 'failed': 0, 'removed': 0}
+    try:
+        analyses = find_analyses(root)
+        signatures = db.get_signatures()
+
+        # Remove cochleae whose analysis no longer exists
+        for cochlea in set(signatures) - set(analyses):
+            with db.conn:
+                db.remove(cochlea)
+            n['removed'] += 1
+
+        pending = {}
+        for cochlea, pieces in analyses.items():
+            if not force and signatures.get(cochlea) == get_signature(pieces):
+                n['skipped'] += 1
+            else:
+                pending[cochlea] = pieces
+
+        if pending:
+            with ProcessPoolExecutor(jobs) as executor:
+                futures = [executor.submit(process_cochlea, c, p, **kwargs)
+                           for c, p in pending.items()]
+                for future in as_completed(futures):
+                    result = future.result()
+                    db.update(result)
+                    n[result['summary']['status']] += 1
+                    if callback is not None:
+                        callback(result)
+    finally:
+        db.close()
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser('Summarize cell counts per frequency band across cochleae')
+    parser.add_argument('root', type=Path, help='Folder containing the '
+                        'analysis (subfolders are searched)')
+    parser.add_argument('--output', type=Path, help='SQLite database to save '
+                        'the results to (default is cochleogram.db in root)')
+    parser.add_argument('--species', choices=('mouse', 'gerbil'), default='mouse')
+    parser.add_argument('--freq-start', type=float, help='Lowest frequency (kHz)')
+    parser.add_argument('--freq-end', type=float, help='Highest frequency (kHz)')
+    parser.add_argument('--band-width', type=float, default=1,
+                        help='Width of frequency bands (octaves)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true',
+                        help='Process all cochleae, including unchanged ones')
+    args = parser.parse_args()
+
+    def report(result):
+        summary = result['summary']
+        print(f'{summary["status"]:>7} {summary["elapsed"]:6.2f}s {summary["cochlea"]}')
+        if summary['error']:
+            print(f'    {summary["error"]}')
+        sys.stdout.flush()
+
+    t0 = time.time()
+    n = aggregate(args.root, args.output, args.jobs, args.force, report,
+                  species=args.species, freq_start=args.freq_start,
+                  freq_end=args.freq_end, band_width=args.band_width)
+    print(f'{n["ok"]} summarized, {n["skipped"]} unchanged, {n["failed"]} '
+          f'failed, {n["removed"]} removed in {time.time() - t0:.1f}s')
+    if n['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
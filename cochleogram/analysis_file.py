@@ -0,0 +1,219 @@
+'''
+Compact binary format for saved analysis
+
+The analysis is normally saved as indented JSON. For analyses with thousands
+of cells, parsing the JSON dominates the time needed to load the analysis.
+The compact format is a NumPy `.npz` archive: the numeric lists in the state
+(e.g., the coordinates of cells, spirals and puncta, and the excluded regions)
+are stored as binary arrays and the remainder of the state is stored as JSON
+in the `state` entry of the archive. The labels of cells (see
+`Points.get_state`) are stored in columns (coordinates, number of labels and
+label names).
+
+Loading the compact format returns the same structure as loading the JSON, so
+both formats can be used interchangeably.
+
+To convert existing analysis files:
+
+    cochleogram-convert-analysis <path> [<path> ...] [--to npz]
+'''
+import argparse
+import io
+import json
+from pathlib import Path
+
+import numpy as np
+
+from cochleogram.util import write_atomic
+
+
+FORMATS = {
+    '.json': 'json',
+    '.npz': 'npz',
+}
+
+# Numeric lists with fewer elements than this are kept in the JSON since each
+# array adds some overhead to the archive.
+MIN_ARRAY_SIZE = 16
+
+
+def _encode_labels(labels, arrays):
+    # Labels are a list of [[x, y], [label, ...]] (see `Points.get_state`).
+    name = f'labels_{len(arrays)}'
+    xy = np.array([k for k, _ in labels], dtype='f8').reshape((-1, 2))
+    count = np.array([len(v) for _, v in labels], dtype='i8')
+    names = np.array([l for _, v in labels for l in v], dtype='U')
+    arrays[f'{name}_xy'] = xy
+    arrays[f'{name}_count'] = count
+    arrays[f'{name}_names'] = names
+    return {'__labels__': name}
+
+
+def _decode_labels(name, arrays):
+    xy = arrays[f'{name}_xy'].tolist()
+    count = arrays[f'{name}_count'].tolist()
+    names = arrays[f'{name}_names'].tolist()
+    labels = []
+    i = 0
+    for k, n in zip(xy, count):
+        labels.append([k, names[i:i+n]])
+        i += n
+    return labels
+
+
+def _encode(value, arrays):
+    if isinstance(value, dict):
+        result = {}
+        for k, v in value.items():
+            if k == 'labels' and isinstance(v, list) and v:
+                result[k] = _encode_labels(v, arrays)
+            else:
+                result[k] = _encode(v, arrays)
+        return result
+    if isinstance(value, (list, tuple)):
+        if len(value) >= MIN_ARRAY_SIZE or \
+                (value and isinstance(value[0], (list, tuple))):
+            try:
+                array = np.array(value)
+            except (ValueError, OverflowError):
+                # Ragged list or values that cannot be stored in an array
+                array = None
+            if array is not None and array.dtype.kind in 'biuf' and \
+                    array.size >= MIN_ARRAY_SIZE:
+                name = f'array_{len(arrays)}'
+                arrays[name] = array
+                return {'__array__': name}
+        return [_encode(v, arrays) for v in value]
+    return value
+
+
+def _decode(value, arrays):
+    if isinstance(value, dict):
+        if '__array__' in value:
+            return arrays[value['__array__']].tolist()
+        if '__labels__' in value:
+            return _decode_labels(value['__labels__'], arrays)
+        return {k: _decode(v, arrays) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    return value
+
+
+def dumps_npz(state):
+    '''
+    Return the state encoded in the compact format as bytes
+    '''
+    arrays = {}
+    header = _encode(state, arrays)
+    arrays['state'] = np.frombuffer(json.dumps(header).encode('utf-8'), dtype='u1')
+    fh = io.BytesIO()
+    np.savez(fh, **arrays)
+    return fh.getvalue()
+
+
+def load_npz(filename):
+    '''
+    Load state saved in the compact format
+    '''
+    with np.load(filename, allow_pickle=False) as fh:
+        arrays = dict(fh.items())
+    header = json.loads(arrays.pop('state').tobytes().decode('utf-8'))
+    return _decode(header, arrays)
+
+
+def equal(a, b):
+    '''
+    True if the states are equal (unlike `==`, NaN values are equal)
+    '''
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(equal(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b):
+        return True
+    return a == b
+
+
+def get_format(filename):
+    try:
+        return FORMATS[Path(filename).suffix.lower()]
+    except KeyError:
+        raise ValueError(f'Unrecognized analysis format for {filename}')
+
+
+def load(filename):
+    '''
+    Load state from filename (the format is determined by the extension)
+    '''
+    if get_format(filename) == 'npz':
+        return load_npz(filename)
+    return json.loads(Path(filename).read_text())
+
+
+def save(filename, state):
+    '''
+    Save state to filename (the format is determined by the extension)
+    '''
+    if get_format(filename) == 'npz':
+        write_atomic(filename, dumps_npz(state))
+    else:
+        write_atomic(filename, json.dumps(state, indent=4))
+
+
+def convert(filename, state_format='npz', keep=False):
+    '''
+    Convert analysis file to the specified format
+
+    The converted file is loaded and compared with the original before the
+    original is removed.
+
+    Parameters
+    ----------
+    filename : {str, Path}
+        Analysis file to convert.
+    state_format : {'npz', 'json'}
+        Format to convert to.
+    keep : bool
+        If True, keep the original file. Note that `BaseReader.load_state`
+        loads the most recently modified file when both are present.
+
+    Returns
+    -------
+    new_filename : Path
+        Name of converted file.
+    '''
+    filename = Path(filename)
+    new_filename = filename.with_suffix(f'.{state_format}')
+    if new_filename == filename:
+        return filename
+    state = load(filename)
+    save(new_filename, state)
+    if not equal(load(new_filename), state):
+        new_filename.unlink()
+        raise ValueError(f'Conversion of {filename} did not preserve the analysis')
+    if not keep:
+        filename.unlink()
+    return new_filename
+
+
+def main():
+    parser = argparse.ArgumentParser('Convert saved analysis between JSON and compact (npz) format')
+    parser.add_argument('paths', nargs='+', type=Path, help='Analysis files '
+                        'or folders to search for analysis files')
+    parser.add_argument('--to', choices=('npz', 'json'), default='npz')
+    parser.add_argument('--keep', action='store_true', help='Keep the original files')
+    args = parser.parse_args()
+
+    src_suffix = '.json' if args.to == 'npz' else '.npz'
+    for path in args.paths:
+        if path.is_dir():
+            filenames = sorted(path.glob(f'**/*_analysis{src_suffix}'))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            new_filename = convert(filename, args.to, args.keep)
+            print(f'Converted {filename} to {new_filename.name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+'''
+Background autosave of the analysis
+
+Edits are debounced so that the analysis is only saved once the user pauses
+(or after `AutosaveService.max_delay` seconds of continuous editing). A cheap
+copy of the state is made on the GUI thread and then serialized and written
+on a background thread. Each autosave is written atomically (to a temporary
+file that is then renamed) alongside the analysis file, and the most recent
+`AutosaveService.max_snapshots` autosaves are kept.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+from atom.api import Atom, Dict, Float, Int, Value
+from enaml.application import timed_call
+
+from cochleogram.util import write_atomic
+
+
+def copy_state(state):
+    '''
+    Copy the dictionaries and lists in the state
+
+    Much faster than `copy.deepcopy` for large states (e.g., thousands of
+    cells) since other values (e.g., floats, strings and tuples) are immutable
+    and can be shared with the original.
+    '''
+    if isinstance(state, dict):
+        return {k: copy_state(v) for k, v in state.items()}
+    if isinstance(state, list):
+        return [copy_state(v) if isinstance(v, (dict, list)) else v for v in state]
+    return state
+
+
+def autosave_filename(filename, snapshot=0):
+    '''
+    Return name of autosave snapshot for the analysis saved to filename
+
+    Snapshot 0 is the most recent.
+    '''
+    suffix = '' if snapshot == 0 else f'_{snapshot}'
+    return filename.with_name(f'{filename.stem}_autosave{suffix}.json')
+
+
+class AutosaveService(Atom):
+    '''
+    Saves the analysis of each presenter in the background after it has been
+    edited
+    '''
+
+    #: Save once there have been no edits for this many seconds
+    delay = Float(2)
+
+    #: Maximum number of seconds between the first unsaved edit and the
+    #: autosave (i.e., when the user edits continuously)
+    max_delay = Float(10)
+
+    #: Number of autosave snapshots to keep for each analysis
+    max_snapshots = Int(5)
+
+    #: Executor that runs the background thread
+    executor = Value()
+
+    #: Number of autosaves written
+    n_saved = Int(0)
+
+    #: Incremented on each edit of the presenter. Used to ignore timers for
+    #: all but the most recent edit.
+    requests = Dict()
+
+    #: Time of the first edit of the presenter since it was last autosaved
+    first_request = Dict()
+
+    #: Version of the analysis (see `CellAnalysis.get_version`) of each
+    #: presenter when it was last autosaved
+    saved_versions = Dict()
+
+    #: Future for the most recent write
+    future = Value()
+
+    def _default_executor(self):
+        return ThreadPoolExecutor(1, thread_name_prefix='autosave')
+
+    def request(self, presenter):
+        '''
+        Request an autosave of the presenter's analysis
+        '''
+        now = time.time()
+        first = self.first_request.setdefault(presenter, now)
+        request = self.requests.get(presenter, 0) + 1
+        self.requests[presenter] = request
+        delay = min(self.delay, max(first + self.max_delay - now, 0))
+        timed_call(int(delay * 1e3), self._save, presenter, request)
+
+    def _save(self, presenter, request):
+        # Only the timer for the most recent edit saves, unless edits have
+        # been arriving continuously for longer than `max_delay`.
+        first = self.first_request.get(presenter)
+        overdue = first is not None and time.time() >= first + self.max_delay
+        if self.requests.get(presenter) != request and not overdue:
+            return
+        self.first_request.pop(presenter, None)
+        self.save(presenter)
+
+    def save(self, presenter):
+        '''
+        Save the presenter's analysis in the background if it has changed
+        since it was last saved or autosaved
+        '''
+        version = presenter.obj.get_version()
+        if version in (presenter.saved_version, self.saved_versions.get(presenter)):
+            return
+        self.saved_versions[presenter] = version
+        state = presenter.get_autosave_state()
+        filename = presenter.reader.state_filename(presenter.obj)
+        self.future = self.executor.submit(self._write, filename, state)
+
+    def _write(self, filename, state):
+        try:
+            text = json.dumps(state, indent=4)
+            filename.parent.mkdir(exist_ok=True)
+            # Rotate older snapshots, discarding the oldest.
+            for i in range(self.max_snapshots - 1, 0, -1):
+                src = autosave_filename(filename, i - 1)
+                if src.exists():
+                    os.replace(src, autosave_filename(filename, i))
+            write_atomic(autosave_filename(filename), text)
+            self.n_saved += 1
+        except Exception as e:
+            log.exception(e)
+
+    def unregister(self, presenter):
+        '''
+        Stop tracking the presenter (e.g., when the dataset is closed)
+
+        Any edit that is still waiting for its autosave is saved right away.
+        Timers that are still pending for the presenter are ignored.
+        '''
+        if presenter in self.first_request:
+            self.save(presenter)
+        self.requests.pop(presenter, None)
+        self.first_request.pop(presenter, None)
+        self.saved_versions.pop(presenter, None)
+
+    def flush(self):
+        '''
+        Wait until all pending writes are complete
+        '''
+        if self.future is not None:
+            self.future.result()
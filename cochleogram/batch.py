@@ -0,0 +1,202 @@
+'''
+Generate composites (frequency maps) for many cochleae without the GUI
+
+Each dataset is processed in a separate process. The reader is selected based
+on the format of the dataset (as when loading a dataset in the GUI) and the
+composite is saved alongside the analysis. Datasets whose composite is newer
+than the saved analysis are skipped, so an interrupted run can be resumed by
+running the same command again.
+
+    cochleogram-batch "data/*.lif" --species mouse --jobs 4
+'''
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from glob import glob
+import os
+from pathlib import Path
+import sys
+import time
+import traceback
+
+from matplotlib import pyplot as plt
+
+from cochleogram import plot, readers
+from cochleogram.config import SPECIES_SETTINGS
+
+
+def expand_paths(paths):
+    '''
+    Expand glob patterns (e.g., on Windows, where the shell does not) in the
+    list of dataset paths
+    '''
+    expanded = []
+    for path in paths:
+        if any(c in str(path) for c in '*?['):
+            expanded.extend(sorted(glob(str(path))))
+        else:
+            expanded.append(path)
+    return [Path(p) for p in expanded]
+
+
+def composite_filename(reader, file_format='pdf'):
+    # Must match the name used by `CochleaReader.save_figure`.
+    return reader.save_path() / f'{reader.get_name()}_frequency_map.{file_format}'
+
+
+def is_up_to_date(reader, file_format='pdf'):
+    '''
+    True if the composite exists and is newer than the saved analysis
+    '''
+    filename = composite_filename(reader, file_format)
+    if not filename.exists():
+        return False
+    analysis_mtimes = [f.stat().st_mtime for f in reader.save_path().glob('*_analysis.*')]
+    return filename.stat().st_mtime >= max(analysis_mtimes, default=0)
+
+
+def process_dataset(path, species='mouse', freq_start=None, freq_end=None,
+                    freq_step=0.5, channels=None, file_format='pdf',
+                    force=False):
+    '''
+    Generate composite with frequency map for a single cochlea
+
+    Parameters
+    ----------
+    path : Path
+        Dataset to process.
+    species : {None, 'mouse', 'gerbil'}
+        Species used for the frequency map. If None, only the spiral is
+        plotted.
+    freq_start, freq_end : {None, float}
+        Range of frequencies (in kHz) to mark. If None, the default for the
+        species is used.
+    freq_step : float
+        Spacing of the frequencies in octaves.
+    channels : {None, list}
+        Names of channels to include in the composite. If None, all channels
+        are included.
+    file_format : str
+        Format of the figure.
+    force : bool
+        If True, regenerate the composite even if it is newer than the
+        analysis.
+
+    Returns
+    -------
+    result : dict
+        Status ('done', 'skipped' or 'failed'), elapsed time and, if the
+        dataset failed, the error message and traceback.
+    '''
+    t0 = time.time()
+    result = {'path': str(path), 'status': 'done', 'error': None, 'traceback': None}
+    try:
+        path = Path(path)
+        if readers.is_tile_dataset(path):
+            raise ValueError('Composites can only be generated for cochlea datasets')
+        reader = readers.get_cochlea_reader_class(path)(path)
+        result['filename'] = str(composite_filename(reader, file_format))
+        if not force and is_up_to_date(reader, file_format):
+            result['status'] = 'skipped'
+        else:
+            cochlea = reader.load_collection(raise_load_analysis_error=True)
+            if not cochlea.ihc_spiral_complete():
+                raise ValueError('The IHC spiral is incomplete')
+            if channels is None:
+                channels = cochlea.channel_names
+            if species is not None:
+                settings = SPECIES_SETTINGS[species]
+                freq_map = {
+                    'freq_start': settings['freq_lb'] if freq_start is None else freq_start,
+                    'freq_end': settings['freq_ub'] if freq_end is None else freq_end,
+                    'freq_step': freq_step,
+                }
+            else:
+                freq_map = None
+            fig = plot.plot_composite(cochlea, freq_map=freq_map,
+                                      freq_spiral=True, channels=channels,
+                                      species=species)
+            title = reader.get_name()
+            if species is not None:
+                title = title + '\n' + species + ' map'
+            fig.suptitle(title)
+            reader.save_figure(fig, 'frequency_map', file_format=file_format)
+            plt.close(fig)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+    result['elapsed'] = time.time() - t0
+    return result
+
+
+def process_datasets(paths, jobs=None, **kwargs):
+    '''
+    Process datasets in parallel, yielding the result for each dataset as it
+    completes (see `process_dataset`)
+    '''
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(process_dataset, p, **kwargs) for p in paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser('Generate composites (frequency maps) for many cochleae')
+    parser.add_argument('paths', nargs='+', help='Datasets (LIF files or '
+                        'folders of CZI or IMS files). Glob patterns are '
+                        'expanded.')
+    parser.add_argument('--species', choices=('mouse', 'gerbil', 'none'),
+                        default='mouse', help='Species for the frequency map '
+                        '(none to only plot the spiral)')
+    parser.add_argument('--freq-start', type=float, help='Lowest frequency (kHz)')
+    parser.add_argument('--freq-end', type=float, help='Highest frequency (kHz)')
+    parser.add_argument('--freq-step', type=float, default=0.5,
+                        help='Spacing of frequencies (octaves)')
+    parser.add_argument('--channels', nargs='+', help='Channels to include '
+                        'in the composite (default is all channels)')
+    parser.add_argument('--format', dest='file_format', default='pdf',
+                        choices=('pdf', 'tiff', 'jpg', 'png'))
+    parser.add_argument('--jobs', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Number of datasets to process in parallel. Each '
+                        'process loads an entire cochlea into memory.')
+    parser.add_argument('--force', action='store_true', help='Regenerate '
+                        'composites that are newer than the analysis')
+    parser.add_argument('--traceback', action='store_true',
+                        help='Show full traceback for failed datasets')
+    args = parser.parse_args()
+
+    paths = expand_paths(args.paths)
+    if not paths:
+        parser.error('No datasets found')
+
+    species = None if args.species == 'none' else args.species
+    n = {'done': 0, 'skipped': 0, 'failed': 0}
+    t0 = time.time()
+    results = process_datasets(paths, args.jobs, species=species,
+                               freq_start=args.freq_start,
+                               freq_end=args.freq_end,
+                               freq_step=args.freq_step,
+                               channels=args.channels,
+                               file_format=args.file_format,
+                               force=args.force)
+    for i, result in enumerate(results):
+        n[result['status']] += 1
+        print(f'[{i+1}/{len(paths)}] {result["status"]:>7} '
+              f'{result["elapsed"]:7.1f}s {result["path"]}')
+        if result['status'] == 'failed':
+            print(f'    {result["error"]}')
+            if args.traceback:
+                print(result['traceback'])
+        sys.stdout.flush()
+
+    print(f'{n["done"]} done, {n["skipped"]} skipped (up to date), '
+          f'{n["failed"]} failed in {time.time() - t0:.1f}s')
+    if n['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
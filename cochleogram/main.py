@@ -36,15 +36,31 @@ def main():
 
     parser = argparse.ArgumentParser("Cochleogram helper")
     parser.add_argument("path", nargs='?')
+    parser.add_argument("--channels", nargs='+', help="Channels to load, "
+                        "specified by name (e.g., CtBP2) or emission "
+                        "wavelength in nm (e.g., 568; CZI and IMS files "
+                        "only). The selection is saved "
+                        "with the dataset and reused the next time it is "
+                        "loaded.")
+    parser.add_argument("--raw", action='store_true', help="Keep the raw "
+                        "counts (up to 16 bits) rather than rescaling each "
+                        "channel to 8 bits. Uses twice the memory.")
     args = parser.parse_args()
 
+    channels = None
+    if args.channels is not None:
+        channels = [float(c) if c.replace('.', '', 1).isdigit() else c \
+                    for c in args.channels]
+
     app = QtApplication()
     config = get_config()
 
     current_path = config['DEFAULT']['current_path']
     view = CochleogramWindow(current_path=current_path)
     if args.path is not None:
-        deferred_call(load_dataset, args.path, view)
+        dtype = 'uint16' if args.raw else None
+        deferred_call(load_dataset, args.path, view, channels=channels,
+                      dtype=dtype)
     view.show()
     app.start()
     app.stop()
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 log = logging.getLogger(__name__)
+from pathlib import Path
 
 from atom.api import Atom, Bool, Dict, Event, Int, List, Property, Str, Typed, Value
 from matplotlib import colors
@@ -11,10 +13,12 @@ from psiaudio.util import octave_space
 from scipy import interpolate
 from scipy import ndimage
 from scipy import signal
+from scipy.spatial import cKDTree
 from skimage.registration import phase_cross_correlation
 from skimage.color import rgb2gray
 
 from ndimage_enaml.model import NDImage, NDImageCollection
+from ndimage_enaml.util import color_image
 
 from cochleogram import util
 from cochleogram.config import CELLS, CHANNEL_CONFIG
@@ -30,12 +34,25 @@ class Points(Atom):
 
     updated = Event()
 
+    #: Incremented whenever the points change (i.e., on every `updated`
+    #: event). Used for cheap detection of unsaved changes.
+    version = Int()
+
+    #: Most recent spline interpolations keyed by the interpolation
+    #: parameters. Each value is a tuple of (version, (xi, yi)) where version
+    #: is used to check whether the nodes have changed since the interpolation
+    #: was calculated.
+    interpolation_cache = Dict()
+
     def __init__(self, x=None, y=None, origin=0, exclude=None):
         self.x = [] if x is None else x
         self.y = [] if y is None else y
         self.origin = origin
         self.exclude = [] if exclude is None else exclude
 
+    def _observe_updated(self, event):
+        self.version += 1
+
     def expand_nodes(self, distance):
         '''
         Expand the spiral outward by the given distance
@@ -91,6 +108,15 @@ class Points(Atom):
         return util.arc_direction(x, y)
 
     def interpolate(self, degree=3, smoothing=0, resolution=0.001):
+        key = degree, smoothing, resolution
+        cached_version, result = self.interpolation_cache.get(key, (None, None))
+        if cached_version != self.version:
+            result = self._interpolate(degree, smoothing, resolution)
+            self.interpolation_cache[key] = self.version, result
+        # Return copies so that the caller cannot modify the cached values.
+        return tuple(np.copy(v) if isinstance(v, np.ndarray) else list(v) for v in result)
+
+    def _interpolate(self, degree, smoothing, resolution):
         nodes = self.get_nodes()
         if len(nodes[0]) <= 3:
             return [], []
@@ -143,8 +169,10 @@ class Points(Atom):
         if not self.has_node(x, y, hit_threshold):
             self.x.append(x)
             self.y.append(y)
-            self.update_exclude()
+            # Notify before updating the exclusion regions since they are
+            # snapped to the new interpolation of the spline.
             self.updated = True
+            self.update_exclude()
 
     def has_node(self, x, y, hit_threshold):
         try:
@@ -171,8 +199,8 @@ class Points(Atom):
         if coords in self.labels:
             labels = self.labels.pop(coords)
             log.info('Removing label for node %d. Coords are %r. Labels were %r.', i, coords, labels)
-        self.update_exclude()
         self.updated = True
+        self.update_exclude()
 
     def label_node(self, x, y, label, toggle, hit_threshold=25):
         i = self.find_node(x, y, hit_threshold)
@@ -187,8 +215,8 @@ class Points(Atom):
 
     def set_origin(self, x, y, hit_threshold=25):
         self.origin = int(self.find_node(x, y, hit_threshold))
-        self.update_exclude()
         self.updated = True
+        self.update_exclude()
 
     def nearest_point(self, x, y):
         xi, yi = self.interpolate()
@@ -269,10 +297,135 @@ class Points(Atom):
         self.updated = True
 
 
+class Puncta(Atom):
+    '''
+    Synaptic puncta detected in a single channel
+
+    Coordinates are in microns. `cell` is the index of the cell (in the order
+    stored by the corresponding `Points` instance) each punctum has been
+    assigned to, or -1 if it could not be assigned to a cell.
+    '''
+
+    x = List()
+    y = List()
+    z = List()
+    intensity = List()
+    cell = List()
+
+    updated = Event()
+
+    #: Incremented whenever the puncta change (i.e., on every `updated` event)
+    version = Int()
+
+    def _observe_updated(self, event):
+        self.version += 1
+
+    def set_puncta(self, x, y, z, intensity):
+        self.x = np.asarray(x, dtype=float).tolist()
+        self.y = np.asarray(y, dtype=float).tolist()
+        self.z = np.asarray(z, dtype=float).tolist()
+        self.intensity = np.asarray(intensity, dtype=float).tolist()
+        self.cell = [-1] * len(self.x)
+        self.updated = True
+
+    def assign(self, points, max_distance):
+        self.cell = util.assign_nearest(self.x, self.y, points.x, points.y,
+                                        max_distance).tolist()
+        self.updated = True
+
+    def counts(self, n_cells):
+        '''
+        Number of puncta assigned to each cell.
+        '''
+        cell = np.asarray(self.cell, dtype='i')
+        return np.bincount(cell[cell >= 0], minlength=n_cells)
+
+    def n(self):
+        return len(self.x)
+
+    def clear(self):
+        self.set_puncta([], [], [], [])
+
+    def get_state(self):
+        return {
+            "x": self.x,
+            "y": self.y,
+            "z": self.z,
+            "intensity": self.intensity,
+            "cell": self.cell,
+        }
+
+    def set_state(self, state):
+        self.x = list(state["x"])
+        self.y = list(state["y"])
+        self.z = list(state["z"])
+        self.intensity = list(state.get("intensity", [np.nan] * len(self.x)))
+        self.cell = list(state.get("cell", [-1] * len(self.x)))
+        self.updated = True
+
+
+class AlignmentImage(Atom):
+    '''
+    Grayscale image of a tile, rotated to match the orientation of the tile,
+    along with the intermediate results needed for alignment.
+    '''
+
+    image = Typed(np.ndarray)
+
+    #: Pixels brighter than the 95th percentile (computed on demand)
+    mask = Property(cached=True)
+
+    #: Downsampled regions of the image and their Fourier transforms keyed by
+    #: region and downsampling factor (see `util.coarse_spectrum`). Pairs of
+    #: tiles are registered in parallel, so a thread-safe cache is used.
+    spectra = Typed(util.LRUCache, args=(16,))
+
+    def _get_mask(self):
+        return self.image > np.percentile(self.image, 95)
+
+    def get_spectrum(self, lb, n, factor):
+        key = tuple(lb), tuple(n), factor
+        result = self.spectra.get(key)
+        if result is None:
+            result = util.coarse_spectrum(self.image, lb, n, factor)
+            self.spectra.set(key, result)
+        return result
+
+
 class Tile(NDImage):
 
     source = Str()
 
+    #: Cache of images prepared for alignment keyed by channels and rotation.
+    #: Cleared whenever the image changes.
+    alignment_cache = Dict()
+
+    #: Image pyramid. Each level is downsampled by a factor of two in XY
+    #: relative to the previous level (level 0 is the image itself). Levels
+    #: are built as needed and cleared whenever the image changes.
+    pyramid = List()
+
+    #: Number of levels (excluding level 0) in the pyramid. Downsampling stops
+    #: once the image is smaller than 128 pixels along X or Y.
+    pyramid_levels = Property(cached=True)
+
+    #: Value used to normalize each channel keyed by percentile. This is
+    #: computed from the full-resolution image so the normalization is the
+    #: same for all levels of the pyramid.
+    image_norm = Dict()
+
+    #: Incremented whenever the extent changes. Used for cheap detection of
+    #: unsaved changes.
+    extent_version = Int()
+
+    #: If the tile was cropped from a larger stack (see `crop`), the region
+    #: (xlb, xub, ylb, yub) of the stack in pixels covered by the tile.
+    crop_region = Value()
+
+    #: If the tile was cropped from a larger stack, the XY shape of the stack
+    #: in pixels.
+    crop_shape = Value()
+
     def _default_channel_defaults(self):
         return CHANNEL_CONFIG
 
@@ -280,11 +433,323 @@ class Tile(NDImage):
         super().__init__(info, image)
         self.source = source
 
+    def is_cropped(self):
+        return self.crop_region is not None
+
+    def get_uncropped_extent(self):
+        '''
+        Return extent of the stack the tile was cropped from
+
+        The extent follows the tile (e.g., if the tile is moved during
+        alignment). If the tile was not cropped, this is the extent of the
+        tile.
+        '''
+        if not self.is_cropped():
+            return list(self.extent)
+        xlb, _, ylb, _ = self.crop_region
+        nx, ny = self.crop_shape
+        xv, yv = self.info['voxel_size'][:2]
+        x0 = self.extent[0] - xlb * xv
+        y0 = self.extent[2] - ylb * yv
+        return [x0, x0 + nx * xv, y0, y0 + ny * yv] + list(self.extent[4:])
+
+    def get_image_center(self, axis='z', norm=False):
+        # Cropped tiles are rotated about the center of the original stack so
+        # that they line up exactly with the uncropped tile.
+        if self.is_cropped():
+            extent = self.get_uncropped_extent()
+            return tuple(np.array(extent[:4]).reshape((2, 2)).mean(axis=1))
+        return super().get_image_center(axis, norm)
+
+    def get_state(self):
+        # The extent of the stack is saved so that the analysis can be loaded
+        # whether or not the tile is cropped.
+        return {'extent': self.get_uncropped_extent()}
+
+    def set_state(self, state):
+        if not self.is_cropped():
+            return super().set_state(state)
+        xlb, xub, ylb, yub = self.crop_region
+        xv, yv = self.info['voxel_size'][:2]
+        e = state['extent']
+        self.extent = [e[0] + xlb * xv, e[0] + xub * xv,
+                       e[2] + ylb * yv, e[2] + yub * yv] + list(e[4:])
+
+    def crop(self, region, image, info=None):
+        '''
+        Return new tile containing only a region of this tile
+
+        The new tile is positioned (and rotated) so that it lines up exactly
+        with this tile. The state of the new tile (see `get_state`) is that of
+        this tile so that the analysis can be saved from and loaded into
+        cropped tiles.
+
+        Parameters
+        ----------
+        region : tuple of int
+            Region (xlb, xub, ylb, yub) of the tile in pixels.
+        image : array
+            Pixel data for the region (e.g., as returned by
+            `CochleaReader.load_stack_region`).
+        info : {None, dict}
+            Info for the pixel data (e.g., if only some of the channels were
+            loaded). If None, the info of this tile is used.
+        '''
+        if self.is_cropped():
+            raise ValueError('Tile has already been cropped')
+        xlb, xub, ylb, yub = region
+        info = dict(self.info if info is None else info)
+        xv, yv = self.info['voxel_size'][:2]
+        info['voxel_size'] = self.info['voxel_size']
+        info['lower'] = [
+            self.extent[0] + xlb * xv,
+            self.extent[2] + ylb * yv,
+            self.extent[4],
+        ]
+        info['rotation'] = self.get_rotation()
+        tile = Tile(info, image, self.source)
+        tile.crop_region = tuple(region)
+        tile.crop_shape = tuple(self.image.shape[:2])
+        return tile
+
+    def _observe_extent(self, event):
+        self.extent_version += 1
+
+    def _observe_image(self, event):
+        self.alignment_cache = {}
+        self.pyramid = []
+        self.image_norm = {}
+        self.get_member('pyramid_levels').reset(self)
+
+    def is_evicted(self):
+        '''
+        True if the pixel data has been moved out of memory (see
+        `evict_image`)
+        '''
+        return isinstance(self.image, np.memmap)
+
+    def evict_image(self, filename):
+        '''
+        Move pixel data out of memory
+
+        The image is saved to filename and replaced by a read-only memory map
+        of the file, so the tile remains usable (albeit slower) until
+        `restore_image` is called. Data derived from the image (e.g., the
+        pyramid and alignment images) is discarded.
+        '''
+        if self.is_evicted():
+            return
+        np.save(filename, self.image)
+        # The normalization is the same since the pixel data is unchanged.
+        image_norm = self.image_norm
+        self.image = np.load(filename, mmap_mode='r')
+        self.image_norm = image_norm
+
+    def restore_image(self):
+        '''
+        Load pixel data moved out of memory by `evict_image`
+        '''
+        if not self.is_evicted():
+            return
+        filename = self.image.filename
+        image_norm = self.image_norm
+        self.image = np.array(self.image)
+        self.image_norm = image_norm
+        # The file may still be mapped on Windows if the memory map has not
+        # been garbage-collected. It is then removed along with the temporary
+        # directory when the program exits.
+        try:
+            Path(filename).unlink()
+        except OSError as e:
+            log.debug('Could not remove %s: %s', filename, e)
+
+    def get_memory_usage(self):
+        '''
+        Return number of bytes of pixel data (including derived images) held
+        in memory
+        '''
+        if self.is_evicted() or util.is_placeholder(self.image):
+            n = 0
+        else:
+            n = self.image.nbytes
+        n += sum(level.nbytes for level in self.pyramid[1:])
+        n += sum(a.image.nbytes for a in self.alignment_cache.values())
+        return n
+
+    def _get_pyramid_levels(self):
+        n = min(self.image.shape[:2])
+        return int(max(0, np.floor(np.log2(n / 128))))
+
+    def get_pyramid_level(self, level):
+        '''
+        Return image downsampled by a factor of 2 ** level in XY
+        '''
+        if not (0 <= level <= self.pyramid_levels):
+            raise ValueError(f'Pyramid level {level} does not exist')
+        if not self.pyramid:
+            self.pyramid.append(self.image)
+        while len(self.pyramid) <= level:
+            self.pyramid.append(util.halve_xy(self.pyramid[-1]))
+        return self.pyramid[level]
+
+    def get_pyramid_extent(self, level):
+        '''
+        Return XY extent of the image at the requested level of the pyramid
+
+        This can be slightly larger than the extent of the tile since the
+        image is padded as needed before downsampling.
+        '''
+        nx, ny = self.get_pyramid_level(level).shape[:2]
+        xlb, ylb = self.extent[0], self.extent[2]
+        scale = 2 ** level
+        return (
+            xlb, xlb + nx * scale * self.get_voxel_size('x'),
+            ylb, ylb + ny * scale * self.get_voxel_size('y'),
+        )
+
+    def get_image_norm(self, norm_percentile=99):
+        if norm_percentile not in self.image_norm:
+            projection = self.image.max(axis=2)
+            self.image_norm[norm_percentile] = \
+                np.percentile(projection, norm_percentile, axis=(0, 1))
+        return self.image_norm[norm_percentile]
+
+    def get_image(self, channels=None, z_slice=None, axis='z',
+                  norm_percentile=99, level=0, region=None, source=None):
+        '''
+        Return RGB image of the requested channels
+
+        Parameters
+        ----------
+        channels : {None, str, list}
+            Channels to include. If None, all channels are included.
+        z_slice : {None, int, slice}
+            Z-slice (or range of z-slices) to project. If None, the entire
+            stack is projected.
+        axis : {'x', 'y', 'z'}
+            Axis to project along.
+        norm_percentile : float
+            Percentile of the projected image used to normalize each channel.
+        level : int
+            Level of the image pyramid to use. Only supported for projections
+            along Z.
+        region : {None, tuple}
+            Region (xlb, xub, ylb, yub) of the image to return in pixels
+            (relative to the requested pyramid level). If None, the full image
+            is returned. Only supported for projections along Z.
+        source : {None, array}
+            Image at the requested level of the pyramid (see
+            `get_pyramid_level`). Provide this when calling from a background
+            thread so that the pyramid is not built there. Only supported for
+            projections along Z.
+        '''
+        if axis != 'z':
+            if level != 0 or region is not None or source is not None:
+                raise ValueError('Pyramid levels and regions only supported for z-axis')
+            return super().get_image(channels, z_slice, axis, norm_percentile)
+        image = self.get_pyramid_level(level) if source is None else source
+        if region is not None:
+            xlb, xub, ylb, yub = region
+            image = image[xlb:xub, ylb:yub]
+        if z_slice is not None:
+            image = image[:, :, z_slice]
+        if image.ndim == 4:
+            image = image.max(axis=2)
+        norm = self.get_image_norm(norm_percentile)
+        image = np.divide(image, norm, out=np.zeros(image.shape),
+                          where=norm != 0).clip(0, 1)
+        return color_image(image, self.get_channel_config(channels))
+
+    def get_alignment_image(self, channels, rotate_first=False):
+        '''
+        Return grayscale image of the channels rotated to match the tile
+        orientation
+
+        The result is cached until the image changes, so repeated alignment
+        runs (e.g., after nudging one tile) only need to prepare the tiles
+        once.
+
+        Parameters
+        ----------
+        channels : {str, list}
+            Channels to include.
+        rotate_first : bool
+            If True, rotate the RGB image before converting to grayscale (as
+            done by the full alignment mode). Otherwise, convert to grayscale
+            first since rotation is the most expensive step and only needs to
+            be done for one channel.
+        '''
+        rotation = self.get_rotation()
+        key = channels if isinstance(channels, str) else tuple(channels)
+        key = key, rotation, rotate_first
+        if key not in self.alignment_cache:
+            if rotate_first:
+                image = rgb2gray(ndimage.rotate(self.get_image(channels), rotation))
+            else:
+                image = rgb2gray(self.get_image(channels))
+                if rotation != 0:
+                    image = ndimage.rotate(image, rotation)
+            self.alignment_cache[key] = AlignmentImage(image=image)
+        return self.alignment_cache[key]
+
+
+class TileIndex(Atom):
+    '''
+    Array of tile extents for fast hit-testing and intersection tests
+
+    The index is updated whenever the extent of a tile changes.
+    '''
+
+    tiles = List()
+
+    #: Array of (xlb, xub, ylb, yub) for each tile
+    extents = Typed(np.ndarray)
+
+    #: Array of (xlb, xub, ylb, yub) of the bounding box of each tile after
+    #: rotation
+    rotated_extents = Typed(np.ndarray)
+
+    def __init__(self, tiles):
+        super().__init__(tiles=list(tiles))
+        n = len(self.tiles)
+        self.extents = np.zeros((n, 4))
+        self.rotated_extents = np.zeros((n, 4))
+        for i, tile in enumerate(self.tiles):
+            self._update(i)
+            tile.observe('extent', self.update)
+
+    def _update(self, i):
+        self.extents[i] = self.tiles[i].extent[:4]
+        self.rotated_extents[i] = self.tiles[i].get_rotated_extent()[:4]
+
+    def update(self, event):
+        for i, tile in enumerate(self.tiles):
+            if tile is event['object']:
+                self._update(i)
+
+    def contains(self, x, y):
+        '''
+        Return indices of tiles whose (unrotated) extent contains the point
+        '''
+        e = self.extents
+        mask = (e[:, 0] <= x) & (x <= e[:, 1]) & (e[:, 2] <= y) & (y <= e[:, 3])
+        return np.flatnonzero(mask)
+
+    def intersects(self, region):
+        '''
+        Return mask indicating which tiles (after rotation) intersect the
+        region (xlb, xub, ylb, yub)
+        '''
+        xlb, xub, ylb, yub = region
+        e = self.rotated_extents
+        return (e[:, 0] <= xub) & (e[:, 1] >= xlb) & (e[:, 2] <= yub) & (e[:, 3] >= ylb)
+
 
 class CellAnalysis(NDImageCollection):
 
     spirals = Dict()
     cells = Dict()
+    puncta = Dict()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -296,6 +761,17 @@ class CellAnalysis(NDImageCollection):
         # We assume that each tile has the same set of channels
         return self.tiles[0].channel_names
 
+    def default_guess_channel(self, cell_type):
+        '''
+        Return a reasonable default channel for guessing the cells
+        '''
+        if cell_type == 'IHC' and 'CtBP2' in self.channel_names:
+            return 'CtBP2'
+        elif 'MyosinVIIa' in self.channel_names:
+            return 'MyosinVIIa'
+        else:
+            return self.channel_names[0]
+
     def guess_cells(self, cell_type, width, spacing, channel, z_slice):
         tile = self.merge_tiles()
         x, y = util.guess_cells(tile, self.spirals[cell_type], width, spacing,
@@ -303,16 +779,126 @@ class CellAnalysis(NDImageCollection):
         self.cells[cell_type].set_nodes(x, y)
         return len(x)
 
+    def find_puncta(self, channel='CtBP2', width=10, radius=0.5, sigma=0.25,
+                    threshold=0.25, cell_type='IHC', max_distance=10,
+                    chunk_size=(256, 256, 32)):
+        '''
+        Find synaptic puncta within a band around the spiral
+
+        Puncta are identified as 3D local maxima in the channel. Only the
+        portion of each tile within `width` microns of the spiral is searched
+        and each tile is processed in overlapping chunks to keep memory
+        bounded. Puncta are then assigned to the nearest cell.
+
+        Parameters
+        ----------
+        channel : str
+            Name of channel to search (e.g., CtBP2 or GluR2).
+        width : float
+            Search within this distance (in microns) of the spiral.
+        radius : float
+            Minimum separation (in microns) of puncta.
+        sigma : float
+            Standard deviation (in microns) of the Gaussian used to smooth
+            the image before searching for puncta.
+        threshold : float
+            Minimum intensity of puncta as a fraction of the maximum intensity
+            of the channel.
+        cell_type : str
+            Spiral to search along and cells to assign puncta to.
+        max_distance : float
+            Puncta further than this distance (in microns) from the nearest
+            cell are not assigned to a cell.
+        chunk_size : tuple of int
+            Size (in voxels) of the XYZ chunks the image is processed in.
+
+        Returns
+        -------
+        n : int
+            Number of puncta found.
+        '''
+        xs, ys = self.spirals[cell_type].interpolate(resolution=0.001)
+        if len(xs) == 0:
+            raise ValueError(f'Please create the {cell_type} spiral first.')
+        spiral = np.c_[xs, ys]
+
+        points, intensity = [np.zeros((0, 3))], [np.zeros(0)]
+        for tile in self.tiles:
+            if channel not in tile.channel_names:
+                raise ValueError(f'Channel {channel} not found in tile {tile.source} '
+                                 f'(available channels are {", ".join(tile.channel_names)})')
+            ci = tile.channel_names.index(channel)
+            image = tile.image[..., ci]
+            image_max = image.max()
+            # No puncta can be found in a channel that has no signal.
+            if image_max == 0:
+                continue
+            voxel_size = np.array(tile.info['voxel_size'])
+            lower = np.array(tile.extent[::2])
+            t = tile.get_image_transform()
+            bounds = util.get_band_bounds(tile, spiral, width)
+            spiral_voxels = util.get_voxel_coords(tile, spiral)
+
+            footprint = 2 * np.round(radius / voxel_size).astype('i') + 1
+            indices, v = util.find_puncta(image, footprint, sigma / voxel_size,
+                                          threshold * image_max, bounds,
+                                          chunk_size, spiral_voxels,
+                                          width / voxel_size[:2].min())
+
+            coords = indices * voxel_size + lower
+            coords[:, :2] = t.transform(coords[:, :2])
+            points.append(coords)
+            intensity.append(v / image_max)
+
+        points = np.concatenate(points)
+        intensity = np.concatenate(intensity)
+
+        # Discard puncta that fall outside the band.
+        d, _ = cKDTree(spiral).query(points[:, :2], distance_upper_bound=width)
+        m = np.isfinite(d)
+        points, intensity = points[m], intensity[m]
+
+        # Puncta in regions where tiles overlap may be detected more than once.
+        if len(self.tiles) > 1:
+            m = util.suppress_duplicates(points, intensity, radius)
+            points, intensity = points[m], intensity[m]
+
+        puncta = self.puncta.setdefault(channel, Puncta())
+        puncta.set_puncta(*points.T, intensity)
+        puncta.assign(self.cells[cell_type], max_distance)
+        return puncta.n()
+
+    def assign_puncta(self, channel='CtBP2', cell_type='IHC', max_distance=10):
+        '''
+        Reassign puncta to the nearest cell (e.g., after editing the cells).
+        '''
+        self.puncta[channel].assign(self.cells[cell_type], max_distance)
+
     def clear_cells(self, cell_type):
         self.cells[cell_type].clear()
 
     def clear_spiral(self, cell_type):
         self.spirals[cell_type].clear()
 
+    def get_version(self):
+        '''
+        Return key that changes whenever the state (as returned by
+        `get_state`) changes
+
+        This is much cheaper than comparing the state since only the version
+        counter of each object is checked.
+        '''
+        return (
+            tuple(v.version for v in self.spirals.values()),
+            tuple(v.version for v in self.cells.values()),
+            tuple((k, v.version) for k, v in self.puncta.items()),
+        )
+
     def get_state(self):
         return {
             'spirals': {k: v.get_state() for k, v in self.spirals.items()},
             'cells': {k: v.get_state() for k, v in self.cells.items()},
+            'puncta': {k: v.get_state() for k, v in self.puncta.items()},
         }
 
     def set_state(self, state):
@@ -320,6 +906,8 @@ class CellAnalysis(NDImageCollection):
             v.set_state(state['spirals'][k])
         for k, v in self.cells.items():
             v.set_state(state['cells'][k])
+        for k, v in state.get('puncta', {}).items():
+            self.puncta.setdefault(k, Puncta()).set_state(v)
 
 
 class Piece(CellAnalysis):
@@ -328,6 +916,11 @@ class Piece(CellAnalysis):
     copied_from = Str()
     region = Value()
 
+    #: Saved state of tiles that were not loaded (e.g., tiles that do not
+    #: overlap the band loaded by `CochleaReader.load_band`). These are saved
+    #: unchanged so that the analysis can still be loaded with all tiles.
+    omitted_tiles = Dict()
+
     def __init__(self, tiles, piece, copied_from=None, region=None):
         super().__init__(tiles=tiles)
         self.piece = piece
@@ -338,7 +931,33 @@ class Piece(CellAnalysis):
     def is_copy(self):
         return bool(self.copied_from)
 
-    def align_tiles(self, alignment_channel='MyosinVIIa'):
+    def align_tiles(self, alignment_channel='MyosinVIIa', mode='full',
+                    min_confidence=0.2, n_jobs=None):
+        '''
+        Align tiles based on correlation between the images
+
+        Parameters
+        ----------
+        alignment_channel : {str, list of str}
+            Channel(s) used for alignment.
+        mode : {'full', 'overlap', 'global'}
+            If 'full', the entire images of each pair of tiles are
+            correlated. If 'overlap', only the region where the tiles are
+            predicted to overlap (based on their current extents) is
+            correlated using a coarse-to-fine search. This is much faster
+            and less likely to lock onto the wrong peak, but requires the
+            tiles to already be roughly aligned (e.g., using the stage
+            coordinates). If 'global', the offset between every pair of
+            overlapping tiles is estimated (as in 'overlap') and the
+            positions of all tiles are then solved for at once so that errors
+            do not accumulate along the piece.
+        min_confidence : float
+            Only used by 'global' mode. Pairs of tiles whose correlation
+            after alignment is less than this value are ignored.
+        n_jobs : {None, int}
+            Only used by 'global' mode. Number of threads used to estimate
+            the pairwise offsets. If None, use one thread per core.
+        '''
         # First, figure out the order in which we should work on the alignment.
         # Let's keep it basic by just sorting by lower left corner of the xy
         # coordinate.
@@ -347,34 +966,129 @@ class Piece(CellAnalysis):
         corners = [tuple(t.get_rotated_extent()[::2][:2]) for t in self.tiles]
         order = sorted(range(len(corners)), key=lambda x: corners[x])
 
+        if mode == 'full':
+            self._align_tiles_full(alignment_channel, order)
+        elif mode == 'overlap':
+            self._align_tiles_overlap(alignment_channel, order)
+        elif mode == 'global':
+            self._align_tiles_global(alignment_channel, order, min_confidence, n_jobs)
+        else:
+            raise ValueError(f'Unsupported alignment mode {mode}')
+
+    def _align_tiles_global(self, alignment_channel, order, min_confidence, n_jobs):
+        n = len(self.tiles)
+        voxel_size = np.array(self.tiles[0].info['voxel_size'][:2])
+        with ThreadPoolExecutor(n_jobs) as executor:
+            images = list(executor.map(lambda t: t.get_alignment_image(alignment_channel), self.tiles))
+            origins = np.array([t.get_rotated_extent()[:4:2] for t in self.tiles])
+
+            pairs = []
+            for i in range(n):
+                for j in range(i + 1, n):
+                    overlap = util.get_overlap(origins[i], images[i].image.shape,
+                                               origins[j], images[j].image.shape,
+                                               voxel_size)
+                    if overlap is not None:
+                        pairs.append((i, j))
+
+            def register(pair):
+                i, j = pair
+                return util.register_overlap(images[i].image, origins[i],
+                                             images[j].image, origins[j],
+                                             voxel_size,
+                                             ref_spectrum=images[i].get_spectrum,
+                                             mov_spectrum=images[j].get_spectrum)
+            results = list(executor.map(register, pairs))
+
+        constraints = []
+        for (i, j), result in zip(pairs, results):
+            if result is None:
+                continue
+            new_origin, confidence = result
+            if confidence < min_confidence:
+                log.info('Ignoring alignment of %s to %s (correlation %.2f)',
+                         self.tiles[j].source, self.tiles[i].source, confidence)
+                continue
+            constraints.append((i, j, new_origin - origins[i], confidence))
+
+        positions = util.solve_tile_positions(origins, constraints, anchor=order[0])
+        for tile, origin, position in zip(self.tiles, origins, positions):
+            dx, dy = position - origin
+            extent = np.array(tile.extent)
+            extent[0:2] += dx
+            extent[2:4] += dy
+            tile.extent = extent.tolist()
+
+    def _align_tiles_overlap(self, alignment_channel, order):
+        images = {i: self.tiles[i].get_alignment_image(alignment_channel) for i in order}
+
+        aligned = [order[0]]
+        for i in order[1:]:
+            tile = self.tiles[i]
+            voxel_size = np.array(tile.info['voxel_size'][:2])
+            origin = np.array(tile.get_rotated_extent()[:4:2])
+
+            # Align to the already-aligned tile that overlaps the most.
+            best, best_n = None, 0
+            for j in aligned:
+                ref_origin = np.array(self.tiles[j].get_rotated_extent()[:4:2])
+                overlap = util.get_overlap(ref_origin, images[j].image.shape,
+                                           origin, images[i].image.shape,
+                                           voxel_size)
+                if overlap is not None and np.prod(overlap[2]) > best_n:
+                    best, best_n = j, np.prod(overlap[2])
+            aligned.append(i)
+            if best is None:
+                log.info('Tile %s does not overlap any other tile', tile.source)
+                continue
+
+            ref_origin = np.array(self.tiles[best].get_rotated_extent()[:4:2])
+            result = util.register_overlap(images[best].image, ref_origin,
+                                           images[i].image, origin, voxel_size,
+                                           ref_spectrum=images[best].get_spectrum,
+                                           mov_spectrum=images[i].get_spectrum)
+            if result is None:
+                log.info('Overlap of tile %s is too small to align', tile.source)
+                continue
+            new_origin, confidence = result
+            log.info('Aligned tile %s to %s (correlation %.2f)', tile.source,
+                     self.tiles[best].source, confidence)
+            dx, dy = new_origin - origin
+            extent = np.array(tile.extent)
+            extent[0:2] += dx
+            extent[2:4] += dy
+            tile.extent = extent.tolist()
+
+    def _align_tiles_full(self, alignment_channel, order):
         base_tile = self.tiles[order[0]]
-        base_img = ndimage.rotate(base_tile.get_image(alignment_channel), base_tile.get_rotation())
-        base_img = rgb2gray(base_img)
-        base_mask = base_img > np.percentile(base_img, 95)
+        base = base_tile.get_alignment_image(alignment_channel, rotate_first=True)
 
         x_um_per_px, y_um_per_px = base_tile.info['voxel_size'][:2]
 
         for i in order[1:]:
             tile = self.tiles[i]
-            img = ndimage.rotate(tile.get_image(alignment_channel), tile.get_rotation())
-            img = rgb2gray(img)
-            mask = img > np.percentile(img, 95)
-            result = phase_cross_correlation(base_img, img,
-                                             reference_mask=base_mask,
-                                             moving_mask=mask)
+            moving = tile.get_alignment_image(alignment_channel, rotate_first=True)
+            result = phase_cross_correlation(base.image, moving.image,
+                                             reference_mask=base.mask,
+                                             moving_mask=moving.mask)
             x_shift, y_shift = result[0]
             extent = np.array(base_tile.extent[:])
             extent[0:2] += x_shift * x_um_per_px
             extent[2:4] += y_shift * y_um_per_px
             tile.extent = extent.tolist()
             base_tile = tile
-            base_img = img
-            base_mask = mask
+            base = moving
+
+    def get_version(self):
+        tiles = tuple(t.extent_version for t in self.tiles)
+        return super().get_version() + (tiles,)
 
     def get_state(self):
         state = super().get_state()
+        tiles = dict(self.omitted_tiles)
+        tiles.update({t.source: t.get_state() for t in self.tiles})
         state.update({
-            'tiles': {t.source: t.get_state() for t in self.tiles},
+            'tiles': tiles,
             'copied_from': self.copied_from,
         })
         return state
@@ -384,6 +1098,9 @@ class Piece(CellAnalysis):
         if 'tiles' in state:
             for tile in self.tiles:
                 tile.set_state(state['tiles'][tile.source])
+            loaded = {t.source for t in self.tiles}
+            self.omitted_tiles = {k: v for k, v in state['tiles'].items()
+                                  if k not in loaded}
 
 
 # Recieves normalized distance along the cochlear partition from the base as a
@@ -396,10 +1113,114 @@ freq_fn = {
 }
 
 
+class SpiralDistance:
+    '''
+    Distance along the spirals of a cochlea with the pieces joined end to end
+
+    The spiral of each piece is shifted so that it starts where the spiral of
+    the previous piece ends. All values are stored as arrays with one entry
+    per point along the joined spiral (see `Cochlea.get_spiral_distance`).
+    '''
+
+    def __init__(self, pieces, spiral='IHC'):
+        self.spiral = spiral
+        self.points = {}
+        self.bounds = {}
+
+        xs, ys, piece_ids, i = [], [], [], []
+        n = 0
+        for piece in pieces:
+            s = piece.spirals[spiral]
+            x, y = s.interpolate(resolution=0.001)
+            if len(x) == 0:
+                raise ValueError(f'Please check the {spiral} spiral on piece {piece.piece} and try again.')
+            self.points[piece.piece] = s
+            self.bounds[piece.piece] = slice(n, n + len(x))
+            n += len(x)
+            xs.append(x)
+            ys.append(y)
+            piece_ids.append(np.full(len(x), piece.piece))
+            i.append(np.arange(len(x)) / len(x))
+
+        self.x_orig = np.concatenate(xs)
+        self.y_orig = np.concatenate(ys)
+        self.piece = np.concatenate(piece_ids)
+        self.i = np.concatenate(i)
+
+        # Shift each piece so it starts where the previous piece ends.
+        self.x = self.x_orig.copy()
+        self.y = self.y_orig.copy()
+        xo, yo = 0, 0
+        for b in self.bounds.values():
+            self.x[b] -= self.x_orig[b.start] - xo
+            self.y[b] -= self.y_orig[b.start] - yo
+            xo, yo = self.x[b.stop - 1], self.y[b.stop - 1]
+
+        d = np.sqrt(np.diff(self.x) ** 2 + np.diff(self.y) ** 2)
+        self.distance_mm = np.r_[0, np.cumsum(d)] * 1e-3
+        self.distance_norm = self.distance_mm / self.distance_mm[-1]
+
+        # Direction of each spiral (see `get_direction`).
+        self.direction = {}
+
+    def __len__(self):
+        return len(self.distance_mm)
+
+    def get_direction(self, piece):
+        '''
+        Return direction of the spiral of the piece (see `util.arc_direction`)
+
+        Calculated on demand since finding the origin of the arc is slow.
+        '''
+        if piece not in self.direction:
+            self.direction[piece] = self.points[piece].direction()
+        return self.direction[piece]
+
+    def get_frequency(self, species='mouse'):
+        return freq_fn[species](self.distance_norm)
+
+    def get_point(self, index, species='mouse'):
+        '''
+        Return information about the point at index as a dictionary
+        '''
+        piece = int(self.piece[index])
+        return {
+            'piece': piece,
+            'i': float(self.i[index]),
+            'direction': float(self.get_direction(piece)),
+            'x': float(self.x[index]),
+            'y': float(self.y[index]),
+            'x_orig': float(self.x_orig[index]),
+            'y_orig': float(self.y_orig[index]),
+            'distance_mm': float(self.distance_mm[index]),
+            'distance_norm': float(self.distance_norm[index]),
+            'frequency': float(freq_fn[species](self.distance_norm[index])),
+        }
+
+    def to_dataframe(self, species='mouse'):
+        direction = np.empty(len(self))
+        for piece, b in self.bounds.items():
+            direction[b] = self.get_direction(piece)
+        return pd.DataFrame({
+            'piece': self.piece,
+            'i': self.i,
+            'direction': direction,
+            'x': self.x,
+            'y': self.y,
+            'x_orig': self.x_orig,
+            'y_orig': self.y_orig,
+            'distance_mm': self.distance_mm,
+            'distance_norm': self.distance_norm,
+            'frequency': self.get_frequency(species),
+        })
+
+
 class Cochlea:
 
     def __init__(self, pieces):
         self.pieces = pieces
+        #: Cached `SpiralDistance` for each spiral (see `get_spiral_distance`)
+        self.distance_cache = {}
         self.pieces[0].region = 'hook'
         self.pieces[-1].region = 'apex'
 
@@ -439,38 +1260,31 @@ class Cochlea:
                 return False
         return True
 
+    def get_spiral_distance(self, spiral='IHC'):
+        '''
+        Return distance along the spiral with the pieces joined end to end
+
+        The result is cached until the spiral of any of the pieces changes.
+
+        Parameters
+        ----------
+        spiral : str
+            Spiral to calculate the distance along.
+
+        Returns
+        -------
+        distance : SpiralDistance
+        '''
+        points = [piece.spirals[spiral] for piece in self.pieces]
+        key = tuple((id(p), p.version) for p in points)
+        cached_key, result = self.distance_cache.get(spiral, (None, None))
+        if cached_key != key:
+            result = SpiralDistance(self.pieces, spiral)
+            self.distance_cache[spiral] = key, result
+        return result
+
     def calculate_distance(self, species='mouse', spiral='IHC'):
-        # First, we need to merge the spirals
-        xo, yo = 0, 0
-        results = []
-        for piece in self.pieces:
-            s = piece.spirals[spiral]
-            x, y = s.interpolate(resolution=0.001)
-            if len(x) == 0:
-                raise ValueError(f'Please check the {spiral} spiral on piece {piece.piece} and try again.')
-            x_norm = x - (x[0] - xo)
-            y_norm = y - (y[0] - yo)
-            xo = x_norm[-1]
-            yo = y_norm[-1]
-            i = np.arange(len(x)) / len(x)
-            result = pd.DataFrame({
-                'direction': s.direction(),
-                'i': i,
-                'x': x_norm,
-                'y': y_norm,
-                'x_orig': x,
-                'y_orig': y,
-                'piece': piece.piece,
-            }).set_index(['piece', 'i'])
-            results.append(result)
-        results = pd.concat(results).reset_index()
-
-        # Now we can do some distance calculations
-        results['distance_mm'] = np.sqrt(results['x'].diff() ** 2 + results['y'].diff() ** 2).cumsum() * 1e-3
-        results['distance_mm'] = results['distance_mm'].fillna(0)
-        results['distance_norm'] = results['distance_mm'] / results['distance_mm'].max()
-        results['frequency'] = freq_fn[species](results['distance_norm'])
-        return results
+        return self.get_spiral_distance(spiral).to_dataframe(species)
 
     def make_frequency_map(self, freq_start=4, freq_end=64, freq_step=0.5,
                            species='mouse', spiral='IHC',
@@ -478,15 +1292,16 @@ class Cochlea:
         '''
         Return information for generating frequency map
         '''
-        results = self.calculate_distance(species=species, spiral=spiral)
+        distance = self.get_spiral_distance(spiral)
+        frequency = distance.get_frequency(species)
         info = {}
         for freq in octave_space(freq_start, freq_end, freq_step):
-            idx = (results['frequency'] - freq).abs().idxmin()
-            info[freq] = results.loc[idx].to_dict()
+            idx = np.abs(frequency - freq).argmin()
+            info[freq] = distance.get_point(idx, species)
 
         if include_extremes:
-            for ix in (0, -1):
-                row = results.iloc[ix].to_dict()
+            for ix in (0, len(frequency) - 1):
+                row = distance.get_point(ix, species)
                 info[row['frequency']] = row
 
         return info
@@ -1,10 +1,17 @@
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+log = logging.getLogger(__name__)
+
+from pathlib import Path
+import tempfile
 import time
 
 import json
 from atom.api import (
     Atom,
     Bool,
+    Callable,
     Dict,
     Enum,
     Event,
@@ -21,7 +28,7 @@ from atom.api import (
     Value,
 )
 
-from enaml.application import deferred_call
+from enaml.application import deferred_call, timed_call
 
 import matplotlib as mp
 from matplotlib.axes import Axes
@@ -38,12 +45,302 @@ import numpy as np
 from scipy import interpolate
 
 from ndimage_enaml.model import ChannelConfig
-from ndimage_enaml.presenter import NDImageCollectionPresenter, StatePersistenceMixin
+from ndimage_enaml.presenter import (
+    NDImageCollectionPresenter, NDImagePlot, StatePersistenceMixin
+)
 
+from cochleogram.autosave import AutosaveService, copy_state
 from cochleogram.config import CELLS, CELL_COLORS, CELL_KEY_MAP, TOOL_KEY_MAP
-from cochleogram.model import Piece, Points, Tile
+from cochleogram.model import Piece, Points, Tile, TileIndex
 from cochleogram.readers import BaseReader
-from cochleogram.util import get_region, make_plot_path, shortest_path
+from cochleogram.util import (
+    clip_line, clip_points, get_region, LRUCache, make_plot_path, pad_region,
+    region_contains, shortest_path
+)
+
+
+class FrameScheduler(Atom):
+    '''
+    Coalesces redraw requests for a canvas into frames
+
+    Artists mark themselves as dirty rather than redrawing immediately. On
+    each frame, all dirty artists are updated and then the canvas is drawn
+    once. Frames are limited to `max_fps`.
+    '''
+
+    #: Callback that draws the canvas
+    draw = Callable()
+
+    #: Maximum number of frames to draw per second
+    max_fps = Float(30)
+
+    #: Number of frames drawn
+    frames_drawn = Int(0)
+
+    #: Number of artists updated on the most recent frame
+    artists_updated = Int(0)
+
+    #: Number of artists updated across all frames
+    total_artists_updated = Int(0)
+
+    #: Artists that need to be updated on the next frame. A dict is used as an
+    #: ordered set.
+    dirty = Dict()
+
+    #: Does the canvas need to be drawn on the next frame?
+    canvas_dirty = Bool(False)
+
+    #: Has the next frame been scheduled?
+    scheduled = Bool(False)
+
+    #: Are we currently processing a frame?
+    in_frame = Bool(False)
+
+    #: Time the most recent frame was started
+    last_frame = Float(0)
+
+    def mark_dirty(self, artist=None):
+        '''
+        Request that the artist (if provided) be updated and the canvas be
+        drawn on the next frame
+        '''
+        if artist is not None:
+            self.dirty[artist] = None
+        self.canvas_dirty = True
+        # Any requests made while processing the frame are handled on the
+        # same frame.
+        if not self.in_frame:
+            self.schedule()
+
+    def schedule(self):
+        if self.scheduled:
+            return
+        self.scheduled = True
+        delay = self.last_frame + 1 / self.max_fps - time.time()
+        if delay > 0:
+            timed_call(int(np.ceil(delay * 1e3)), self.tick)
+        else:
+            deferred_call(self.tick)
+
+    def tick(self):
+        self.scheduled = False
+        self.last_frame = time.time()
+        self.in_frame = True
+        n = 0
+        try:
+            while self.dirty:
+                artist = next(iter(self.dirty))
+                del self.dirty[artist]
+                artist.needs_redraw = False
+                artist.redraw()
+                n += 1
+            if self.canvas_dirty:
+                self.canvas_dirty = False
+                self.draw()
+                self.frames_drawn += 1
+        finally:
+            self.in_frame = False
+        self.artists_updated = n
+        self.total_artists_updated += n
+        # Drawing the canvas can generate new requests (e.g., the axes limits
+        # may be adjusted to maintain the aspect ratio). Handle these on the
+        # next frame.
+        if self.dirty or self.canvas_dirty:
+            self.schedule()
+
+
+def channel_config_from_key(channels):
+    '''
+    Create the configuration of the visible channels from the channel settings
+    of a render key (see `ImagePlot.get_render_key`)
+    '''
+    return [
+        ChannelConfig(name=name, i=i, min_value=lb, max_value=ub,
+                      display_color=f'#{argb & 0xFFFFFF:06x}')
+        for name, i, lb, ub, argb in channels
+    ]
+
+
+class SlicePrefetcher(Atom):
+    '''
+    Renders the z-slices surrounding the current z-slice of an artist in a
+    background thread
+
+    Slices are rendered into the render cache of the artist using the
+    current channel configuration, pyramid level and region so that scrolling
+    through the stack only needs to swap the image shown by the artist. Any
+    pending work is discarded when the display settings of the artist change.
+    '''
+
+    #: Number of slices on each side of the current slice to render
+    radius = Int(4)
+
+    #: Number of slices rendered in the background
+    slices_rendered = Int(0)
+
+    #: Executor that runs the background thread
+    executor = Value()
+
+    #: Generation of the display settings for each artist. Incremented
+    #: whenever the settings change so that the worker can discard stale
+    #: requests.
+    generations = Dict()
+
+    #: Settings used for the most recent request for each artist
+    settings = Dict()
+
+    #: Pending futures keyed by (artist, render key)
+    futures = Dict()
+
+    #: Has the executor been shut down (see `shutdown`)?
+    stopped = Bool(False)
+
+    def _default_executor(self):
+        return ThreadPoolExecutor(1, thread_name_prefix='slice-prefetch')
+
+    def cancel(self, artist):
+        '''
+        Discard pending requests for the artist
+        '''
+        self.generations[artist] = self.generations.get(artist, 0) + 1
+        self.settings.pop(artist, None)
+        for key in list(self.futures):
+            if key[0] is artist:
+                self.futures.pop(key).cancel()
+
+    def prefetch(self, artist):
+        '''
+        Request that the slices surrounding the current z-slice of the artist
+        be rendered
+        '''
+        if self.stopped:
+            return
+        if artist.display_mode != 'slice' or artist.region is None:
+            self.cancel(artist)
+            return
+        channels, (lb, ub), level, region = artist.get_render_key()
+        settings = channels, ub - lb, level, region
+        if settings != self.settings.get(artist):
+            self.cancel(artist)
+            self.settings[artist] = settings
+
+        # Drop finished requests
+        for key, future in list(self.futures.items()):
+            if future.done():
+                del self.futures[key]
+
+        # Render slices closest to the current slice first. Slices in the
+        # direction of the most recent scroll are preferred.
+        step = 1 if lb >= artist.prefetch_origin else -1
+        artist.prefetch_origin = lb
+        thickness = ub - lb
+        z_max = artist.z_slice_max - thickness
+        generation = self.generations.get(artist, 0)
+
+        # Build the pyramid level and normalization here since they modify the
+        # tile (which must only be done on the GUI thread). The channel
+        # settings are copied from the key so that the images match the key
+        # even if the settings change before they are rendered.
+        source = artist.ndimage.get_pyramid_level(level)
+        artist.ndimage.get_image_norm()
+        channel_config = channel_config_from_key(channels)
+        for distance in range(1, self.radius + 1):
+            for z in (lb + step * distance, lb - step * distance):
+                if not (0 <= z <= z_max):
+                    continue
+                key = channels, (z, z + thickness), level, region
+                if key in artist.render_cache or (artist, key) in self.futures:
+                    continue
+                future = self.executor.submit(self._render, artist, key,
+                                              generation, channel_config,
+                                              source)
+                self.futures[artist, key] = future
+
+    def wait(self, artist, key):
+        '''
+        Wait for the slice to finish rendering if it has already been requested
+        '''
+        future = self.futures.pop((artist, key), None)
+        if future is not None and not future.cancel():
+            future.result()
+
+    def _render(self, artist, key, generation, channel_config, source):
+        if self.generations.get(artist, 0) != generation:
+            return
+        _, (lb, ub), level, region = key
+        image = artist.render_image(np.s_[lb:ub], level, region,
+                                    channel_config, source)
+        if self.generations.get(artist, 0) != generation:
+            return
+        artist.render_cache.set(key, image)
+        self.slices_rendered += 1
+
+    def cancel_all(self):
+        for artist in list(self.settings):
+            self.cancel(artist)
+
+    def shutdown(self):
+        self.stopped = True
+        self.cancel_all()
+        self.executor.shutdown(wait=False)
+
+
+class MemoryBudget(Atom):
+    '''
+    Limits the memory used by the pixel data of all presenters
+
+    Presenters are ordered by when they were last viewed. When the memory
+    used by all presenters exceeds `max_bytes`, the pixel data of the least
+    recently viewed presenters is moved out of memory (see
+    `BasePresenter.release_memory`) until the total is within the budget.
+    The presenter being viewed is never released. Released presenters are
+    restored when they are viewed again (see `activate`).
+    '''
+
+    #: Maximum number of bytes of pixel data to keep in memory
+    max_bytes = Int(4 * 1024 ** 3)
+
+    #: Registered presenters ordered from least to most recently viewed
+    presenters = List()
+
+    #: Temporary directory holding the pixel data of released presenters
+    cache_dir = Value()
+
+    def _default_cache_dir(self):
+        return tempfile.TemporaryDirectory(prefix='cochleogram-')
+
+    def register(self, presenter):
+        if presenter not in self.presenters:
+            self.presenters.insert(0, presenter)
+
+    def unregister(self, presenter):
+        if presenter in self.presenters:
+            self.presenters.remove(presenter)
+
+    def get_memory_usage(self):
+        return sum(p.get_memory_usage() for p in self.presenters)
+
+    def activate(self, presenter):
+        '''
+        Mark presenter as the most recently viewed, restoring its pixel data
+        if needed, and then enforce the budget
+        '''
+        self.unregister(presenter)
+        self.presenters.append(presenter)
+        presenter.restore_memory()
+        self.enforce()
+
+    def enforce(self):
+        usage = {p: p.get_memory_usage() for p in self.presenters}
+        total = sum(usage.values())
+        for presenter in self.presenters[:-1]:
+            if total <= self.max_bytes:
+                break
+            if presenter.memory_released:
+                continue
+            log.info('Releasing memory held by %s', presenter.obj)
+            presenter.release_memory(self.cache_dir.name)
+            total += presenter.get_memory_usage() - usage[presenter]
 
 
 class PointPlot(Atom):
@@ -73,6 +370,14 @@ class PointPlot(Atom):
 
     highlight_label = Str()
 
+    #: Only data within this region (xlb, xub, ylb, yub) is drawn. If None, all
+    #: data is drawn.
+    clip_region = Value()
+
+    #: Scheduler that coalesces redraws. If None, the artist redraws itself on
+    #: the next iteration of the event loop.
+    scheduler = Typed(FrameScheduler)
+
     def _default_artist_styles(self):
         return {
             'active': [
@@ -105,6 +410,12 @@ class PointPlot(Atom):
     def set_state(self, state):
         pass
 
+    def get_artists(self):
+        '''
+        Return Matplotlib artists managed by this plot
+        '''
+        return [self.artist, self.highlight_artist]
+
     def add_point(self, x, y):
         self.points.add_node(x, y, hit_threshold=2.5)
 
@@ -117,10 +428,24 @@ class PointPlot(Atom):
     def label_point(self, x, y, label, toggle=True):
         self.points.label_node(x, y, label, toggle=toggle)
 
+    def set_viewport(self, viewport):
+        # The region drawn is padded so that we only need to redraw once the
+        # viewport moves outside of it (or is much smaller than it after
+        # zooming in).
+        if region_contains(self.clip_region, viewport):
+            clip_width = self.clip_region[1] - self.clip_region[0]
+            if (viewport[1] - viewport[0]) * 4 > clip_width:
+                return
+        self.clip_region = pad_region(viewport, 0.5)
+        self.request_redraw()
+
     @observe("active")
     def request_redraw(self, event=False):
-        self.needs_redraw = True
-        deferred_call(self.redraw_if_needed)
+        if self.scheduler is not None:
+            self.scheduler.mark_dirty(self)
+        else:
+            self.needs_redraw = True
+            deferred_call(self.redraw_if_needed)
 
     def redraw_if_needed(self):
         if self.needs_redraw:
@@ -130,10 +455,10 @@ class PointPlot(Atom):
     def redraw(self, event=None):
         nodes = self.points.get_nodes()
         self.has_nodes = len(nodes[0]) > 0
-        self.artist.set_data(*nodes)
+        self.artist.set_data(*clip_points(*nodes, self.clip_region))
 
         highlight_nodes = self.points.get_labeled_nodes(self.highlight_label)
-        self.highlight_artist.set_data(*highlight_nodes)
+        self.highlight_artist.set_data(*clip_points(*highlight_nodes, self.clip_region))
 
         style = 'active' if self.active else 'inactive'
         self.artist.set_path_effects(self.artist_styles[style])
@@ -169,6 +494,12 @@ class LinePlot(PointPlot):
     spline_artist_styles = Dict()
     origin_artist_styles = Dict()
 
+    #: Path outlining the excluded regions and the state of the spline and
+    #: excluded regions it was created from. The path is only recreated when
+    #: these change.
+    exclude_path = Value()
+    exclude_path_key = Value()
+
     def _default_artist_styles(self):
         return {
             'active': [
@@ -211,6 +542,12 @@ class LinePlot(PointPlot):
         self.exclude_artist = mpatches.PathPatch(path, facecolor='salmon', alpha=0.25, zorder=100)
         axes.add_patch(self.exclude_artist)
 
+    def get_artists(self):
+        return super().get_artists() + [
+            self.spline_artist, self.origin_artist, self.exclude_artist,
+            self.new_exclude_artist,
+        ]
+
     def start_exclude(self, x, y):
         self.start_drag = x, y
         self.end_drag = None
@@ -230,8 +567,7 @@ class LinePlot(PointPlot):
         self.points.remove_exclude(x, y)
 
     def _observe_exclude_active(self, event=False):
-        self.needs_redraw = True
-        deferred_call(self.redraw_if_needed)
+        self.request_redraw()
 
     def redraw(self, event=None):
         super().redraw()
@@ -247,13 +583,17 @@ class LinePlot(PointPlot):
 
         xi, yi = self.points.interpolate()
         self.has_spline = len(xi) > 0
-        self.spline_artist.set_data(xi, yi)
+        self.spline_artist.set_data(*clip_line(xi, yi, self.clip_region))
         self.new_exclude_artist.set_visible(self.active)
 
         self.has_exclusion = len(self.points.exclude) > 0
-        path = make_plot_path(self.points, self.points.exclude)
+        # The version changes whenever the nodes or exclusion regions change.
+        key = id(self.points), self.points.version
+        if key != self.exclude_path_key:
+            self.exclude_path = make_plot_path(self.points, self.points.exclude)
+            self.exclude_path_key = key
 
-        self.exclude_artist.set_path(path)
+        self.exclude_artist.set_path(self.exclude_path)
         self.exclude_artist.set_visible(self.exclude_active)
 
         if self.start_drag and self.end_drag:
@@ -268,147 +608,327 @@ class LinePlot(PointPlot):
         self.new_exclude_artist.set_path(path)
 
 
-class ImagePlot(Atom):
+class ImagePlot(NDImagePlot):
+    '''
+    Plot of a tile that caches the rendered (i.e., colored and projected)
+    image
 
-    alpha = Float(0.75)
-    highlight = Bool(False)
-    zorder = Int(10)
+    Changes that only affect how the rendered image is positioned or blended
+    (e.g., extent, alpha, zorder and highlight) reuse the image shown by the
+    artist. Changes to the visible channels, display range, display colors,
+    display mode or z-slice pull the image from the cache if it was recently
+    rendered.
 
-    channel_config = Value()
+    The image is rendered from the level of the tile's image pyramid that
+    matches the resolution of the screen (see `set_level`). Only the region of
+    the image that falls within the viewport (plus some padding so that small
+    pans do not require a new region) is rendered. Tiles outside of the
+    viewport are not rendered at all (see `set_viewport`).
+    '''
 
-    display_mode = Enum("projection", "slice")
-    display_channels = List()
-    visible_channels = Property()
-    extent = Tuple()
-    z_slice = Int(0)
-    z_slice_min = Int(0)
-    z_slice_max = Int(0)
-    shift = Float()
+    #: Rendered images keyed by the display settings used to render them
+    render_cache = Typed(LRUCache)
 
-    tile = Typed(Tile)
-    artist = Value()
-    rectangle = Value()
-    axes = Value()
-    auto_rotate = Bool(True)
-    rotation_transform = Value()
-    transform = Value()
+    #: Key of the image currently shown by the artist
+    rendered_key = Value()
 
-    updated = Event()
-    needs_redraw = Bool(False)
+    #: Offset (dx, dy) of the displayed tile that has not yet been written to
+    #: the tile extent (see `drag_image`).
+    pending_offset = Tuple(Float(), default=(0.0, 0.0))
 
-    def _get_visible_channels(self):
-        return [c.name for c in self.channel_config.values() if c.visible]
+    #: Level of the image pyramid to display
+    level = Int(0)
 
-    def get_state(self):
-        return {
-            "alpha": self.alpha,
-            "zorder": self.zorder,
-            "display_mode": self.display_mode,
-            "display_channels": self.display_channels,
-            "z_slice": self.z_slice,
-            "z_slice_min": self.z_slice_min,
-            "z_slice_max": self.z_slice_max,
-            "shift": self.shift,
-        }
+    #: Visible region (xlb, xub, ylb, yub) of the axes. If None, the entire
+    #: image is rendered.
+    viewport = Value()
 
-    def set_state(self, state):
-        self.alpha = state["alpha"]
-        self.zorder = state["zorder"]
-        self.display_mode = state["display_mode"]
-        self.display_channels = state["display_channels"]
-        self.z_slice = state["z_slice"]
-        self.z_slice_min = state["z_slice_min"]
-        self.z_slice_max = state["z_slice_max"]
-        self.shift = state["shift"]
-
-    def __init__(self, axes, tile, **kwargs):
-        super().__init__(**kwargs)
-        self.tile = tile
-        self.axes = axes
-        self.axes.xaxis.set_major_locator(ticker.NullLocator())
-        self.axes.yaxis.set_major_locator(ticker.NullLocator())
-        self.rotation_transform = T.Affine2D()
-        self.transform = self.rotation_transform + axes.transData
-        self.artist = axes.imshow(np.array([[0, 1], [0, 1]]), origin="lower", transform=self.transform)
-        self.rectangle = mp.patches.Rectangle((0, 0), 0, 0, ec='red', fc='None', zorder=5000, transform=self.transform)
-        self.rectangle.set_alpha(0)
-        self.axes.add_patch(self.rectangle)
-        self.z_slice_max = self.tile.image.shape[2] - 1
-        self.z_slice = self.tile.image.shape[2] // 2
-        self.shift = self.tile.info["voxel_size"][0] * 5
-        self.channel_config = {c: ChannelConfig(name=c) for c in tile.channel_names}
+    #: Is any part of the tile within the viewport?
+    in_viewport = Bool(True)
 
-        for config in self.channel_config.values():
-            config.observe('visible', self.request_redraw)
-            config.observe('min_value', self.request_redraw)
-            config.observe('max_value', self.request_redraw)
-        tile.observe('extent', self.request_redraw)
-
-    def _observe_highlight(self, event):
-        if self.highlight:
-            self.rectangle.set_alpha(1)
-        else:
-            self.rectangle.set_alpha(0)
+    #: Region (xlb, xub, ylb, yub) of the image, in pixels relative to the
+    #: current level of the pyramid, that is currently rendered
+    region = Value()
 
-    def _observe_alpha(self, event):
-        self.artist.set_alpha(self.alpha)
+    #: Rendered regions are aligned to blocks of this many pixels so that they
+    #: can be reused from the cache when panning.
+    region_block = Int(256)
 
-    def _observe_zorder(self, event):
-        self.artist.set_zorder(self.zorder)
+    #: Fraction of the viewport size to pad the rendered region by on each
+    #: side.
+    region_padding = Float(0.5)
 
-    def drag_image(self, dx, dy):
-        extent = np.array(self.tile.extent)
-        extent[0:2] += dx
-        extent[2:4] += dy
-        self.tile.extent = extent.tolist()
+    #: Scheduler that coalesces redraws. If None, the artist redraws itself on
+    #: the next iteration of the event loop.
+    scheduler = Typed(FrameScheduler)
 
-    def move_image(self, direction, step_scale=1):
-        extent = np.array(self.tile.extent)
-        step = step_scale * self.shift
-        if direction == "up":
-            extent[2:4] += step
-        elif direction == "down":
-            extent[2:4] -= step
-        elif direction == "left":
-            extent[0:2] -= step
-        elif direction == "right":
-            extent[0:2] += step
-        self.tile.extent = extent.tolist()
-
-    @observe("z_slice", "display_mode", "alpha", "highlight")
-    def request_redraw(self, event=False):
-        self.needs_redraw = True
-        deferred_call(self.redraw_if_needed)
+    #: Summary of what was shown by the artist after the most recent redraw
+    drawn_signature = Value()
 
-    def redraw_if_needed(self):
-        if self.needs_redraw:
-            self.redraw()
-            self.needs_redraw = False
+    #: Renders neighboring z-slices in the background. If None, slices are
+    #: only rendered when displayed.
+    prefetcher = Typed(SlicePrefetcher)
 
-    def redraw(self, event=None):
-        z_slice = None if self.display_mode == 'projection' else self.z_slice
-        channels = [c for c in self.channel_config.values() if c.visible]
-        image = self.tile.get_image(channels=channels, z_slice=z_slice).swapaxes(0, 1)
-        self.artist.set_data(image)
-        xlb, xub, ylb, yub = extent = self.tile.get_image_extent()[:4]
-        self.artist.set_extent(extent)
-        self.rectangle.set_bounds(xlb, ylb, xub-xlb, yub-ylb)
-        t = self.tile.get_image_transform()
-        if self.auto_rotate:
-            self.rotation_transform.set_matrix(t.get_matrix())
-        self.updated = True
+    #: Lower bound of the z-slice the most recent prefetch was centered on
+    prefetch_origin = Int(0)
+
+    #: Have the rendered images been released (see `release`)? Redraws are
+    #: deferred until `restore` is called.
+    released = Bool(False)
+
+    def request_redraw(self, event=None):
+        if self.released:
+            self.needs_redraw = True
+        elif self.scheduler is not None:
+            self.scheduler.mark_dirty(self)
+        else:
+            super().request_redraw(event)
 
-    def contains(self, x, y):
-        return self.tile.contains(x, y)
+    def _default_render_cache(self):
+        return LRUCache(max_items=16)
 
-    def set_channel_visible(self, channel_name, visible):
-        self.channel_config[channel_name].visible = visible
+    @observe('level', 'viewport', 'in_viewport')
+    def _request_view_redraw(self, event):
+        self.request_redraw()
+
+    def set_viewport(self, viewport, in_viewport=True):
+        self.viewport = viewport
+        self.in_viewport = in_viewport
+
+    def get_region(self):
+        '''
+        Return region (xlb, xub, ylb, yub) of the image to render in pixels
+        relative to the current level of the pyramid
+
+        Returns None if no part of the image falls within the padded viewport.
+        '''
+        nx, ny = self.ndimage.get_pyramid_level(self.level).shape[:2]
+        if self.viewport is None:
+            return 0, nx, 0, ny
+        xlb, xub, ylb, yub = pad_region(self.viewport, self.region_padding)
+        corners = [[xlb, ylb], [xub, ylb], [xub, yub], [xlb, yub]]
+        corners = self.rotation_transform.inverted().transform(corners)
+        x0, _, y0, _ = self.ndimage.get_pyramid_extent(self.level)
+        scale = 2 ** self.level
+        pixel_size = [self.ndimage.get_voxel_size('x') * scale,
+                      self.ndimage.get_voxel_size('y') * scale]
+        corners = (corners - [x0, y0]) / pixel_size
+        block = self.region_block
+        lb = np.floor(corners.min(axis=0) / block) * block
+        ub = np.ceil(corners.max(axis=0) / block) * block
+        lb = np.clip(lb, 0, [nx, ny]).astype('i')
+        ub = np.clip(ub, 0, [nx, ny]).astype('i')
+        if np.any(ub <= lb):
+            return None
+        return int(lb[0]), int(ub[0]), int(lb[1]), int(ub[1])
+
+    def get_region_extent(self):
+        '''
+        Return extent (in data coordinates) of the rendered region
+        '''
+        x0, _, y0, _ = self.ndimage.get_pyramid_extent(self.level)
+        scale = 2 ** self.level
+        sx = self.ndimage.get_voxel_size('x') * scale
+        sy = self.ndimage.get_voxel_size('y') * scale
+        xlb, xub, ylb, yub = self.region
+        return x0 + xlb * sx, x0 + xub * sx, y0 + ylb * sy, y0 + yub * sy
+
+    def set_level(self, data_per_pixel):
+        '''
+        Select the coarsest pyramid level that has at least one image pixel
+        per screen pixel
+
+        Parameters
+        ----------
+        data_per_pixel : float
+            Size of a screen pixel in data units (i.e., microns).
+        '''
+        ratio = data_per_pixel / self.ndimage.get_voxel_size('x')
+        level = int(np.floor(np.log2(max(ratio, 1))))
+        self.level = min(level, self.ndimage.pyramid_levels)
+
+    def _observe_ndimage(self, event):
+        if event.get('oldvalue', None) is not None:
+            event['oldvalue'].unobserve('image', self.clear_render_cache)
+        super()._observe_ndimage(event)
+        event['value'].observe('image', self.clear_render_cache)
+        for config in self.channel_config.values():
+            config.observe(('visible', 'min_value', 'max_value', 'display_color'),
+                           self.cancel_prefetch)
+        self.clear_render_cache()
+
+    def cancel_prefetch(self, event=None):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel(self)
+
+    def clear_render_cache(self, event=None):
+        self.cancel_prefetch()
+        self.render_cache.clear()
+        self.rendered_key = None
+        self.drawn_signature = None
+        if event is not None:
+            self.request_redraw()
+
+    def release(self):
+        '''
+        Discard rendered images and stop redrawing until `restore` is called
+        '''
+        self.released = True
+        self.clear_render_cache()
+        self.artist.set_data(np.zeros((1, 1, 3), dtype='uint8'))
+
+    def restore(self):
+        self.released = False
+        self.request_redraw()
+
+    def get_memory_usage(self):
+        '''
+        Return number of bytes held by rendered images
+        '''
+        n = self.render_cache.nbytes
+        if self.rendered_key not in self.render_cache:
+            n += self.artist.get_array().nbytes
+        return n
+
+    def get_render_key(self):
+        '''
+        Return hashable key identifying all display settings that affect the
+        pixel content of the rendered image
+        '''
+        channels = tuple(
+            (c.name, c.i, c.min_value, c.max_value, c.display_color.argb)
+            for c in self.channel_config.values() if c.visible
+        )
+        if self.display_mode == 'projection':
+            z_slice = None
+        else:
+            z_slice = self.z_slice_lb, self.z_slice_ub
+        return channels, z_slice, self.level, self.region
+
+    def get_image(self, z_slice=None, level=None, region=None,
+                  channel_config=None, source=None):
+        if z_slice is None and self.display_mode == 'slice':
+            z_slice = self.z_slice
+        if level is None:
+            level = self.level
+        if region is None:
+            region = self.region
+        if channel_config is None:
+            channel_config = [c for c in self.channel_config.values() if c.visible]
+        image = self.ndimage.get_image(channels=channel_config,
+                                       z_slice=z_slice, level=level,
+                                       region=region, source=source)
+        return image.swapaxes(0, 1)
+
+    def render_image(self, z_slice=None, level=None, region=None,
+                     channel_config=None, source=None):
+        '''
+        Render image without using the cache
+
+        The artist expects the image in YX order. A contiguous copy is
+        returned as 8-bit RGB (what Matplotlib converts it to anyways when
+        drawing) to keep the cache small. Safe to call from a background
+        thread if the channel configuration and source (the image at the
+        requested pyramid level) are provided and the normalization of the
+        image has been computed.
+        '''
+        image = self.get_image(z_slice, level, region, channel_config, source) * 255
+        return np.ascontiguousarray(image.round().astype('uint8'))
+
+    def render(self, key=None):
+        '''
+        Return rendered image for the current display settings
+        '''
+        if key is None:
+            key = self.get_render_key()
+        if self.prefetcher is not None:
+            self.prefetcher.wait(self, key)
+        image = self.render_cache.get(key)
+        if image is None:
+            image = self.render_image()
+            self.render_cache.set(key, image)
+        return image
+
+    def drag_image(self, dx, dy, preview=False):
+        '''
+        Move tile by dx, dy
+
+        If preview is True, only the displayed position of the tile is updated.
+        The move is written to the tile extent by `commit_offset`.
+        '''
+        if not preview:
+            return super().drag_image(dx, dy)
+        x, y = self.pending_offset
+        self.pending_offset = x + dx, y + dy
+        self.update_transform()
+        self.updated = True
 
-    def set_channel_min_value(self, channel_name, min_value):
-        self.channel_config[channel_name].min_value = min_value
+    def move_image(self, direction, step_scale=1, preview=False):
+        step = step_scale * self.shift
+        dx, dy = {
+            'up': (0, step),
+            'down': (0, -step),
+            'left': (-step, 0),
+            'right': (step, 0),
+        }.get(direction, (0, 0))
+        self.drag_image(dx, dy, preview)
+
+    def commit_offset(self):
+        '''
+        Write offset accumulated by previewed moves to the tile extent
+
+        Returns
+        -------
+        committed : bool
+            True if there was an offset to commit.
+        '''
+        dx, dy = self.pending_offset
+        if dx == 0 and dy == 0:
+            return False
+        self.pending_offset = 0.0, 0.0
+        super().drag_image(dx, dy)
+        return True
+
+    def update_transform(self):
+        # Translating the rotated image is equivalent to rotating the
+        # translated image about its new center, so the pending offset can be
+        # applied on top of the current tile transform.
+        if self.auto_rotate:
+            t = T.Affine2D(self.ndimage.get_image_transform().get_matrix())
+        else:
+            t = T.Affine2D()
+        self.rotation_transform.set_matrix(t.translate(*self.pending_offset).get_matrix())
 
-    def set_channel_max_value(self, channel_name, max_value):
-        self.channel_config[channel_name].max_value = max_value
+    def redraw(self, event=None):
+        self.update_transform()
+        xlb, xub, ylb, yub = self.ndimage.get_image_extent()[:4]
+        self.rectangle.set_bounds(xlb, ylb, xub-xlb, yub-ylb)
+        self.region = self.get_region() if self.in_viewport else None
+        if self.region is None:
+            self.artist.set_visible(False)
+        else:
+            key = self.get_render_key()
+            if key != self.rendered_key:
+                self.artist.set_data(self.render(key))
+                self.rendered_key = key
+            self.artist.set_extent(self.get_region_extent())
+            self.artist.set_visible(True)
+            if self.prefetcher is not None:
+                self.prefetcher.prefetch(self)
+
+        # Only notify listeners (which will redraw the canvas) if the
+        # appearance of the tile has changed.
+        signature = (
+            self.rendered_key if self.region is not None else None,
+            tuple(self.artist.get_extent()),
+            self.rotation_transform.get_matrix().tobytes(),
+            self.alpha,
+            self.zorder,
+            self.highlight,
+        )
+        if signature != self.drawn_signature:
+            self.drawn_signature = signature
+            self.updated = True
 
 
 class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
@@ -438,12 +958,7 @@ class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
         return self._guess_channel()
 
     def _guess_channel(self):
-        if self.cells == 'IHC' and 'CtBP2' in self.obj.channel_names:
-            return 'CtBP2'
-        elif 'MyosinVIIa' in self.obj.channel_names:
-            return 'MyosinVIIa'
-        else:
-            return self.obj.channel_names[0]
+        return self.obj.default_guess_channel(self.cells)
 
     def _observe_cells(self, event):
         # Select reasonable default for guessing cells.
@@ -474,6 +989,132 @@ class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
     #: Interface to help read data
     reader = Instance(BaseReader)
 
+    #: Index of tile extents used for hit-testing and culling
+    tile_index = Typed(TileIndex)
+
+    #: Coalesces redraws of the artists and canvas into frames
+    scheduler = Typed(FrameScheduler)
+
+    def _default_scheduler(self):
+        return FrameScheduler(draw=self.redraw)
+
+    #: Renders the z-slices surrounding the current z-slice in the background
+    prefetcher = Typed(SlicePrefetcher, ())
+
+    #: Copy of the canvas with everything except the overlays (i.e., cells,
+    #: spirals and exclusion regions) drawn. Used for blitting the overlays.
+    background = Value()
+
+    #: Does the background need to be redrawn (e.g., due to changes in the
+    #: images or the axes limits)?
+    background_dirty = Bool(True)
+
+    def _default_figure(self):
+        figure = super()._default_figure()
+        figure.canvas.mpl_connect('draw_event', self._capture_background)
+        return figure
+
+    def request_redraw(self, event=None):
+        self.background_dirty = True
+        self.scheduler.mark_dirty()
+
+    def request_overlay_redraw(self, event=None):
+        '''
+        Request redraw of the canvas where only the overlays have changed
+        '''
+        self.scheduler.mark_dirty()
+
+    def invalidate_background(self, event=None):
+        self.background_dirty = True
+
+    def get_overlay_artists(self):
+        artists = [a for p in self.point_artists.values() for a in p.get_artists()]
+        return sorted(artists, key=lambda a: a.get_zorder())
+
+    def draw_overlay(self):
+        for artist in self.get_overlay_artists():
+            self.axes.draw_artist(artist)
+
+    def _capture_background(self, event):
+        # Called after every full draw of the canvas (including those
+        # triggered by the backend, e.g., on resize). At this point the
+        # overlays have not been drawn since they are animated.
+        canvas = self.figure.canvas
+        if not canvas.supports_blit:
+            return
+        self.background = canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_overlay()
+
+    def redraw(self):
+        canvas = self.figure.canvas
+        # Animated artists are skipped when the canvas is drawn. Only mark the
+        # overlays as animated if the canvas supports blitting.
+        for artist in self.get_overlay_artists():
+            artist.set_animated(canvas.supports_blit)
+        if canvas.supports_blit and self.background is not None \
+                and not self.background_dirty:
+            canvas.restore_region(self.background)
+            self.draw_overlay()
+            canvas.blit(self.figure.bbox)
+        else:
+            canvas.draw()
+            # Drawing may adjust the axes limits to maintain the aspect ratio.
+            # These changes are already reflected in the background.
+            self.background_dirty = False
+
+    #: Saves the analysis in the background after it is edited. If None, the
+    #: analysis is only saved on request.
+    autosave = Typed(AutosaveService)
+
+    #: Version of the analysis (see `CellAnalysis.get_version`) when it was
+    #: last saved or loaded. Used to check for unsaved changes without
+    #: comparing the full state.
+    saved_version = Value()
+
+    #: Has the pixel data been moved out of memory (see `release_memory`)?
+    memory_released = Bool(False)
+
+    def get_memory_usage(self):
+        '''
+        Return number of bytes of pixel data held in memory by the tiles and
+        artists
+        '''
+        n = sum(t.get_memory_usage() for t in self.obj.tiles)
+        n += sum(a.get_memory_usage() for a in self.ndimage_artists.values())
+        return n
+
+    def close(self):
+        '''
+        Stop background work (e.g., when the dataset is closed)
+        '''
+        self.prefetcher.shutdown()
+
+    def release_memory(self, cache_dir):
+        '''
+        Move pixel data of the tiles into files in cache_dir and discard the
+        rendered images
+
+        The tiles remain usable (e.g., for generating the composite) since
+        they are memory-mapped from the files.
+        '''
+        self.prefetcher.cancel_all()
+        for artist in self.ndimage_artists.values():
+            artist.release()
+        for tile in self.obj.tiles:
+            tile.evict_image(Path(cache_dir) / f'{id(tile):x}.npy')
+        self.background = None
+        self.background_dirty = True
+        self.memory_released = True
+
+    def restore_memory(self):
+        if not self.memory_released:
+            return
+        for tile in self.obj.tiles:
+            tile.restore_image()
+        for artist in self.ndimage_artists.values():
+            artist.restore()
+        self.memory_released = False
+
     # For spirals and cells
     point_artists = Dict()
     current_spiral_artist = Value()
@@ -482,10 +1123,13 @@ class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
     def __init__(self, obj, reader, **kwargs):
         for key in self.available_cells:
             color = CELL_COLORS[key]
-            cells = PointPlot(self.axes, obj.cells[key], name=key, base_color=color)
-            spiral = LinePlot(self.axes, obj.spirals[key], name=key, base_color=color, marker_style='s')
-            cells.observe('updated', self.request_redraw)
-            spiral.observe('updated', self.request_redraw)
+            cells = PointPlot(self.axes, obj.cells[key], name=key,
+                              base_color=color, scheduler=self.scheduler)
+            spiral = LinePlot(self.axes, obj.spirals[key], name=key,
+                              base_color=color, marker_style='s',
+                              scheduler=self.scheduler)
+            cells.observe('updated', self.request_overlay_redraw)
+            spiral.observe('updated', self.request_overlay_redraw)
             cells.observe('updated', self.update_state)
             spiral.observe('updated', self.update_state)
             self.point_artists[key, 'cells'] = cells
@@ -497,8 +1141,53 @@ class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
 
         # This sets up the image plots
         super().__init__(obj=obj, reader=reader, **kwargs)
+        self.saved_version = obj.get_version()
         self.load_state()
 
+        # Update the pyramid level and rendered region of the images (and
+        # the data drawn by the overlays) when zooming, panning or resizing.
+        self.axes.callbacks.connect('xlim_changed', self.invalidate_background)
+        self.axes.callbacks.connect('ylim_changed', self.invalidate_background)
+        self.axes.callbacks.connect('xlim_changed', self.update_viewport)
+        self.axes.callbacks.connect('ylim_changed', self.update_viewport)
+        self.figure.canvas.mpl_connect('resize_event', self.update_viewport)
+        self.update_viewport()
+
+    def update_viewport(self, event=None):
+        width, height = self.axes.bbox.width, self.axes.bbox.height
+        if width <= 0 or height <= 0:
+            return
+        xlb, xub = sorted(self.axes.get_xlim())
+        ylb, yub = sorted(self.axes.get_ylim())
+        viewport = xlb, xub, ylb, yub
+        data_per_pixel = min((xub - xlb) / width, (yub - ylb) / height)
+        in_viewport = self.tile_index.intersects(viewport)
+        for artist, visible in zip(self.ndimage_artists.values(), in_viewport):
+            artist.set_level(data_per_pixel)
+            artist.set_viewport(viewport, bool(visible))
+        for artist in self.point_artists.values():
+            artist.set_viewport(viewport)
+
+    def _observe_obj(self, event):
+        self.tile_index = TileIndex(self.obj)
+        self.ndimage_artists = {
+            t.source: ImagePlot(self.axes, t, auto_rotate=self.rotate_ndimage,
+                                scheduler=self.scheduler,
+                                prefetcher=self.prefetcher)
+            for t in self.obj
+        }
+        for artist in self.ndimage_artists.values():
+            artist.observe('updated', self.request_redraw)
+
+        # Needs to be set to force a change notification that sets the current
+        # artist.
+        self.current_artist_index = 0
+
+        # This is necessary because `imshow` will override some axis settings.
+        # We need to set them back to what we want.
+        self.axes.axis('equal')
+        self.axes.axis(self.obj.get_image_extent())
+
     @observe('cells', 'tool')
     def _update_plots(self, event=None):
         for artist in self.point_artists.values():
@@ -598,11 +1287,39 @@ class BasePresenter(NDImageCollectionPresenter, StatePersistenceMixin):
         self.set_interaction_mode(state["cells"], state["tool"])
 
     def get_full_state(self):
-        return deepcopy({
+        return copy_state({
             "data": self.obj.get_state(),
             "view": self.get_state(),
         })
 
+    def get_autosave_state(self):
+        state = self.get_full_state()
+        state['meta'] = copy_state(self.saved_meta)
+        state['meta']['autosaved'] = datetime.now(timezone.utc).isoformat()
+        return state
+
+    def update_state(self, event=None):
+        super().update_state(event)
+        if self.autosave is not None and self.unsaved_changes:
+            self.autosave.request(self)
+
+    def save_state(self, include_meta=True):
+        version = self.obj.get_version()
+        super().save_state(include_meta)
+        self.saved_version = version
+        self.update_state()
+
+    def load_state(self):
+        version = self.obj.get_version()
+        super().load_state()
+        # If no analysis was found, the state is unchanged.
+        if self.obj.get_version() != version:
+            self.saved_version = self.obj.get_version()
+            self.update_state()
+
+    def check_for_changes(self):
+        self.unsaved_changes = self.obj.get_version() != self.saved_version
+
 
 class CellCountPresenter(BasePresenter):
 
@@ -642,12 +1359,14 @@ class CochleogramPresenter(BasePresenter):
 
     available_tools = set_default(("tile", "spiral", "exclude", "cells"))
 
-    def check_for_changes(self):
-        saved = self.saved_state['data'].copy()
-        saved.pop('copied_from', None)
-        unsaved = self.get_full_state()['data']
-        unsaved.pop('copied_from', None)
-        self.unsaved_changes = saved != unsaved
+    #: Algorithm used for automatically aligning tiles (see
+    #: `Piece.align_tiles`).
+    alignment_mode = Enum('full', 'overlap', 'global')
+
+    def _default_figure(self):
+        figure = super()._default_figure()
+        figure.canvas.mpl_connect('key_release_event', lambda e: self.key_release(e))
+        return figure
 
     def _observe_current_artist_index(self, event):
         super()._observe_current_artist_index(event)
@@ -668,7 +1387,9 @@ class CochleogramPresenter(BasePresenter):
         self.request_redraw()
 
     def action_auto_align_tiles(self):
-        self.obj.align_tiles(self.current_artist.visible_channels)
+        self.commit_tiles()
+        self.obj.align_tiles(self.current_artist.visible_channels,
+                             mode=self.alignment_mode)
         self.update_state()
 
     def action_clone_spiral(self, to_spiral, distance):
@@ -707,19 +1428,38 @@ class CochleogramPresenter(BasePresenter):
             self.key_press_point_plot(event)
 
     def key_press_tile(self, event):
+        # Arrow keys only move the displayed tile. The new position is written
+        # to the tile when the key is released.
         if event.key in ["right", "left", "up", "down"]:
             if self.current_artist is not None:
-                self.current_artist.move_image(event.key)
+                self.current_artist.move_image(event.key, preview=True)
         elif event.key in ["shift+right", "shift+left", "shift+up", "shift+down"]:
             if self.current_artist is not None:
-                self.current_artist.move_image(event.key.split('+')[1], 0.25)
+                self.current_artist.move_image(event.key.split('+')[1], 0.25, preview=True)
         elif event.key.lower() == "n":
+            self.commit_tiles()
             i = self.current_artist_index
             self.current_artist_index = (i + 1) % len(self.ndimage_artists)
         elif event.key.lower() == "p":
+            self.commit_tiles()
             i = len(self.ndimage_artists) + 1
             self.current_artist_index = (i - 1) % len(self.ndimage_artists)
-        self.update_state()
+
+    def key_release(self, event):
+        if self.tool == 'tile' and self.drag_event is None:
+            self.commit_tiles()
+
+    def commit_tiles(self):
+        '''
+        Write any pending moves of the displayed tiles to the tiles
+        '''
+        committed = [a.commit_offset() for a in self.ndimage_artists.values()]
+        if any(committed):
+            self.update_state()
+
+    def save_state(self, include_meta=True):
+        self.commit_tiles()
+        super().save_state(include_meta)
 
     def key_press_point_plot(self, event):
         if event.key.startswith('shift+'):
@@ -741,6 +1481,8 @@ class CochleogramPresenter(BasePresenter):
     def right_button_press(self, event):
         if self.tool != 'tile':
             self.button_press_point_plot(event)
+        elif self.current_artist is not None and event.xdata is not None:
+            self.start_drag_tile(event)
 
     def left_button_release(self, event):
         if not self.pan_performed:
@@ -749,13 +1491,15 @@ class CochleogramPresenter(BasePresenter):
 
     def button_release_tile(self, event):
         if event.button == MouseButton.LEFT and event.xdata is not None:
-            for i, artist in enumerate(self.ndimage_artists.values()):
-                if artist.contains(event.xdata, event.ydata):
-                    self.current_artist_index = i
-                    break
+            hits = self.tile_index.contains(event.xdata, event.ydata)
+            if len(hits):
+                self.current_artist_index = int(hits[0])
 
     @observe('tool', 'cells')
     def _reset_drag(self, event):
+        if event['type'] == 'create':
+            return
+        self.commit_tiles()
         self.drag_event = None
         if self.current_spiral_artist is not None:
             self.current_spiral_artist.start_drag = None
@@ -767,8 +1511,8 @@ class CochleogramPresenter(BasePresenter):
                 self.button_release_tile(event)
             self.end_pan(event)
         elif event.button == MouseButton.RIGHT:
-            if self.tool == 'tile':
-                self.drag_event = None
+            if self.tool == 'tile' and self.drag_event is not None:
+                self.end_drag_tile(event)
 
     def start_drag_exclude(self, event):
         self.drag_event = event
@@ -784,7 +1528,7 @@ class CochleogramPresenter(BasePresenter):
         elif self.tool == 'tile' and self.current_artist is not None:
             dx = event.xdata - self.drag_event.xdata
             dy = event.ydata - self.drag_event.ydata
-            self.current_artist.drag_image(dx, dy)
+            self.current_artist.drag_image(dx, dy, preview=True)
             self.drag_event = event
         else:
             self.current_spiral_artist.update_exclude(event.xdata, event.ydata)
@@ -795,4 +1539,4 @@ class CochleogramPresenter(BasePresenter):
 
     def end_drag_tile(self, event):
         self.drag_event = None
-        self.update_state()
+        self.commit_tiles()
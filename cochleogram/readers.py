@@ -9,6 +9,7 @@ import re
 import numpy as np
 
 from . import model
+from . import analysis_file
 from . import util
 
 P_FREQ = re.compile(r'.*?(\d+p\d+)_kHz.*')
@@ -20,6 +21,18 @@ def extract_frequency(name):
     return None
 
 
+def pad_z(image, pad_bottom, pad_top):
+    '''
+    Pad XYZC image with empty slices below and above the stack
+    '''
+    if util.is_placeholder(image):
+        shape = list(image.shape)
+        shape[2] += pad_bottom + pad_top
+        return util.placeholder_image(shape, image.dtype)
+    padding = [(0, 0), (0, 0), (pad_bottom, pad_top), (0, 0)]
+    return np.pad(image, padding)
+
+
 class BaseReader:
     '''
     Base class of all readers. Provides state persistence for analysis. Actual
@@ -27,20 +40,121 @@ class BaseReader:
     data should be handled by subclasses.
     '''
 
+    #: Channels to load (see `util.get_channel_indices`). If None, all
+    #: channels are loaded.
+    channels = None
+
+    #: True if the channels were selected using the selection saved with the
+    #: dataset (see `load_collection`).
+    saved_channels_used = False
+
+    #: Data type of the loaded images. If 'uint8', each channel is rescaled to
+    #: 0 ... 255. If 'uint16', the raw counts are kept (display scaling is
+    #: only applied when rendering).
+    dtype = 'uint8'
+
+    #: If True, the pixel data is not read. Tiles are created with placeholder
+    #: images (see `util.placeholder_image`) that have the shape of the image
+    #: but do not use any memory, so the tile extents and the saved analysis
+    #: (e.g., cells and spirals) are available for generating summaries.
+    metadata_only = False
+
+    #: Format used when saving analysis that has not been saved before (see
+    #: `cochleogram.analysis_file`). Existing analysis is saved in the format
+    #: it was loaded from.
+    state_format = 'json'
+
+    def find_state_file(self, obj):
+        '''
+        Return the file containing the saved analysis (None if there is no
+        saved analysis)
+
+        If the analysis has been saved in more than one format, the most
+        recently modified file is returned.
+        '''
+        json_filename = self.state_filename(obj)
+        filenames = [f for f in (json_filename, json_filename.with_suffix('.npz'))
+                     if f.exists()]
+        if not filenames:
+            return None
+        return max(filenames, key=lambda f: f.stat().st_mtime)
+
     def load_state(self, obj):
-        state_filename = self.state_filename(obj)
-        if not state_filename.exists():
+        state_filename = self.find_state_file(obj)
+        if state_filename is None:
             raise IOError('No saved analysis found')
-        return json.loads(state_filename.read_text())
+        return analysis_file.load(state_filename)
 
     def save_state(self, obj, state):
-        state_filename = self.state_filename(obj)
+        state_filename = self.find_state_file(obj)
+        if state_filename is None:
+            state_filename = self.state_filename(obj) \
+                .with_suffix(f'.{self.state_format}')
         state_filename.parent.mkdir(exist_ok=True)
-        state_filename.write_text(json.dumps(state, indent=4))
+        analysis_file.save(state_filename, state)
+
+    def describe_channels(self):
+        '''
+        Return description of the channels selected for loading
+        '''
+        if self.channels is None:
+            return 'all channels'
+        return ', '.join(c if isinstance(c, str) else f'{c:g} nm' for c in self.channels)
+
+    def channels_filename(self):
+        return self.save_path() / f'{self.get_name()}_channels.json'
+
+    def load_channels(self):
+        '''
+        Return channel selection saved for this dataset (None if all channels
+        should be loaded)
+        '''
+        filename = self.channels_filename()
+        if not filename.exists():
+            return None
+        return json.loads(filename.read_text())
+
+    def save_channels(self, channels):
+        filename = self.channels_filename()
+        if channels is None:
+            filename.unlink(missing_ok=True)
+        else:
+            filename.parent.mkdir(exist_ok=True)
+            filename.write_text(json.dumps(list(channels)))
 
     def load_collection(self, load_analysis=True,
-                     raise_load_analysis_error=False):
+                        raise_load_analysis_error=False, channels=None):
+        '''
+        Load collection
+
+        Parameters
+        ----------
+        load_analysis : bool
+            If True, load saved analysis.
+        raise_load_analysis_error : bool
+            If True, raise an error if no saved analysis is found.
+        channels : {None, list}
+            Channels to load, specified by name or emission wavelength (see
+            `util.get_channel_indices`). Once the collection is loaded, the
+            selection is saved with the dataset and reused on subsequent
+            loads. If None, the saved selection is used (or all channels if
+            there is no saved selection).
+        '''
+        if channels is None:
+            self.channels = self.load_channels()
+            self.saved_channels_used = self.channels is not None
+            if self.saved_channels_used:
+                log.info('Loading %s using the channel selection saved in %s',
+                         self.describe_channels(), self.channels_filename())
+        else:
+            self.channels = list(channels)
+            self.saved_channels_used = False
+        # The selection is validated when the images are loaded. Save it only
+        # once loading succeeds so that an invalid selection does not break
+        # subsequent loads of the dataset.
         collection = self._load_collection()
+        if channels is not None:
+            self.save_channels(self.channels)
         if load_analysis:
             for obj in collection:
                 try:
@@ -69,9 +183,101 @@ class CochleaReader(BaseReader):
     more if the entire piece did not fit inside the field of view.
     '''
 
+    #: If set, only the region of each stack within this distance (in microns)
+    #: of the saved spirals is loaded (see `load_band`). Pieces without a
+    #: saved spiral are loaded without any tiles.
+    spiral_band = None
+
+    #: Spirals used when loading the band around the spirals. If None, all
+    #: spirals are used.
+    spiral_band_cells = None
+
     def __init__(self, path):
         self.path = Path(path)
 
+    def load_collection(self, load_analysis=True,
+                        raise_load_analysis_error=False, channels=None):
+        if self.spiral_band is None:
+            return super().load_collection(load_analysis,
+                                           raise_load_analysis_error, channels)
+        if not load_analysis:
+            raise ValueError('The analysis must be loaded to find the spirals')
+        # Load the metadata (including the tile positions) and the analysis
+        # first so that the region of each stack surrounding the spirals can
+        # be found.
+        metadata_only = self.metadata_only
+        self.metadata_only = True
+        try:
+            cochlea = super().load_collection(True, raise_load_analysis_error,
+                                              channels)
+        finally:
+            self.metadata_only = metadata_only
+        stack_names = self.list_pieces()
+        pieces = [self.load_band(p, stack_names[p.piece], self.spiral_band,
+                                 self.spiral_band_cells) for p in cochlea]
+        return model.Cochlea(pieces)
+
+    def load_band(self, piece, stack_names, width, cell_types=None,
+                  channels=None):
+        '''
+        Load the band of image data surrounding the spirals of the piece
+
+        Only the bounding box of the band in each stack is read. Tiles that do
+        not overlap the band are omitted, but their saved state is kept (see
+        `Piece.omitted_tiles`) so that analysis saved from the band can be
+        loaded into the full piece.
+
+        Parameters
+        ----------
+        piece : Piece
+            Piece with the saved analysis applied. The tiles must have the
+            full extent of each stack (e.g., loaded with `metadata_only`).
+        stack_names : list of str
+            Name of the stack for each tile in the piece (as returned by
+            `list_pieces`).
+        width : float
+            Load the region within this distance (in microns) of the spirals.
+        cell_types : {None, list}
+            Spirals to load the band around. If None, all spirals are used.
+        channels : {None, list}
+            Channels to load. If None, the channels selected for the reader
+            are loaded.
+
+        Returns
+        -------
+        piece : Piece
+            Piece containing the cropped tiles (see `Tile.crop`) with the
+            analysis of the original piece.
+        '''
+        if cell_types is None:
+            cell_types = list(piece.spirals.keys())
+        if channels is None:
+            channels = self.channels
+        spirals = [np.c_[piece.spirals[c].interpolate()] for c in cell_types]
+        spirals = [s for s in spirals if len(s)]
+
+        tiles = []
+        if spirals:
+            spirals = np.concatenate(spirals)
+            for tile, stack_name in zip(piece.tiles, stack_names):
+                nx, ny = tile.image.shape[:2]
+                xlb, xub, ylb, yub = util.get_band_bounds(tile, spirals, width)
+                region = max(xlb, 0), min(xub, nx), max(ylb, 0), min(yub, ny)
+                if region[0] >= region[1] or region[2] >= region[3]:
+                    continue
+                info, image = self.load_stack_region(stack_name, region, channels)
+                # Pad the region along Z to match the tile.
+                zv = tile.info['voxel_size'][2]
+                pb = int(round((tile.info['lower'][2] - tile.extent[4]) / zv))
+                pt = tile.image.shape[2] - image.shape[2] - pb
+                if pb != 0 or pt != 0:
+                    image = pad_z(image, pb, pt)
+                tiles.append(tile.crop(region, image, info))
+
+        band = model.Piece(tiles, piece.piece, copied_from=piece.copied_from)
+        band.set_state(piece.get_state())
+        return band
+
     def save_figure(self, fig, suffix, file_format='pdf'):
         filename = self.save_path() / f'{self.get_name()}_{suffix}.{file_format}'
         filename.parent.mkdir(exist_ok=True)
@@ -107,8 +313,11 @@ class CochleaReader(BaseReader):
         pad_top = (z_n - pad_bottom - slice_n).astype('i')
 
         for (t, pb, pt) in zip(tiles, pad_bottom, pad_top):
-            padding = [(0, 0), (0, 0), (pb, pt), (0, 0)]
-            t.image = np.pad(t.image, padding)
+            # Stacks that already span the full range are left as-is (this
+            # also avoids Atom comparing the old and new image element by
+            # element when they have the same shape).
+            if pb != 0 or pt != 0:
+                t.image = pad_z(t.image, pb, pt)
             t.extent[4:] = [z_min, z_max]
 
         return model.Piece(tiles, piece, copied_from=copied)
@@ -123,6 +332,37 @@ class CochleaReader(BaseReader):
         raise NotImplementedError
 
     def _load_tile(self, stack_name):
+        info, img = self._load_stack(stack_name, self.channels)
+        return model.Tile(info, img, self.tile_source(stack_name))
+
+    def load_stack_region(self, stack_name, region, channels=None):
+        '''
+        Load only the region of the stack
+
+        Parameters
+        ----------
+        stack_name : str
+            Name of the stack (as returned by `list_pieces`).
+        region : tuple of int
+            Region (xlb, xub, ylb, yub) of the stack to load in pixels.
+        channels : {None, list}
+            Channels to load (see `util.get_channel_indices`). If None, all
+            channels are loaded.
+
+        Returns
+        -------
+        info : dict
+            Information about the full stack.
+        image : array
+            Pixel data of the region (see `Tile.crop`). The stack is not
+            padded along Z as it is when loading the piece.
+        '''
+        return self._load_stack(stack_name, channels, region)
+
+    def tile_source(self, stack_name):
+        return f'{self.path.stem}_{stack_name}'
+
+    def _load_stack(self, stack_name, channels, region=None):
         raise NotImplementedError
 
     def save_path(self):
@@ -153,10 +393,10 @@ class LIFCochleaReader(CochleaReader):
                 pass
         return {p: pieces[p] for p in sorted(pieces)}
 
-    def _load_tile(self, stack_name):
-        info, img = util.load_lif(self.path, stack_name)
-        name = f'{self.path.stem}_{stack_name}'
-        return model.Tile(info, img, name)
+    def _load_stack(self, stack_name, channels, region=None):
+        return util.load_lif(self.path, stack_name, dtype=self.dtype,
+                             channels=channels,
+                             metadata_only=self.metadata_only, region=region)
 
     def save_path(self):
         return self.path.parent / self.path.stem
@@ -182,11 +422,10 @@ class CZICochleaReader(CochleaReader):
                 pass
         return {p: pieces[p] for p in sorted(pieces)}
 
-    def _load_tile(self, stack_name):
+    def _load_stack(self, stack_name, channels, region=None):
         filename = self.path / f'{stack_name}.czi'
-        info, img = util.load_czi(filename)
-        name = f'{self.path.stem}_{stack_name}'
-        return model.Tile(info, img, name)
+        return util.load_czi(filename, dtype=self.dtype, channels=channels,
+                             metadata_only=self.metadata_only, region=region)
 
     def save_path(self):
         return self.path.parent / self.path.stem
@@ -213,11 +452,10 @@ class IMSCochleaReader(CochleaReader):
                 pass
         return {p: pieces[p] for p in sorted(pieces)}
 
-    def _load_tile(self, stack_name):
+    def _load_stack(self, stack_name, channels, region=None):
         filename = self.path / f'{stack_name}.ims'
-        info, img = util.load_ims(filename)
-        name = f'{self.path.stem}_{stack_name}'
-        return model.Tile(info, img, name)
+        return util.load_ims(filename, channels=channels,
+                             metadata_only=self.metadata_only, region=region)
 
     def save_path(self):
         return self.path.parent / self.path.stem
@@ -228,17 +466,31 @@ class ProcessedCochleaReader(CochleaReader):
     def list_pieces(self):
         p_piece = re.compile(r'.*piece_(\d+)\w?')
         pieces = {}
-        for path in self.path.glob('*piece_*.*'):
-            if path.name.endswith('.json'):
-                continue
+        for path in self.path.glob('*piece_*.npy'):
             piece = int(p_piece.match(path.stem).group(1))
             pieces.setdefault(piece, []).append(path.stem)
         return {p: pieces[p] for p in sorted(pieces)}
 
-    def _load_tile(self, stack_name):
-        image = np.load(f'{stack_name}.npy')
+    def tile_source(self, stack_name):
+        return stack_name
+
+    def _load_stack(self, stack_name, channels, region=None):
+        filename = self.path / f'{stack_name}.npy'
         info = json.loads(filename.with_suffix('.json').read_text())
-        return model.Tile(info, image, filename.stem)
+        # Memory-map the file so that only the requested channels (and
+        # region) are read.
+        image = np.load(filename, mmap_mode='r')
+        indices = util.get_channel_indices(info['channels'], channels)
+        info['channels'] = [info['channels'][i] for i in indices]
+        if region is not None:
+            xlb, xub, ylb, yub = region
+            image = image[xlb:xub, ylb:yub]
+        if self.metadata_only:
+            image = util.placeholder_image(image.shape[:-1] + (len(indices),),
+                                           image.dtype)
+        else:
+            image = np.array(image[..., indices])
+        return info, image
 
     def save_path(self):
         return self.path
@@ -279,7 +531,9 @@ class LIFTileReader(TileReader):
         self.fh = LifFile(path)
 
     def load_tile(self, tile_name):
-        info, img = util.load_lif(self.path, tile_name)
+        info, img = util.load_lif(self.path, tile_name, dtype=self.dtype,
+                                   channels=self.channels,
+                                   metadata_only=self.metadata_only)
         tile = model.Tile(info, img, source=tile_name)
         freq = extract_frequency(tile_name)
         return model.TileAnalysis(tile, name=tile_name, frequency=freq)
@@ -302,7 +556,9 @@ class CZITileReader(TileReader):
 
     def load_tile(self, tile_name):
         filename = self.path / f'{tile_name}.czi'
-        info, img = util.load_czi(filename)
+        info, img = util.load_czi(filename, dtype=self.dtype,
+                                   channels=self.channels,
+                                   metadata_only=self.metadata_only)
         tile = model.Tile(info, img, source=tile_name)
         freq = extract_frequency(tile_name)
         return model.TileAnalysis(tile, name=tile_name, frequency=freq)
@@ -315,3 +571,53 @@ class CZITileReader(TileReader):
 
     def save_path(self):
         return self.path
+
+
+def get_cochlea_reader_class(path):
+    '''
+    Return reader class for the cochlea dataset at path based on the format
+    '''
+    path = Path(path)
+    if path.is_dir():
+        if len(list(path.glob('*.czi'))) > 0:
+            return CZICochleaReader
+        elif len(list(path.glob('*.ims'))) > 0:
+            return IMSCochleaReader
+        elif len(list(path.glob('*piece_*.npy'))) > 0:
+            return ProcessedCochleaReader
+    elif path.suffix.lower() == '.lif':
+        return LIFCochleaReader
+    raise ValueError(f'Unrecognized format for {path}')
+
+
+def get_tile_reader_class(path):
+    '''
+    Return reader class for the tile (e.g., 63x) dataset at path based on the
+    format
+    '''
+    path = Path(path)
+    if path.suffix.lower() == '.lif':
+        return LIFTileReader
+    elif path.is_dir():
+        return CZITileReader
+    raise ValueError(f'Unrecognized format for {path}')
+
+
+def is_tile_dataset(path):
+    '''
+    True if the dataset at path contains tiles for cell counts (i.e., 63x
+    images) rather than an entire cochlea
+    '''
+    return '63x' in Path(path).stem
+
+
+def get_reader_class(path):
+    '''
+    Return reader class for the dataset at path
+
+    Datasets with "63x" in the name are read as tiles for cell counts. All
+    other datasets are read as an entire cochlea.
+    '''
+    if is_tile_dataset(path):
+        return get_tile_reader_class(path)
+    return get_cochlea_reader_class(path)
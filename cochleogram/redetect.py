@@ -0,0 +1,245 @@
+'''
+Re-run the cell detection for many cochleae without the GUI
+
+This runs `CellAnalysis.guess_cells` along the spirals saved with each piece
+(e.g., to compare detection parameters across a cohort). Only the band of
+image data surrounding the spirals is read, so a dataset can be processed
+without loading the entire cochlea into memory. Each dataset is processed in a
+separate process.
+
+The saved analysis is never modified. Instead, the analysis (with the cells
+replaced by the detected cells) is written to a variant file alongside it
+(e.g., ``cochlea_piece_1_analysis_guess-w2.5-s5.json``).
+
+    cochleogram-redetect "data/*.lif" --width 3 --spacing 6 --jobs 4
+'''
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from datetime import datetime, timezone
+import os
+from pathlib import Path
+import re
+import sys
+import time
+import traceback
+
+from cochleogram import analysis_file, readers
+from cochleogram.batch import expand_paths
+from cochleogram.config import CELLS
+
+
+#: Margin (in microns) added to the band loaded around the spiral in addition
+#: to twice the search width. This ensures that the smoothing used when
+#: detecting cells is not affected by the edge of the region.
+BAND_MARGIN = 10
+
+
+def default_variant(width, spacing, channel=None):
+    '''
+    Return name of the variant for the detection parameters
+    '''
+    variant = f'guess-w{width:g}-s{spacing:g}'
+    if channel is not None:
+        variant = f'{variant}-{channel}'
+    return variant
+
+
+def variant_filename(state_filename, variant):
+    '''
+    Return name of the file the variant of the saved analysis is written to
+    '''
+    if not re.match(r'^[\w.-]+$', variant) or variant.startswith('autosave'):
+        raise ValueError(f'Invalid variant name "{variant}"')
+    return state_filename.with_name(f'{state_filename.stem}_{variant}{state_filename.suffix}')
+
+
+def redetect_piece(reader, piece, stack_names, cell_types, width, spacing,
+                   channel=None):
+    '''
+    Detect cells along the spirals of the piece
+
+    Returns
+    -------
+    cells : dict
+        State of the detected cells for each cell type.
+    channels : dict
+        Channel used to detect each cell type.
+    '''
+    if channel is None:
+        channels = {c: piece.default_guess_channel(c) for c in cell_types}
+    else:
+        channels = {c: channel for c in cell_types}
+
+    band = reader.load_band(piece, stack_names, 2 * width + BAND_MARGIN,
+                            cell_types, sorted(set(channels.values())))
+    cells = {}
+    for c in cell_types:
+        band.guess_cells(c, width, spacing, channels[c], None)
+        cells[c] = band.cells[c].get_state()
+    return cells, channels
+
+
+def process_dataset(path, cell_types=None, width=2.5, spacing=5.0,
+                    channel=None, variant=None, force=False):
+    '''
+    Re-run cell detection for a single cochlea
+
+    Parameters
+    ----------
+    path : Path
+        Dataset to process.
+    cell_types : {None, list}
+        Cell types to detect. If None, all cell types with a spiral are
+        detected.
+    width : float
+        Width (in microns) along the spiral to search for cells.
+    spacing : float
+        Minimum spacing (in microns) of cells.
+    channel : {None, str}
+        Channel used to detect cells. If None, the channel that is selected
+        by default in the GUI is used for each cell type.
+    variant : {None, str}
+        Name of the variant the results are saved to. If None, the name is
+        generated from the parameters (see `default_variant`).
+    force : bool
+        If True, overwrite variants that are newer than the saved analysis.
+
+    Returns
+    -------
+    result : dict
+        Status ('done', 'skipped' or 'failed'), elapsed time, number of cells
+        detected in each piece and, if the dataset failed, the error message
+        and traceback.
+    '''
+    t0 = time.time()
+    result = {'path': str(path), 'status': 'done', 'error': None,
+              'traceback': None, 'cells': {}}
+    if variant is None:
+        variant = default_variant(width, spacing, channel)
+    try:
+        path = Path(path)
+        if readers.is_tile_dataset(path):
+            raise ValueError('Cells can only be re-detected for cochlea datasets')
+        reader = readers.get_cochlea_reader_class(path)(path)
+        # Preserve the dynamic range of the raw counts for finding the
+        # centroid of each cell.
+        reader.metadata_only = True
+        reader.dtype = 'uint16'
+        cochlea = reader.load_collection()
+        stack_names = reader.list_pieces()
+        reader.metadata_only = False
+
+        n_done = 0
+        for piece in cochlea:
+            state_filename = reader.find_state_file(piece)
+            if state_filename is None:
+                continue
+            filename = variant_filename(state_filename, variant)
+            if not force and filename.exists() and \
+                    filename.stat().st_mtime >= state_filename.stat().st_mtime:
+                continue
+            types = CELLS if cell_types is None else cell_types
+            types = [c for c in types if len(piece.spirals[c].interpolate()[0])]
+            if not types:
+                continue
+
+            cells, channels = redetect_piece(reader, piece,
+                                             stack_names[piece.piece], types,
+                                             width, spacing, channel)
+
+            state = reader.load_state(piece)
+            state['data']['cells'].update(cells)
+            state.setdefault('meta', {})['redetect'] = {
+                'source': state_filename.name,
+                'width': width,
+                'spacing': spacing,
+                'channels': channels,
+                'modified': datetime.now(timezone.utc).isoformat(),
+            }
+            analysis_file.save(filename, state)
+            result['cells'][piece.piece] = {c: len(v['x']) for c, v in cells.items()}
+            n_done += 1
+
+        if n_done == 0:
+            result['status'] = 'skipped'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+    result['elapsed'] = time.time() - t0
+    return result
+
+
+def process_datasets(paths, jobs=None, **kwargs):
+    '''
+    Process datasets in parallel, yielding the result for each dataset as it
+    completes (see `process_dataset`)
+    '''
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(process_dataset, p, **kwargs) for p in paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser('Re-run cell detection along the saved spirals of many cochleae')
+    parser.add_argument('paths', nargs='+', help='Datasets (LIF files or '
+                        'folders of CZI or IMS files). Glob patterns are '
+                        'expanded.')
+    parser.add_argument('--cells', nargs='+', choices=CELLS, help='Cell types '
+                        'to detect (default is all cell types with a spiral)')
+    parser.add_argument('--width', type=float, default=2.5,
+                        help='Width along spiral to search for cells (um)')
+    parser.add_argument('--spacing', type=float, default=5.0,
+                        help='Minimum spacing of cells (um)')
+    parser.add_argument('--channel', help='Channel used to detect cells '
+                        '(default is the same channel selected in the GUI)')
+    parser.add_argument('--variant', help='Name of the variant the results '
+                        'are saved to (default is generated from the '
+                        'parameters)')
+    parser.add_argument('--jobs', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Number of datasets to process in parallel')
+    parser.add_argument('--force', action='store_true', help='Overwrite '
+                        'variants that are newer than the saved analysis')
+    parser.add_argument('--traceback', action='store_true',
+                        help='Show full traceback for failed datasets')
+    args = parser.parse_args()
+
+    paths = expand_paths(args.paths)
+    if not paths:
+        parser.error('No datasets found')
+    variant = args.variant
+    if variant is None:
+        variant = default_variant(args.width, args.spacing, args.channel)
+    try:
+        variant_filename(Path('analysis.json'), variant)
+    except ValueError as e:
+        parser.error(str(e))
+
+    n = {'done': 0, 'skipped': 0, 'failed': 0}
+    t0 = time.time()
+    results = process_datasets(paths, args.jobs, cell_types=args.cells,
+                               width=args.width, spacing=args.spacing,
+                               channel=args.channel, variant=variant,
+                               force=args.force)
+    for i, result in enumerate(results):
+        n[result['status']] += 1
+        print(f'[{i+1}/{len(paths)}] {result["status"]:>7} '
+              f'{result["elapsed"]:7.1f}s {result["path"]}')
+        for piece, counts in result['cells'].items():
+            counts = ', '.join(f'{c} {v}' for c, v in counts.items())
+            print(f'    piece {piece}: {counts}')
+        if result['status'] == 'failed':
+            print(f'    {result["error"]}')
+            if args.traceback:
+                print(result['traceback'])
+        sys.stdout.flush()
+
+    print(f'{n["done"]} done, {n["skipped"]} skipped, {n["failed"]} failed '
+          f'in {time.time() - t0:.1f}s (saved as variant {variant})')
+    if n['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
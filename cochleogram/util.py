@@ -1,16 +1,21 @@
 import logging as log
 
+from collections import OrderedDict
 from importlib.metadata import version
 import json
+import os
 import re
 from pathlib import Path
 import pickle
 import subprocess
+import threading
 
 from matplotlib import path as mpath
 import numpy as np
 import pandas as pd
-from scipy import ndimage, optimize, signal
+from scipy import fft, ndimage, signal
+from scipy.spatial import cKDTree
+from skimage.registration import phase_cross_correlation
 
 from ndimage_enaml.util import expand_path
 
@@ -28,24 +33,85 @@ def get_region(spline, start, end):
 
 
 def make_plot_path(spline, regions, path_width=15):
+    '''
+    Create path outlining regions of spline
+
+    Parameters
+    ----------
+    spline : Points
+        Spline the regions are defined along.
+    regions : list
+        List of (start, end) tuples where start and end are (x, y) coordinates
+        of the start and end of the region. Each coordinate is snapped to the
+        nearest point on the spline.
+    path_width : float
+        Distance on either side of the spline to include in the outline.
+
+    Returns
+    -------
+    path : matplotlib.path.Path
+        Single path containing a closed polygon for each region.
+    '''
     if len(regions) == 0:
         verts = np.zeros((0, 2))
         return mpath.Path(verts, [])
 
-    path_data = []
-    for s, e in regions:
-        xs, ys = get_region(spline, s, e)
-        xe, ye = expand_path(xs, ys, 15)
-        xlb, xub = xe[0, :], xe[-1, :]
-        ylb, yub = ye[0, :], ye[-1, :]
-        xc = np.r_[xlb[1:], xub[::-1]]
-        yc = np.r_[ylb[1:], yub[::-1]]
-        path_data.append((mpath.Path.MOVETO, [xlb[0], ylb[0]]))
-        for x, y in zip(xc, yc):
-            path_data.append((mpath.Path.LINETO, (x, y)))
-        path_data.append((mpath.Path.CLOSEPOLY, [xlb[0], ylb[0]]))
-    codes, verts = zip(*path_data)
-    return mpath.Path(verts, codes)
+    xi, yi = spline.interpolate(resolution=0.001)
+    v = np.asarray(xi) + np.asarray(yi) * 1j
+    if len(v) == 0:
+        raise ValueError('Spline must have at least four nodes')
+
+    # Find start and end of each region on the spline
+    ends = np.asarray(regions, dtype=float).reshape((-1, 2, 2))
+    ends = ends[..., 0] + ends[..., 1] * 1j
+    i = np.abs(ends[..., np.newaxis] - v).argmin(axis=-1)
+    ilb, iub = i.min(axis=1), i.max(axis=1)
+    n = iub - ilb
+    if np.any(n < 2):
+        raise ValueError('Region too small')
+
+    # Angle perpendicular to the spline at each point. The first point of
+    # each region uses the angle of the following segment.
+    a = np.angle(np.diff(v)) + np.pi / 2
+    idx = np.concatenate([np.arange(lb, ub) for lb, ub in zip(ilb, iub)])
+    offsets = np.r_[0, np.cumsum(n)[:-1]]
+    a_idx = idx - 1
+    a_idx[offsets] = ilb
+    offset = path_width * np.exp(1j * a[a_idx])
+    lower = v[idx] - offset
+    upper = v[idx] + offset
+
+    # Each polygon traces the lower edge forwards and the upper edge backwards
+    # and then closes back to the start.
+    verts = []
+    codes = []
+    for o, m in zip(offsets, n):
+        j = np.arange(o, o + m)
+        verts.extend([lower[j], upper[j[::-1]], lower[j[:1]]])
+        c = np.full(2 * m + 1, mpath.Path.LINETO, dtype=mpath.Path.code_type)
+        c[0] = mpath.Path.MOVETO
+        c[-1] = mpath.Path.CLOSEPOLY
+        codes.append(c)
+    verts = np.concatenate(verts)
+    verts = np.c_[verts.real, verts.imag]
+    return mpath.Path(verts, np.concatenate(codes))
+
+
+def write_atomic(filename, data):
+    '''
+    Write data (text or bytes) to filename such that the file is never
+    partially written
+
+    The data is written to a temporary file that then replaces filename.
+    '''
+    filename = Path(filename)
+    tmp_filename = filename.with_name(f'{filename.name}.tmp')
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with tmp_filename.open(mode) as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_filename, filename)
 
 
 def argnearest(x, y, xa, ya):
@@ -70,7 +136,11 @@ def find_centroid(x, y, image, rx, ry, factor=4):
     for xi, yi in zip(x, y):
         ylb, yub = int(round(yi-ry)), int(round(yi+ry))
         xlb, xub = int(round(xi-rx)), int(round(xi+rx))
-        i = image[xlb:xub, ylb:yub].astype('int64')
+        # Normalize before raising to the power so that high bit-depth images
+        # do not overflow.
+        i = image[xlb:xub, ylb:yub].astype('float64')
+        if (i_max := i.max(initial=0)) > 0:
+            i /= i_max
         xc, yc = ndimage.center_of_mass(i ** factor)
         if np.isnan(xc) or np.isnan(yc):
             # If there are zero division errors (e.g., the entire ROI is zero),
@@ -110,7 +180,109 @@ def list_lif_stacks(filename):
     return [stack.name for stack in fh.get_iter_image()]
 
 
-def load_lif(filename, piece, max_xy=4096, dtype='uint8'):
+def placeholder_image(shape, dtype='uint8'):
+    '''
+    Return read-only image of zeros that does not allocate memory for the
+    pixels
+
+    Used when only the metadata (e.g., shape and extent) of a stack is needed.
+    '''
+    return np.broadcast_to(np.zeros((), dtype=dtype), tuple(shape))
+
+
+def is_placeholder(image):
+    '''
+    True if image was created by `placeholder_image`
+    '''
+    return image.size > 0 and not any(image.strides)
+
+
+def plane_slices(region, n_rows):
+    '''
+    Return row and column slices of an image plane as stored in the file
+    (rows ordered from top to bottom of the screen) that cover region (xlb,
+    xub, ylb, yub) of the returned stack (XY ordering with the origin in the
+    lower corner)
+    '''
+    xlb, xub, ylb, yub = region
+    return slice(n_rows - yub, n_rows - ylb), slice(xlb, xub)
+
+
+def get_channel_indices(channel_info, channels=None, emission_tolerance=5):
+    '''
+    Return indices of the channels to load
+
+    Parameters
+    ----------
+    channel_info : list of dict
+        Information about each channel in the file (in the format stored under
+        the `channels` key of the tile info).
+    channels : {None, list}
+        Channels to load. Each item is either the name of the channel (as
+        given in the filename) or the emission wavelength (in nm) of the
+        channel. Emission wavelengths can only be used if the channel info
+        includes the emission wavelength (i.e., CZI and IMS files). If None,
+        all channels are loaded.
+    emission_tolerance : float
+        Maximum difference (in nm) between the requested and actual emission
+        wavelength.
+
+    Returns
+    -------
+    indices : list of int
+        Indices of the channels to load in the order they are stored in the
+        file.
+    '''
+    if channels is None:
+        return list(range(len(channel_info)))
+    indices = set()
+    available = ', '.join(c['name'] for c in channel_info)
+    for channel in channels:
+        if isinstance(channel, str):
+            match = [i for i, c in enumerate(channel_info) if c['name'] == channel]
+        elif all(c.get('emission') is None for c in channel_info):
+            raise ValueError(f'Cannot select channel {channel:g} by emission '
+                             'wavelength since the emission wavelengths are '
+                             'not available for this dataset. Select the '
+                             f'channel by name instead (available channels '
+                             f'are {available})')
+        else:
+            match = [i for i, c in enumerate(channel_info) \
+                     if c.get('emission') is not None \
+                     and abs(c['emission'] - channel) <= emission_tolerance]
+        if not match:
+            raise ValueError(f'Channel {channel} not found (available channels are {available})')
+        indices.update(match)
+    return sorted(indices)
+
+
+def load_lif(filename, piece, max_xy=4096, dtype='uint8', channels=None,
+             metadata_only=False, region=None):
+    '''
+    Load stack from LIF file
+
+    Parameters
+    ----------
+    filename : {str, Path}
+        LIF file to load from.
+    piece : str
+        Name of stack in the file.
+    max_xy : int
+        Stacks larger than this along X or Y are downsampled.
+    dtype : {'uint8', 'uint16'}
+        If 'uint8', each channel is rescaled to the range 0 ... 255. If
+        'uint16', the raw counts (at the native bit depth of up to 16 bits)
+        are kept and no floating-point copy of the stack is created.
+    channels : {None, list}
+        Channels to load (see `get_channel_indices`).
+    metadata_only : bool
+        If True, the pixel data is not read and a placeholder image of the
+        same shape is returned (see `placeholder_image`).
+    region : {None, tuple of int}
+        If provided, only return region (xlb, xub, ylb, yub) of the stack in
+        pixels (after downsampling). The info still describes the full stack.
+        Note that when rescaling to uint8, the maximum of the region is used.
+    '''
     filename = Path(filename)
 
     from readlif.reader import LifFile
@@ -169,14 +341,38 @@ def load_lif(filename, piece, max_xy=4096, dtype='uint8'):
     nx = min(max_xy, pixels[0])
     ny = min(max_xy, pixels[1])
 
-    shape = [ny, nx, stack.dims[2], stack.channels]
-    img = np.empty(shape, dtype=np.float32)
-    for c in range(stack.channels):
-        for z, s in enumerate(stack.get_iter_z(c=c)):
-            if zoom != 1:
-                img[:, :, z, c] = ndimage.zoom(s, (zoom, zoom))
-            else:
-                img[:, :, z, c] = s
+    channel_info = []
+    for c in filename.stem.split('-')[2:]:
+        if c in ('63x', '20x', '10x', 'CellCount'):
+            continue
+        channel_info.append({'name': c})
+
+    # If the number of channels does not match what's in the filename, mark them as unknown.
+    if len(channel_info) != stack.channels:
+        channel_info = [{'name': f'Unknown {c+1}'} for c in range(stack.channels)]
+
+    # Only decode the requested channels.
+    indices = get_channel_indices(channel_info, channels)
+    channel_info = [channel_info[c] for c in indices]
+
+    # Raw counts are copied directly into the stack.
+    raw = dtype == 'uint16'
+    if region is None:
+        rows, cols = slice(None), slice(None)
+        shape = [ny, nx, stack.dims[2], len(indices)]
+    else:
+        rows, cols = plane_slices(region, ny)
+        xlb, xub, ylb, yub = region
+        shape = [yub - ylb, xub - xlb, stack.dims[2], len(indices)]
+    if metadata_only:
+        img = placeholder_image(shape, dtype)
+    else:
+        img = np.empty(shape, dtype=dtype if raw else np.float32)
+        for i, c in enumerate(indices):
+            for z, s in enumerate(stack.get_iter_z(c=c)):
+                if zoom != 1:
+                    s = ndimage.zoom(s, (zoom, zoom))
+                img[:, :, z, i] = np.asarray(s)[rows, cols]
 
     # Z-step was negative. Flip stack to fix this so that we always have a
     # positive Z-step.
@@ -184,16 +380,6 @@ def load_lif(filename, piece, max_xy=4096, dtype='uint8'):
         img = img[:, :, ::-1]
         voxel_size[2] = -voxel_size[2]
 
-    channels = []
-    for c in filename.stem.split('-')[2:]:
-        if c in ('63x', '20x', '10x', 'CellCount'):
-            continue
-        channels.append({'name': c})
-
-    # If the number of channels does not match what's in the filename, mark them as unknown.
-    if len(channels) != img.shape[-1]:
-        channels = [{'name': f'Unknown {c+1}'} for c in range(img.shape[-1])]
-
     # Note that all units should be in microns since this is the most logical
     # unit for a confocal analysis.
     info = {
@@ -210,20 +396,22 @@ def load_lif(filename, piece, max_xy=4096, dtype='uint8'):
         # implement specific tweaks for each confocal system we use.
         'system': system,
         'note': 'XY position from stage coords seem to be swapped',
-        'channels': channels,
+        'channels': channel_info,
         'rotation': rot,
     }
 
-    # Rescale to range 0 ... 1
-    img = img / img.max(axis=(0, 1, 2), keepdims=True)
-    if 'int' in dtype:
-        img *= 255
+    if not (raw or metadata_only):
+        # Rescale to range 0 ... 1
+        img = img / img.max(axis=(0, 1, 2), keepdims=True)
+        if 'int' in dtype:
+            img *= 255
+        img = img.astype(dtype)
 
-    # Coerce to dtype, reorder so that tile origin is in lower corner of image
-    # (makes it easer to reconcile with plotting), and swap axes from YX to XY.
-    # Final axes ordering should be XYZC where C is channel and origin of XY
-    # should be in lower corner of screen.
-    img = img.astype(dtype)[::-1].swapaxes(0, 1)
+    # Reorder so that tile origin is in lower corner of image (makes it easer
+    # to reconcile with plotting), and swap axes from YX to XY. Final axes
+    # ordering should be XYZC where C is channel and origin of XY should be in
+    # lower corner of screen.
+    img = img[::-1].swapaxes(0, 1)
 
     return info, img
 
@@ -310,16 +498,20 @@ def ims_image_info(fh):
     }
 
 
-def ims_image(fh, image_info):
-    data = []
-    for channel_node in fh['DataSet/ResolutionLevel 0/TimePoint 0'].values():
-        data.append(channel_node['Data'][:][..., np.newaxis])
-    data = np.concatenate(data, axis=-1)
+def ims_image(fh, image_info, indices=None, region=None):
+    '''
+    Read image data ordered from lowest to highest emission wavelength
+
+    If indices is provided, only the channels at these indices (relative to
+    the order by emission wavelength) are read. If region (xlb, xub, ylb, yub)
+    is provided, only that region of each channel is read.
+    '''
+    channel_nodes = list(fh['DataSet/ResolutionLevel 0/TimePoint 0'].values())
 
     # Figure out sort order of channels to go from lowest to highest
     # emission wavelength.
     emission = []
-    for i in range(data.shape[-1]):
+    for i in range(len(channel_nodes)):
         c_attrs = fh[f'DataSetInfo/Channel {i}'].attrs
         e = ims_extract_str(c_attrs, 'LSMEmissionWavelength')
         if '-' in e:
@@ -329,17 +521,39 @@ def ims_image(fh, image_info):
         else:
             e = float(e)
         emission.append(e)
-    i = np.argsort(emission)
+    order = np.argsort(emission)
+    if indices is not None:
+        order = order[indices]
+
+    # The data is padded to the chunk size, so only read the valid voxels (or
+    # the requested region).
     x, y, z = image_info['n_voxels']
-    return data[:z, :y, :x, i].swapaxes(0, 2)
+    xlb, xub, ylb, yub = (0, x, 0, y) if region is None else region
+    data = []
+    for i in order:
+        data.append(channel_nodes[i]['Data'][:z, ylb:yub, xlb:xub][..., np.newaxis])
+    data = np.concatenate(data, axis=-1)
+    return data.swapaxes(0, 2)
 
 
-def load_ims(filename):
+def load_ims(filename, channels=None, metadata_only=False, region=None):
     import h5py
+    filename = Path(filename)
     fh = h5py.File(filename, 'r')
     info = ims_image_info(fh)
-    img = ims_image(fh, info)
-    info['channels'] = channels_from_filename(filename, info['channel_config'])
+    channel_info = channels_from_filename(filename, info['channel_config'])
+    indices = get_channel_indices(channel_info, channels)
+    if metadata_only:
+        dtype = fh['DataSet/ResolutionLevel 0/TimePoint 0/Channel 0/Data'].dtype
+        if region is None:
+            shape = info['n_voxels'][:2]
+        else:
+            xlb, xub, ylb, yub = region
+            shape = [xub - xlb, yub - ylb]
+        img = placeholder_image(shape + [info['n_voxels'][2], len(indices)], dtype)
+    else:
+        img = ims_image(fh, info, indices, region)
+    info['channels'] = [channel_info[i] for i in indices]
     return info, img
 
 
@@ -397,7 +611,31 @@ def channels_from_filename(filename, channel_config):
     return channels
 
 
-def load_czi(filename, max_xy=1024, dtype='uint8'):
+def load_czi(filename, max_xy=1024, dtype='uint8', channels=None,
+             metadata_only=False, region=None):
+    '''
+    Load stack from CZI file
+
+    Parameters
+    ----------
+    filename : {str, Path}
+        CZI file to load.
+    max_xy : int
+        Currently unused.
+    dtype : {'uint8', 'uint16'}
+        If 'uint8', each channel is rescaled to the range 0 ... 255. If
+        'uint16', the raw counts (at the native bit depth of up to 16 bits)
+        are kept and no floating-point copy of the stack is created.
+    channels : {None, list}
+        Channels to load (see `get_channel_indices`).
+    metadata_only : bool
+        If True, the pixel data is not read and a placeholder image of the
+        same shape is returned (see `placeholder_image`).
+    region : {None, tuple of int}
+        If provided, only return region (xlb, xub, ylb, yub) of the mosaic in
+        pixels. The info still describes the full mosaic. Note that when
+        rescaling to uint8, the maximum of the region is used.
+    '''
     filename = Path(filename)
 
     from aicspylibczi import CziFile
@@ -439,8 +677,9 @@ def load_czi(filename, max_xy=1024, dtype='uint8'):
     # color, but I am leaving these in so that we can eventually do something
     # with them later.
     channel_config = czi_get_channel_config_dims(fh)
-    channel_order = [c[0] for c in channel_config]
-    channels = channels_from_filename(filename, channel_config)
+    channel_info = channels_from_filename(filename, channel_config)
+    indices = get_channel_indices(channel_info, channels)
+    channel_order = [channel_config[i][0] for i in indices]
 
     # Note that all units should be in microns since this is the most logical
     # unit for a confocal analysis.
@@ -454,35 +693,67 @@ def load_czi(filename, max_xy=1024, dtype='uint8'):
         'version': version('cochleogram'),
         # Reader used to read in data
         'reader': 'czi',
-        'channels': channels,
+        'channels': [channel_info[i] for i in indices],
         'rotation': rotation,
     }
 
+    # Only decode the requested channels (and region of the mosaic).
     dims = dict(zip(fh.dims, fh.size))
-    c_set = []
-    for c in range(dims['C']):
-        z_stack = []
-        if 'Z' in dims:
-            for z in range(dims['Z']):
-                i = fh.read_mosaic(Z=z, C=c).squeeze()
-                z_stack.append(i[..., np.newaxis])
+    read_kw = {}
+    if metadata_only or region is not None:
+        bbox = fh.get_mosaic_bounding_box()
+    if region is not None:
+        # The mosaic region is (x, y, w, h) with y increasing from the top.
+        xlb, xub, ylb, yub = region
+        read_kw['region'] = (bbox.x + xlb, bbox.y + bbox.h - yub, xub - xlb, yub - ylb)
+    if metadata_only:
+        if region is None:
+            shape = (bbox.h, bbox.w)
         else:
-            i = fh.read_mosaic(C=c).squeeze()
-            z_stack.append(i[..., np.newaxis])
-
-        c_set.append(np.concatenate(z_stack, axis=-1)[..., np.newaxis])
-    img = np.concatenate(c_set, axis=-1)
-    img = img / img.max(axis=(0, 1, 2))
-    if 'in' in dtype:
-        img *= 255
-
-    # Coerce to dtype, reorder so that tile origin is in lower corner of image
-    # (makes it easer to reconcile with plotting), and swap axes from YX to XY.
-    # Final axes ordering should be XYZC where C is channel and origin of XY
-    # should be in lower corner of screen. We also reorder the channels based
-    # on their emission wavelength (i.e., lowest to highest wavelength) since
-    # that's what's saved in the filename.
-    img = img.astype(dtype)[::-1, :, :, channel_order].swapaxes(0, 1)
+            shape = (yub - ylb, xub - xlb)
+        shape = shape + (dims.get('Z', 1), len(channel_order))
+        img = placeholder_image(shape, dtype)
+    elif dtype == 'uint16':
+        # Keep the raw counts. Each plane is copied directly into the stack so
+        # that no intermediate copies of the stack are created.
+        img = None
+        n_z = dims.get('Z', 1)
+        for ci, c in enumerate(channel_order):
+            for z in range(n_z):
+                if 'Z' in dims:
+                    plane = fh.read_mosaic(Z=z, C=c, **read_kw).squeeze()
+                else:
+                    plane = fh.read_mosaic(C=c, **read_kw).squeeze()
+                if img is None:
+                    shape = plane.shape + (n_z, len(channel_order))
+                    img = np.empty(shape, dtype=dtype)
+                img[..., z, ci] = plane
+    else:
+        c_set = []
+        for c in channel_order:
+            z_stack = []
+            if 'Z' in dims:
+                for z in range(dims['Z']):
+                    i = fh.read_mosaic(Z=z, C=c, **read_kw).squeeze()
+                    z_stack.append(i[..., np.newaxis])
+            else:
+                i = fh.read_mosaic(C=c, **read_kw).squeeze()
+                z_stack.append(i[..., np.newaxis])
+
+            c_set.append(np.concatenate(z_stack, axis=-1)[..., np.newaxis])
+        img = np.concatenate(c_set, axis=-1)
+        img = img / img.max(axis=(0, 1, 2))
+        if 'in' in dtype:
+            img *= 255
+        img = img.astype(dtype)
+
+    # Reorder so that tile origin is in lower corner of image (makes it easer
+    # to reconcile with plotting), and swap axes from YX to XY. Final axes
+    # ordering should be XYZC where C is channel and origin of XY should be in
+    # lower corner of screen. The channels were already read in order of their
+    # emission wavelength (i.e., lowest to highest wavelength) since that's
+    # what's saved in the filename.
+    img = img[::-1].swapaxes(0, 1)
     return info, img
 
 
@@ -525,28 +796,145 @@ def smooth_epochs(epochs):
     return np.array(smoothed)
 
 
-def arc_origin(x, y):
+def fit_circle(x, y, method='taubin', robust=False, n_iter=20, tol=1e-9):
+    '''
+    Fit circle to points
+
+    Parameters
+    ----------
+    x, y : array
+        Coordinates of the points.
+    method : {'taubin', 'kasa'}
+        Algebraic fit used. The Kasa fit is a linear least-squares fit that
+        underestimates the radius of short, noisy arcs. The Taubin fit is
+        nearly unbiased.
+    robust : bool
+        If True, refine the algebraic fit by iteratively reweighted least
+        squares so that the sum of the absolute deviations of the points from
+        the circle is minimized (i.e., outliers have less influence). The
+        refinement starts from the algebraic fit, so it may not recover from
+        a poor algebraic fit (e.g., short arcs with many outliers).
+    n_iter : int
+        Maximum number of iterations for the Taubin fit and the refinement.
+    tol : float
+        Relative tolerance used to stop iterating.
+
+    Returns
+    -------
+    xo, yo : float
+        Center of the circle.
+    r : float
+        Radius of the circle.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) < 3:
+        raise ValueError('At least three points are required to fit a circle')
+
+    # Center the points for numerical stability.
+    xm, ym = x.mean(), y.mean()
+    u, v = x - xm, y - ym
+    z = u ** 2 + v ** 2
+
+    if method == 'kasa':
+        a = np.c_[u, v, np.ones_like(u)]
+        (b0, b1, b2), _, rank, _ = np.linalg.lstsq(a, z, rcond=None)
+        if rank < 3:
+            raise ValueError('Points are collinear')
+        uo, vo = b0 / 2, b1 / 2
+        r2 = b2 + uo ** 2 + vo ** 2
+    elif method == 'taubin':
+        # Newton's method on the characteristic polynomial of the Taubin fit
+        # (Chernov, Circular and Linear Regression, 2010).
+        muu, mvv, muv = (u * u).mean(), (v * v).mean(), (u * v).mean()
+        muz, mvz, mzz = (u * z).mean(), (v * z).mean(), (z * z).mean()
+        mz = muu + mvv
+        cov = muu * mvv - muv ** 2
+        var_z = mzz - mz ** 2
+        a3 = 4 * mz
+        a2 = -3 * mz ** 2 - mzz
+        a1 = var_z * mz + 4 * cov * mz - muz ** 2 - mvz ** 2
+        a0 = muz * (muz * mvv - mvz * muv) + mvz * (mvz * muu - muz * muv) - var_z * cov
+        eta, p = 0, np.inf
+        for _ in range(n_iter):
+            p_prev, p = p, a0 + eta * (a1 + eta * (a2 + eta * a3))
+            if abs(p) > abs(p_prev):
+                eta = 0
+                break
+            eta_prev = eta
+            eta = eta - p / (a1 + eta * (2 * a2 + eta * 3 * a3))
+            if eta < 0:
+                eta = 0
+                break
+            if abs(eta - eta_prev) <= tol * abs(eta):
+                break
+        det = eta ** 2 - eta * mz + cov
+        if det == 0:
+            raise ValueError('Points are collinear')
+        uo = (muz * (mvv - eta) - mvz * muv) / det / 2
+        vo = (mvz * (muu - eta) - muz * muv) / det / 2
+        r2 = uo ** 2 + vo ** 2 + mz
+    else:
+        raise ValueError(f'Unrecognized method {method}')
+
+    if not np.isfinite(uo) or not np.isfinite(vo):
+        raise ValueError('Points are collinear')
+    r = np.sqrt(r2)
+
+    if robust:
+        # Gauss-Newton on the geometric distance with weights that are
+        # inversely proportional to the absolute residuals, which converges
+        # toward the least absolute deviation fit.
+        eps = 1e-6 * r
+        for _ in range(n_iter):
+            du, dv = u - uo, v - vo
+            d = np.sqrt(du ** 2 + dv ** 2)
+            d = np.maximum(d, eps)
+            res = d - r
+            w = 1 / np.sqrt(np.maximum(np.abs(res), eps))
+            jac = np.c_[-du / d, -dv / d, -np.ones_like(d)]
+            step, *_ = np.linalg.lstsq(jac * w[:, np.newaxis], -res * w, rcond=None)
+            uo, vo, r = uo + step[0], vo + step[1], r + step[2]
+            if np.abs(step).max() <= tol * r:
+                break
+
+    return uo + xm, vo + ym, r
+
+
+def arc_origin(x, y, robust=False):
     '''
     Determine most likely origin for arc
+
+    The origin is the center of the circle fit to the arc (see
+    `fit_circle`).
     '''
-    def _fn(origin, xa, ya):
-        xo, yo = origin
-        d = np.sqrt((xa - xo) ** 2 + (ya - yo) ** 2)
-        return np.sum(np.abs(d - d.mean()))
-    result = optimize.minimize(_fn, (x.mean(), y.mean()), (x, y))
-    return result.x
+    xo, yo, _ = fit_circle(x, y, robust=robust)
+    return np.array([xo, yo])
 
 
-def arc_direction(x, y):
+def arc_direction(x, y, min_ratio=3):
     '''
     Given arc defined by x and y, determine direction of arc
 
+    The direction is the side of the chord joining the ends of the arc that
+    the arc bulges toward. This does not require the origin of the arc to be
+    found, so it is fast and stable for nearly straight arcs. The bulge is
+    measured by fitting a parabola (as a function of the distance along the
+    arc) to the deviation of the vertices from the chord. The height of the
+    parabola at the midpoint of the arc (i.e., the sagitta) must exceed the
+    RMS residual of the fit by `min_ratio` for the direction to be
+    determined.
+
     Parameters
     ----------
     x : array
         x coordinates of vertices defining arc
     y : array
         y coordinates of vertices defining arc
+    min_ratio : float
+        Minimum ratio of the sagitta to the RMS residual required to determine
+        the direction. Arcs that are too straight (or too irregular) to
+        determine the direction raise a ValueError.
 
     Returns
     -------
@@ -554,12 +942,25 @@ def arc_direction(x, y):
         -1 if arc sweeps clockwise (i.e., change in angle of vertices relative
         to origin is negative), +1 if arc sweeps counter-clockwise
     '''
-    xo, yo = arc_origin(x, y)
-    angles = np.unwrap(np.arctan2(y-yo, x-xo))
-    sign = np.sign(np.diff(angles))
-    if np.any(sign != sign[0]):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) < 3:
         raise ValueError('Cannot determine direction of arc')
-    return sign[0]
+    u, v = x - x[0], y - y[0]
+    chord = np.hypot(u[-1], v[-1])
+    length = np.sum(np.hypot(np.diff(x), np.diff(y)))
+    if chord == 0 or length == 0:
+        raise ValueError('Cannot determine direction of arc')
+    # Signed distance of each vertex from the chord (positive to the left).
+    d = (u[-1] * v - v[-1] * u) / chord
+    s = np.r_[0, np.cumsum(np.hypot(np.diff(x), np.diff(y)))] / length
+    b = 4 * s * (1 - s)
+    sagitta = np.sum(d * b) / np.sum(b * b)
+    rms = np.sqrt(np.mean((d - sagitta * b) ** 2))
+    if abs(sagitta) <= min_ratio * rms:
+        raise ValueError('Cannot determine direction of arc')
+    # Counter-clockwise arcs bulge to the right of the chord.
+    return -int(np.sign(sagitta))
 
 
 def guess_cells(tile, spiral, width, spacing, channel, z_slice):
@@ -571,7 +972,13 @@ def guess_cells(tile, spiral, width, spacing, channel, z_slice):
     # Map to centroid
     xni, yni = tile.to_indices(xn, yn)
 
-    image = tile.get_image(channel, z_slice).max(axis=-1)
+    # Use the raw intensity (rather than the display-scaled image) so that the
+    # centroid uses the full dynamic range of the channel.
+    image = tile.image[..., tile.channel_names.index(channel)]
+    if z_slice is not None:
+        image = image[:, :, z_slice]
+    if image.ndim == 3:
+        image = image.max(axis=2)
     x_radius = tile.to_indices_delta(width, 'x')
     y_radius = tile.to_indices_delta(width, 'y')
     log.info('Searching for centroid within %ix%i pixels of spiral', x_radius, y_radius)
@@ -580,3 +987,610 @@ def guess_cells(tile, spiral, width, spacing, channel, z_slice):
     log.info('Shifted points up to %.0f x %.0f microns',
                 np.max(np.abs(xnc - xn)), np.max(np.abs(ync - yn)))
     return xnc, ync
+
+
+def get_voxel_coords(tile, points):
+    '''
+    Convert XY coordinates (in microns) to voxel coordinates of the tile
+
+    Parameters
+    ----------
+    tile : Tile
+        Tile to find the voxel coordinates in.
+    points : array
+        Nx2 array of XY coordinates (in microns).
+
+    Returns
+    -------
+    coords : array
+        Nx2 array of (fractional) XY voxel coordinates in the unrotated frame
+        of the tile.
+    '''
+    voxel_size = np.array(tile.info['voxel_size'][:2])
+    lower = np.array(tile.extent[::2][:2])
+    points = tile.get_image_transform().inverted().transform(points)
+    return (points - lower) / voxel_size
+
+
+def get_band_bounds(tile, spiral, width):
+    '''
+    Return bounding box of the band surrounding the spiral in a tile
+
+    Only the portion of the spiral within `width` of the tile is considered,
+    so that the bounding box of a curved spiral does not extend across the
+    entire tile.
+
+    Parameters
+    ----------
+    tile : Tile
+        Tile to find the band in.
+    spiral : array
+        Nx2 array of XY coordinates (in microns) along the spiral.
+    width : float
+        Half-width (in microns) of the band.
+
+    Returns
+    -------
+    bounds : tuple of int
+        Bounding box (xlb, xub, ylb, yub) of the band in voxels in the
+        unrotated frame of the tile. The bounds are not clipped to the image.
+        If the band does not overlap the tile, the bounding box is empty.
+    '''
+    voxel_size = np.array(tile.info['voxel_size'])
+    xi, yi = get_voxel_coords(tile, spiral).T
+    xpad = width / voxel_size[0]
+    ypad = width / voxel_size[1]
+    nx, ny = tile.image.shape[:2]
+    m = (xi >= -xpad) & (xi <= nx + xpad) & (yi >= -ypad) & (yi <= ny + ypad)
+    if not np.any(m):
+        return 0, 0, 0, 0
+    xi, yi = xi[m], yi[m]
+    return (int(np.floor(xi.min() - xpad)), int(np.ceil(xi.max() + xpad)),
+            int(np.floor(yi.min() - ypad)), int(np.ceil(yi.max() + ypad)))
+
+
+def iter_chunks(n, size, overlap, lb=0, ub=None):
+    '''
+    Split the region lb:ub of an axis of length n into chunks of the given size
+
+    Yields tuples of (core_lb, core_ub, lb, ub) where core_lb:core_ub is the
+    region of the axis the chunk is responsible for and lb:ub is the core
+    region padded by `overlap` on each side (clipped to the axis).
+    '''
+    if ub is None:
+        ub = n
+    for core_lb in range(lb, ub, size):
+        core_ub = min(core_lb + size, ub)
+        yield core_lb, core_ub, max(core_lb - overlap, 0), min(core_ub + overlap, n)
+
+
+def find_puncta(image, footprint, sigma=None, threshold=0, bounds=None,
+                chunk_size=(256, 256, 32), spiral=None, width=None):
+    '''
+    Find local maxima in a 3D (XYZ) image
+
+    The image is processed in overlapping chunks so that only a small block of
+    the image is converted to floating-point at any one time. The overlap is
+    large enough that the result is identical to processing the full image in
+    one pass.
+
+    Parameters
+    ----------
+    image : array
+        XYZ image (e.g., a single channel of a tile).
+    footprint : tuple of int
+        Size of the neighborhood (in voxels) along each axis used to identify
+        local maxima.
+    sigma : {None, tuple of float}
+        If provided, standard deviation (in voxels) of the Gaussian used to
+        smooth the image before searching for maxima.
+    threshold : float
+        Minimum (smoothed) intensity of a local maximum.
+    bounds : {None, tuple of int}
+        Restrict search to region of image defined by (xlb, xub, ylb, yub) in
+        voxels. The image surrounding the region is used when smoothing, so
+        the maxima found are the same as those found in this region when
+        searching the full image.
+    chunk_size : tuple of int
+        Size of each chunk (in voxels) along the XYZ axes.
+    spiral : {None, array}
+        Nx2 array of XY voxel coordinates along the spiral (see
+        `get_voxel_coords`). If provided, chunks that are further than `width`
+        voxels from the spiral are skipped. Maxima in the remaining chunks are
+        not filtered by their distance to the spiral.
+    width : {None, float}
+        Distance (in voxels) from the spiral to search.
+
+    Returns
+    -------
+    indices : array
+        N x 3 array of XYZ voxel indices of each maximum.
+    intensity : array
+        Intensity of each maximum.
+    '''
+    # A maximum in the core of a chunk depends on the smoothed image within
+    # the footprint, which in turn depends on the image within the support of
+    # the Gaussian (truncated at 4 standard deviations).
+    footprint = np.asarray(footprint, dtype='i')
+    overlap = footprint // 2 + 1
+    if sigma is not None:
+        overlap = overlap + np.ceil(np.asarray(sigma) * 4).astype('i')
+
+    if bounds is None:
+        bounds = 0, image.shape[0], 0, image.shape[1]
+    xlb, xub, ylb, yub = bounds
+    xlb, ylb = max(xlb, 0), max(ylb, 0)
+    xub, yub = min(xub, image.shape[0]), min(yub, image.shape[1])
+
+    indices, intensity = [], []
+    if (xub <= xlb) or (yub <= ylb):
+        return np.zeros((0, 3), dtype='i'), np.zeros(0)
+
+    # The chunks cover the region within the bounds, but are padded using the
+    # image outside the bounds so that maxima near the edge of the bounds are
+    # the same as when searching the full image.
+    regions = [(xlb, xub), (ylb, yub), (0, image.shape[2])]
+    chunks = [list(iter_chunks(n, s, o, lb, ub)) for n, s, o, (lb, ub) in \
+              zip(image.shape, chunk_size, overlap, regions)]
+    if spiral is not None:
+        spiral = np.asarray(spiral)
+    for xc in chunks[0]:
+        for yc in chunks[1]:
+            if spiral is not None:
+                # Distance from each point on the spiral to the nearest voxel
+                # in the core of the chunk.
+                dx = np.maximum(np.maximum(xc[0] - spiral[:, 0], spiral[:, 0] - (xc[1] - 1)), 0)
+                dy = np.maximum(np.maximum(yc[0] - spiral[:, 1], spiral[:, 1] - (yc[1] - 1)), 0)
+                if not np.any(dx ** 2 + dy ** 2 <= width ** 2):
+                    continue
+            for zc in chunks[2]:
+                s = tuple(np.s_[lb:ub] for _, _, lb, ub in (xc, yc, zc))
+                chunk = image[s].astype('float32')
+                if sigma is not None:
+                    chunk = ndimage.gaussian_filter(chunk, sigma, mode='nearest')
+                chunk_max = ndimage.maximum_filter(chunk, size=footprint, mode='nearest')
+                i = np.argwhere((chunk == chunk_max) & (chunk >= threshold) & (chunk > 0))
+                v = chunk[tuple(i.T)]
+
+                # Discard maxima that fall in the overlap between chunks since
+                # they are handled by the neighboring chunk.
+                offset = np.array([c[2] for c in (xc, yc, zc)])
+                core_lb = np.array([c[0] for c in (xc, yc, zc)])
+                core_ub = np.array([c[1] for c in (xc, yc, zc)])
+                i += offset
+                m = np.all((i >= core_lb) & (i < core_ub), axis=1)
+                indices.append(i[m])
+                intensity.append(v[m])
+
+    if not indices:
+        return np.zeros((0, 3), dtype='i'), np.zeros(0)
+    return np.concatenate(indices), np.concatenate(intensity)
+
+
+def suppress_duplicates(points, intensity, radius):
+    '''
+    Remove points that lie within radius of a brighter point
+
+    Returns mask indicating which points should be kept.
+    '''
+    keep = np.ones(len(points), dtype=bool)
+    if len(points) == 0:
+        return keep
+    tree = cKDTree(points)
+    # Ties (e.g., maxima on a plateau) are broken by position so that the
+    # result does not depend on the order of the points.
+    for i in np.lexsort(tuple(np.asarray(points).T[::-1]) + (-np.asarray(intensity),)):
+        if not keep[i]:
+            continue
+        for j in tree.query_ball_point(points[i], radius):
+            if j != i:
+                keep[j] = False
+    return keep
+
+
+def assign_nearest(x, y, xn, yn, max_distance=np.inf):
+    '''
+    Assign each point (x, y) to the nearest node (xn, yn)
+
+    Returns index of nearest node for each point. Points that are further
+    than max_distance from all nodes are assigned an index of -1.
+    '''
+    if len(xn) == 0 or len(x) == 0:
+        return np.full(len(x), -1, dtype='i')
+    tree = cKDTree(np.c_[xn, yn])
+    d, i = tree.query(np.c_[x, y], distance_upper_bound=max_distance)
+    i[~np.isfinite(d)] = -1
+    return i
+
+
+def downsample(image, factor):
+    '''
+    Downsample 2D image by averaging blocks of factor x factor pixels
+
+    Pixels that do not fill a complete block at the upper edges of the image
+    are discarded.
+    '''
+    if factor == 1:
+        return image
+    nx, ny = image.shape[0] // factor, image.shape[1] // factor
+    image = image[:nx * factor, :ny * factor]
+    return image.reshape((nx, factor, ny, factor)).mean(axis=(1, 3))
+
+
+def halve_xy(image):
+    '''
+    Downsample image by a factor of two along the first two (XY) axes
+
+    Blocks of 2 x 2 pixels are averaged. If the image has an odd number of
+    pixels along an axis, the last row (or column) is repeated so that no data
+    is discarded. The data type of the image is preserved.
+    '''
+    if image.shape[0] % 2 or image.shape[1] % 2:
+        pad = [(0, image.shape[0] % 2), (0, image.shape[1] % 2)]
+        pad += [(0, 0)] * (image.ndim - 2)
+        image = np.pad(image, pad, mode='edge')
+    nx, ny = image.shape[0] // 2, image.shape[1] // 2
+    result = image.reshape((nx, 2, ny, 2) + image.shape[2:]) \
+        .mean(axis=(1, 3), dtype='float32')
+    if np.issubdtype(image.dtype, np.integer):
+        result = result.round()
+    return result.astype(image.dtype)
+
+
+def pad_region(region, fraction):
+    '''
+    Expand region (xlb, xub, ylb, yub) by a fraction of its size on each side
+    '''
+    xlb, xub, ylb, yub = region
+    dx = (xub - xlb) * fraction
+    dy = (yub - ylb) * fraction
+    return xlb - dx, xub + dx, ylb - dy, yub + dy
+
+
+def region_contains(outer, inner):
+    '''
+    True if region `inner` lies entirely within region `outer`
+
+    Regions are specified as (xlb, xub, ylb, yub). If `outer` is None, it is
+    treated as empty.
+    '''
+    if outer is None:
+        return False
+    return outer[0] <= inner[0] and inner[1] <= outer[1] and \
+        outer[2] <= inner[2] and inner[3] <= outer[3]
+
+
+def in_region(x, y, region):
+    '''
+    Return mask indicating which points fall within region (xlb, xub, ylb,
+    yub). If region is None, all points are included.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if region is None:
+        return np.ones(x.shape, dtype=bool)
+    xlb, xub, ylb, yub = region
+    return (x >= xlb) & (x <= xub) & (y >= ylb) & (y <= yub)
+
+
+def clip_points(x, y, region):
+    '''
+    Discard points that fall outside of region
+    '''
+    mask = in_region(x, y, region)
+    return np.asarray(x)[mask], np.asarray(y)[mask]
+
+
+def clip_line(x, y, region):
+    '''
+    Discard segments of line that fall entirely outside of region
+
+    Segments that cross the edge of the region are kept. Where segments are
+    discarded, a single NaN is inserted so that the line is broken at that
+    point when plotted.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    mask = in_region(x, y, region)
+    if mask.all():
+        return x, y
+    # Keep neighbors of points in the region so that segments crossing the
+    # edge of the region are drawn.
+    keep = mask.copy()
+    keep[1:] |= mask[:-1]
+    keep[:-1] |= mask[1:]
+    # Keep the first point of each discarded run and replace it with NaN.
+    first = ~keep & np.r_[True, keep[:-1]]
+    x = np.where(keep, x, np.nan)[keep | first]
+    y = np.where(keep, y, np.nan)[keep | first]
+    return x, y
+
+
+def get_overlap(ref_origin, ref_shape, mov_origin, mov_shape, voxel_size):
+    '''
+    Find region where two images overlap given their current position
+
+    Parameters
+    ----------
+    ref_origin, mov_origin : array
+        XY coordinate of the lower corner of each image (in microns).
+    ref_shape, mov_shape : tuple
+        Shape of each image (in pixels).
+    voxel_size : array
+        XY size of a pixel (in microns). Both images must have the same voxel
+        size.
+
+    Returns
+    -------
+    overlap : {None, tuple}
+        None if the images do not overlap. Otherwise, tuple of (ref_lb,
+        mov_lb, n) where ref_lb and mov_lb are the pixel indices of the lower
+        corner of the overlapping region in each image and n is the size of
+        the overlapping region in pixels.
+    '''
+    ref_origin = np.asarray(ref_origin)
+    mov_origin = np.asarray(mov_origin)
+    lb = np.maximum(ref_origin, mov_origin)
+    ub = np.minimum(ref_origin + np.asarray(ref_shape[:2]) * voxel_size,
+                    mov_origin + np.asarray(mov_shape[:2]) * voxel_size)
+    ref_lb = np.round((lb - ref_origin) / voxel_size).astype('i')
+    mov_lb = np.round((lb - mov_origin) / voxel_size).astype('i')
+    n = np.floor((ub - lb) / voxel_size).astype('i')
+    n = np.minimum(n, np.asarray(ref_shape[:2]) - ref_lb)
+    n = np.minimum(n, np.asarray(mov_shape[:2]) - mov_lb)
+    if np.any(n <= 0):
+        return None
+    return ref_lb, mov_lb, n
+
+
+def coarse_spectrum(image, lb, n, factor):
+    '''
+    Downsample region of image and compute its Fourier transform
+
+    Parameters
+    ----------
+    image : 2D array
+        Image to extract region from.
+    lb : array
+        Lower corner (in pixels) of region.
+    n : array
+        Size (in pixels) of region.
+    factor : int
+        Downsampling factor.
+
+    Returns
+    -------
+    coarse : 2D array
+        Downsampled region.
+    spectrum : 2D array
+        Fourier transform of downsampled region.
+    '''
+    coarse = downsample(image[lb[0]:lb[0]+n[0], lb[1]:lb[1]+n[1]], factor)
+    return coarse, fft.fft2(coarse)
+
+
+def _brightest_window(image, window):
+    '''
+    Return lower corner of the window x window region with the highest mean
+    intensity.
+    '''
+    window = np.minimum(window, image.shape)
+    smoothed = ndimage.uniform_filter(image, window, mode='constant')
+    # Restrict to centers where the full window fits within the image.
+    lb = window // 2
+    ub = np.array(image.shape) - (window - window // 2) + 1
+    smoothed = smoothed[lb[0]:ub[0], lb[1]:ub[1]]
+    return np.array(np.unravel_index(smoothed.argmax(), smoothed.shape))
+
+
+def correlation(a, b):
+    '''
+    Pearson correlation between two images of the same shape
+    '''
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = np.sqrt(np.sum(a ** 2) * np.sum(b ** 2))
+    if denom == 0:
+        return 0
+    return float(np.sum(a * b) / denom)
+
+
+def register_overlap(ref_image, ref_origin, mov_image, mov_origin, voxel_size,
+                     downsample_factor=4, window=256, min_overlap=32,
+                     ref_spectrum=None, mov_spectrum=None):
+    '''
+    Register two images using only the region where they are predicted to overlap
+
+    The shift is first estimated on a downsampled copy of the overlapping
+    region and then refined at full resolution in a small window centered on
+    the brightest part of the overlap.
+
+    Parameters
+    ----------
+    ref_image, mov_image : 2D array
+        Reference and moving image.
+    ref_origin, mov_origin : array
+        Current XY coordinate of the lower corner of each image (in microns).
+    voxel_size : array
+        XY size of a pixel (in microns).
+    downsample_factor : int
+        Factor to downsample the overlapping region by for the coarse
+        estimate.
+    window : int
+        Size (in pixels) of the full-resolution window used to refine the
+        coarse estimate.
+    min_overlap : int
+        Minimum size (in pixels) of the overlapping region along each axis.
+    ref_spectrum, mov_spectrum : {None, callable}
+        Function with the same signature as `coarse_spectrum` (minus the
+        image) used to compute the downsampled overlap and its Fourier
+        transform. Provide these to reuse results cached from a previous call.
+        If None, `coarse_spectrum` is used.
+
+    Returns
+    -------
+    result : {None, tuple}
+        None if the images do not overlap sufficiently. Otherwise, tuple of
+        (origin, confidence) where origin is the new XY coordinate of the
+        lower corner of the moving image and confidence is the correlation
+        between the two images in the refinement window after alignment.
+    '''
+    voxel_size = np.asarray(voxel_size[:2])
+    overlap = get_overlap(ref_origin, ref_image.shape, mov_origin,
+                          mov_image.shape, voxel_size)
+    if overlap is None:
+        return None
+    ref_lb, mov_lb, n = overlap
+    if np.any(n < min_overlap):
+        return None
+
+    if ref_spectrum is None:
+        ref_spectrum = lambda *args: coarse_spectrum(ref_image, *args)
+    if mov_spectrum is None:
+        mov_spectrum = lambda *args: coarse_spectrum(mov_image, *args)
+
+    # Coarse estimate of shift on downsampled overlap.
+    factor = int(max(1, min(downsample_factor, n.min() // min_overlap)))
+    ref_coarse, ref_fft = ref_spectrum(ref_lb, n, factor)
+    _, mov_fft = mov_spectrum(mov_lb, n, factor)
+    coarse_shift, _, _ = phase_cross_correlation(ref_fft, mov_fft, space='fourier')
+    coarse_shift = np.round(coarse_shift * factor).astype('i')
+
+    # Region of the reference crop that is covered by the moving crop once
+    # the coarse shift is applied.
+    valid_lb = np.maximum(coarse_shift, 0)
+    valid_ub = np.minimum(n, n + coarse_shift)
+    if np.any((valid_ub - valid_lb) < min_overlap):
+        return None
+
+    # Refine using the brightest window of the valid region.
+    ref_crop = ref_image[ref_lb[0]:ref_lb[0]+n[0], ref_lb[1]:ref_lb[1]+n[1]]
+    mov_crop = mov_image[mov_lb[0]:mov_lb[0]+n[0], mov_lb[1]:mov_lb[1]+n[1]]
+    w = np.minimum(window, valid_ub - valid_lb)
+    valid_coarse = ref_coarse[valid_lb[0]//factor:valid_ub[0]//factor,
+                              valid_lb[1]//factor:valid_ub[1]//factor]
+    w_lb = valid_lb + _brightest_window(valid_coarse, np.maximum(w // factor, 1)) * factor
+    w_lb = np.minimum(w_lb, valid_ub - w)
+    ref_window = ref_crop[w_lb[0]:w_lb[0]+w[0], w_lb[1]:w_lb[1]+w[1]]
+    m_lb = w_lb - coarse_shift
+    mov_window = mov_crop[m_lb[0]:m_lb[0]+w[0], m_lb[1]:m_lb[1]+w[1]]
+    fine_shift, _, _ = phase_cross_correlation(ref_window, mov_window)
+    shift = coarse_shift + fine_shift
+
+    # Confidence of the final alignment.
+    i = np.round(fine_shift).astype('i')
+    a_lb = np.maximum(i, 0)
+    a_ub = np.minimum(w, w + i)
+    confidence = correlation(
+        ref_window[a_lb[0]:a_ub[0], a_lb[1]:a_ub[1]],
+        mov_window[a_lb[0]-i[0]:a_ub[0]-i[0], a_lb[1]-i[1]:a_ub[1]-i[1]],
+    )
+
+    origin = np.asarray(ref_origin) + (ref_lb - mov_lb + shift) * voxel_size
+    return origin, confidence
+
+
+def solve_tile_positions(positions, constraints, anchor=0, prior_weight=1e-6):
+    '''
+    Find tile positions that best satisfy a set of pairwise offsets
+
+    Solves the weighted least-squares problem where each constraint specifies
+    the desired offset between the positions of two tiles. A weak prior pulls
+    each tile towards its current position so that tiles that are not
+    connected to the anchor by any constraint are left in place, and the
+    anchor tile is held fixed.
+
+    Parameters
+    ----------
+    positions : array
+        N x 2 array of the current XY position of each tile.
+    constraints : list of tuple
+        Each constraint is a tuple of (i, j, offset, weight) indicating that
+        the position of tile j minus the position of tile i should equal
+        offset.
+    anchor : int
+        Index of tile whose position is held fixed.
+    prior_weight : float
+        Weight of prior pulling tiles towards their current position.
+
+    Returns
+    -------
+    positions : array
+        N x 2 array of the new XY position of each tile.
+    '''
+    positions = np.asarray(positions, dtype=float)
+    n = len(positions)
+    a, b, w = [], [], []
+    for i, j, offset, weight in constraints:
+        row = np.zeros(n)
+        row[i] = -1
+        row[j] = 1
+        a.append(row)
+        b.append(offset)
+        w.append(weight)
+
+    # Prior and anchor
+    for i in range(n):
+        row = np.zeros(n)
+        row[i] = 1
+        a.append(row)
+        b.append(positions[i])
+        w.append(1e3 if i == anchor else prior_weight)
+
+    w = np.sqrt(np.asarray(w))[:, np.newaxis]
+    a = np.asarray(a) * w
+    b = np.asarray(b) * w
+    result, *_ = np.linalg.lstsq(a, b, rcond=None)
+    return result
+
+
+class LRUCache:
+    '''
+    Thread-safe cache that discards the least recently used item when full
+
+    Parameters
+    ----------
+    max_items : int
+        Maximum number of items to keep.
+    max_bytes : {None, int}
+        Maximum total size (as reported by the `nbytes` attribute of each item)
+        of the items to keep. If None, size is not limited. The most recently
+        added item is always kept, even if it exceeds the limit.
+    '''
+
+    def __init__(self, max_items=16, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= getattr(self._items.pop(key), 'nbytes', 0)
+            self._items[key] = value
+            self.nbytes += getattr(value, 'nbytes', 0)
+            while len(self._items) > 1 and (
+                    len(self._items) > self.max_items or
+                    (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= getattr(old, 'nbytes', 0)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
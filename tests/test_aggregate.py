@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from cochleogram import aggregate, model
+
+
+def test_estimate_missing():
+    s = np.arange(0, 200, 10.0)
+    np.testing.assert_allclose(aggregate.estimate_missing(s, np.array([])), [])
+
+    # Two cells are missing from the gap between 40 and 70.
+    s = np.r_[np.arange(0, 50, 10.0), np.arange(70, 200, 10.0)]
+    np.testing.assert_allclose(aggregate.estimate_missing(s, np.array([])), [50, 60])
+
+    # Gaps within the typical spacing (max_gap) are not counted.
+    s = np.r_[np.arange(0, 50, 10.0), np.arange(54, 200, 10.0)]
+    np.testing.assert_allclose(aggregate.estimate_missing(s, np.array([])), [])
+
+    # Gaps overlapping an excluded region are ignored.
+    s = np.r_[np.arange(0, 50, 10.0), np.arange(70, 200, 10.0)]
+    np.testing.assert_allclose(aggregate.estimate_missing(s, np.array([55.0])), [])
+
+    assert len(aggregate.estimate_missing(np.array([0, 10.0]), np.array([]))) == 0
+
+
+def make_cochlea():
+    # IHC spiral along an arc with a cell every 10 microns. Three cells are
+    # missing, one is supernumerary and the cells at the end of the arc are
+    # in an excluded region.
+    radius, sweep = 2000, np.deg2rad(60)
+    theta = np.linspace(0, sweep, 13)
+    piece = model.Piece([], 1, copied_from='')
+    spiral = piece.spirals['IHC']
+    spiral.set_nodes(radius * np.cos(theta), radius * np.sin(theta))
+
+    spacing = 10 / radius
+    theta = np.arange(spacing / 2, sweep, spacing)
+    keep = np.ones(len(theta), dtype=bool)
+    keep[50:53] = False
+    theta = theta[keep]
+    x, y = (radius - 5) * np.cos(theta), (radius - 5) * np.sin(theta)
+    cells = piece.cells['IHC']
+    cells.set_nodes(x, y)
+    cells.labels = {(cells.x[100], cells.y[100]): {'supernumerary'}}
+
+    end = np.deg2rad(55)
+    spiral.exclude = [[[radius * np.cos(end), radius * np.sin(end)],
+                       [radius * np.cos(sweep), radius * np.sin(sweep)]]]
+    n_excluded = int((theta >= end).sum())
+    return model.Cochlea([piece]), radius * sweep * 1e-3, len(theta), n_excluded
+
+
+def test_summarize_cochlea():
+    cochlea, length_mm, n_cells, n_excluded = make_cochlea()
+    bands, cells = aggregate.summarize_cochlea(cochlea, freq_start=2,
+                                               freq_end=128)
+    ihc = bands.query('cell_type == "IHC"')
+    assert ihc['length_mm'].sum() + ihc['excluded_mm'].sum() == \
+        pytest.approx(length_mm, rel=1e-3)
+    assert ihc['excluded_mm'].sum() == pytest.approx(length_mm / 12, rel=0.02)
+    assert ihc['n_cells'].sum() == n_cells - n_excluded
+    assert ihc['n_supernumerary'].sum() == 1
+    assert ihc['n_missing'].sum() == 3
+
+    # Cell types without a spiral are not analyzed.
+    ohc = bands.query('cell_type == "OHC1"')
+    assert ohc['length_mm'].sum() == 0
+    assert ohc['n_missing'].isna().all()
+
+    assert len(cells) == n_cells
+    assert cells['excluded'].sum() == n_excluded
+    assert cells['supernumerary'].sum() == 1
+    # Frequency decreases from the base toward the apex.
+    ihc_cells = cells.query('cell_type == "IHC"').sort_values('distance_mm')
+    assert np.all(np.diff(ihc_cells['frequency']) <= 0)
+    assert ihc_cells['frequency'].between(2, 128).all()
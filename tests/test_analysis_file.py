@@ -0,0 +1,117 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from cochleogram import analysis_file
+
+
+def make_state(n=100):
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1000, n).tolist()
+    y = rng.uniform(0, 1000, n).tolist()
+    x[3] = float('nan')
+    return {
+        'meta': {'saved': '2024-01-01T00:00:00', 'version': '0.9'},
+        'data': {
+            'spirals': {
+                'IHC': {
+                    'x': x,
+                    'y': y,
+                    'origin': 0,
+                    'exclude': [[[1.0, 2.0], [3.0, 4.0]] for _ in range(10)],
+                    'labels': [],
+                },
+                'OHC1': {'x': [], 'y': [], 'origin': 0, 'exclude': [], 'labels': []},
+            },
+            'cells': {
+                'IHC': {
+                    'x': x,
+                    'y': y,
+                    'origin': 0,
+                    'exclude': [],
+                    'labels': [
+                        [[x[0], y[0]], ['artifact']],
+                        [[x[1], y[1]], ['orphan', 'artifact']],
+                        [[x[2], y[2]], []],
+                    ],
+                },
+            },
+            'puncta': {
+                'CtBP2': {'xyz': rng.uniform(0, 100, (50, 3)).tolist()},
+            },
+            'tiles': {
+                'piece_1': {'extent': [0.0, 100.0, 0.0, 100.0, 0.0, 10.0]},
+            },
+            'copied_from': '',
+        },
+    }
+
+
+def load(data):
+    return analysis_file.load_npz(io.BytesIO(data))
+
+
+def test_npz_round_trip():
+    state = make_state()
+    arrays = np.load(io.BytesIO(analysis_file.dumps_npz(state)))
+    # The coordinates are stored as arrays rather than in the JSON.
+    assert len(arrays.files) > 1
+    header = json.loads(arrays['state'].tobytes().decode('utf-8'))
+    assert '__array__' in header['data']['spirals']['IHC']['x']
+    assert '__labels__' in header['data']['cells']['IHC']['labels']
+
+    result = load(analysis_file.dumps_npz(state))
+    assert analysis_file.equal(result, state)
+    cells = result['data']['cells']['IHC']
+    assert cells['labels'][1] == [[state['data']['cells']['IHC']['x'][1],
+                                   state['data']['cells']['IHC']['y'][1]],
+                                  ['orphan', 'artifact']]
+    assert cells['labels'][2][1] == []
+    assert result['data']['spirals']['OHC1'] == state['data']['spirals']['OHC1']
+    assert result['data']['spirals']['IHC']['exclude'] == [[[1.0, 2.0], [3.0, 4.0]]] * 10
+
+
+def test_npz_mixed_lists():
+    # Lists that mix integers and floats are stored as float arrays.
+    values = list(range(10)) + [0.5] * 10
+    result = load(analysis_file.dumps_npz({'x': values, 'short': [1, 2.5]}))
+    assert result['x'] == values
+    assert all(isinstance(v, float) for v in result['x'])
+    assert result['short'] == [1, 2.5]
+    assert isinstance(result['short'][0], int)
+
+    # Integer arrays stay integers and ragged lists are kept in the JSON.
+    ragged = [[1, 2], [3]] * 10
+    result = load(analysis_file.dumps_npz({'x': list(range(20)), 'ragged': ragged}))
+    assert result['x'] == list(range(20))
+    assert all(isinstance(v, int) for v in result['x'])
+    assert result['ragged'] == ragged
+
+
+@pytest.mark.parametrize('keep', [False, True])
+def test_convert(tmp_path, keep):
+    state = make_state()
+    filename = tmp_path / 'cochlea_piece_1_analysis.json'
+    analysis_file.save(filename, state)
+
+    npz_filename = analysis_file.convert(filename, 'npz', keep=keep)
+    assert npz_filename == filename.with_suffix('.npz')
+    assert filename.exists() == keep
+    assert analysis_file.equal(analysis_file.load(npz_filename), state)
+
+    json_filename = analysis_file.convert(npz_filename, 'json')
+    assert not npz_filename.exists()
+    assert analysis_file.equal(analysis_file.load(json_filename), state)
+
+    # Converting to the same format does nothing.
+    assert analysis_file.convert(json_filename, 'json') == json_filename
+    assert json_filename.exists()
+
+
+def test_get_format():
+    assert analysis_file.get_format('analysis.JSON') == 'json'
+    assert analysis_file.get_format('analysis.npz') == 'npz'
+    with pytest.raises(ValueError, match='Unrecognized analysis format'):
+        analysis_file.get_format('analysis.txt')
@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+from cochleogram.autosave import AutosaveService, autosave_filename
+
+
+class Presenter(SimpleNamespace):
+
+    __hash__ = object.__hash__
+
+
+def make_presenter(tmp_path, version):
+    reader = SimpleNamespace(state_filename=lambda obj: tmp_path / 'analysis.json')
+    obj = SimpleNamespace(get_version=lambda: version)
+    return Presenter(obj=obj, reader=reader, saved_version=None,
+                     get_autosave_state=lambda: {'version': version})
+
+
+def test_unregister(tmp_path):
+    service = AutosaveService()
+    presenter = make_presenter(tmp_path, 1)
+
+    # Simulate an edit whose autosave timer has not fired yet.
+    service.first_request[presenter] = 0
+    service.requests[presenter] = 1
+    service.unregister(presenter)
+    service.flush()
+    assert autosave_filename(tmp_path / 'analysis.json').exists()
+    assert service.n_saved == 1
+    assert presenter not in service.requests
+    assert presenter not in service.first_request
+    assert presenter not in service.saved_versions
+
+    # The pending timer no longer saves.
+    service._save(presenter, 1)
+    service.flush()
+    assert service.n_saved == 1
@@ -0,0 +1,248 @@
+import numpy as np
+import pandas as pd
+from psiaudio.util import octave_space
+import pytest
+from scipy import ndimage
+from skimage.color import rgb2gray
+from skimage.registration import phase_cross_correlation
+
+from cochleogram import model
+
+
+def make_tile(image, lower=(0, 0, 0), voxel_size=(0.5, 0.5, 1.0),
+              channels=('CtBP2', 'MyosinVIIa'), source='piece_1'):
+    info = {
+        'lower': list(lower),
+        'voxel_size': list(voxel_size),
+        'channels': [{'name': c} for c in channels],
+    }
+    return model.Tile(info, image, source)
+
+
+def make_puncta_piece(zero=False):
+    rng = np.random.default_rng(0)
+    image = ndimage.gaussian_filter(rng.random((400, 400, 8, 2)), (2, 2, 1, 0))
+    image = (image / image.max() * 255).astype('uint8')
+    if zero:
+        image[..., 0] = 0
+    piece = model.Piece([make_tile(image)], 1, copied_from='')
+    # Arc that curves through the tile so that the bounding box of the spiral
+    # covers most of the tile.
+    theta = np.linspace(0, np.pi * 0.9, 12)
+    piece.spirals['IHC'].set_nodes(200 + 150 * np.cos(theta),
+                                   20 + 150 * np.sin(theta))
+    return piece
+
+
+def test_find_puncta_band():
+    piece = make_puncta_piece()
+    n = piece.find_puncta(width=5)
+    assert n > 0
+
+    # All puncta must fall within the band and must match those found when
+    # searching the entire tile.
+    puncta = piece.puncta['CtBP2']
+    xs, ys = piece.spirals['IHC'].interpolate(resolution=0.001)
+    spiral = np.c_[xs, ys]
+    points = np.c_[puncta.x, puncta.y]
+    d = np.sqrt(((points[:, np.newaxis] - spiral) ** 2).sum(axis=-1)).min(axis=1)
+    assert np.all(d <= 5)
+
+    tile = piece.tiles[0]
+    footprint = 2 * np.round(0.5 / np.array(tile.info['voxel_size'])).astype('i') + 1
+    image = tile.image[..., 0]
+    sigma = 0.25 / np.array(tile.info['voxel_size'])
+    indices, v = model.util.find_puncta(image, footprint, sigma,
+                                        0.25 * image.max())
+    expected = indices * tile.info['voxel_size']
+    d = np.sqrt(((expected[:, np.newaxis, :2] - spiral) ** 2).sum(axis=-1)).min(axis=1)
+    expected = expected[d <= 5]
+    actual = np.c_[puncta.x, puncta.y, puncta.z]
+    np.testing.assert_array_equal(actual[np.lexsort(actual.T)],
+                                  expected[np.lexsort(expected.T)])
+
+
+def test_find_puncta_empty_channel():
+    piece = make_puncta_piece(zero=True)
+    assert piece.find_puncta() == 0
+
+
+def test_find_puncta_missing_channel():
+    piece = make_puncta_piece()
+    with pytest.raises(ValueError, match='Channel GluR2 not found'):
+        piece.find_puncta('GluR2')
+
+
+def make_alignment_piece(rotation=0):
+    rng = np.random.default_rng(1)
+    image = ndimage.gaussian_filter(rng.random((900, 500, 4, 2)), (1, 1, 0, 0))
+    image = (image / image.max() * 255).astype('uint8')
+    tiles = []
+    for k, (x0, y0) in enumerate([(0, 0), (250, 20), (500, 0)]):
+        tile = make_tile(image[x0:x0+400, y0:y0+400].copy(),
+                         lower=(x0 * 0.5, y0 * 0.5, 0),
+                         source=f'piece_1{"abc"[k]}')
+        tile.info['rotation'] = rotation
+        # Perturb the position of each tile.
+        tile.extent = (np.array(tile.extent) + [3*k, 3*k, -2*k, -2*k, 0, 0]).tolist()
+        tiles.append(tile)
+    return model.Piece(tiles, 1, copied_from='')
+
+
+@pytest.mark.parametrize('rotation', [0, 10])
+def test_align_tiles_full(rotation):
+    # The full alignment mode must give the same result as the original
+    # implementation (which did not cache the alignment images).
+    expected = make_alignment_piece(rotation)
+    base_tile = expected.tiles[0]
+    base_img = rgb2gray(ndimage.rotate(base_tile.get_image('MyosinVIIa'), rotation))
+    base_mask = base_img > np.percentile(base_img, 95)
+    for tile in expected.tiles[1:]:
+        img = rgb2gray(ndimage.rotate(tile.get_image('MyosinVIIa'), rotation))
+        mask = img > np.percentile(img, 95)
+        (x_shift, y_shift), *_ = phase_cross_correlation(
+            base_img, img, reference_mask=base_mask, moving_mask=mask)
+        extent = np.array(base_tile.extent[:])
+        extent[0:2] += x_shift * 0.5
+        extent[2:4] += y_shift * 0.5
+        tile.extent = extent.tolist()
+        base_tile, base_img, base_mask = tile, img, mask
+
+    piece = make_alignment_piece(rotation)
+    for i in range(2):
+        piece.align_tiles('MyosinVIIa', mode='full')
+        for tile, expected_tile in zip(piece.tiles, expected.tiles):
+            assert tile.extent == expected_tile.extent
+
+
+@pytest.mark.parametrize('mode', ['overlap', 'global'])
+def test_align_tiles(mode):
+    piece = make_alignment_piece()
+    piece.align_tiles('MyosinVIIa', mode=mode)
+    extents = np.array([t.extent[:4] for t in piece.tiles])
+    expected = np.array([[0, 200, 0, 200], [125, 325, 10, 210], [250, 450, 0, 200]])
+    np.testing.assert_allclose(extents - extents[0, [0, 0, 2, 2]], expected, atol=1e-4)
+
+    # Aligning again using the cached images and spectra must not change the
+    # result.
+    piece.align_tiles('MyosinVIIa', mode=mode)
+    np.testing.assert_allclose(np.array([t.extent[:4] for t in piece.tiles]),
+                               extents, atol=1e-4)
+
+
+def assert_interpolation_current(points):
+    expected = model.Points(list(points.x), list(points.y), points.origin)
+    for actual, desired in zip(points.interpolate(), expected.interpolate()):
+        np.testing.assert_array_equal(actual, desired)
+
+
+def test_points_interpolation_cache():
+    theta = np.linspace(0, np.pi, 8)
+    points = model.Points()
+    points.set_nodes(100 * np.cos(theta), 100 * np.sin(theta))
+    assert_interpolation_current(points)
+    points.add_exclude((100, 0), (70, 70))
+    assert_interpolation_current(points)
+
+    points.add_node(-90, -40)
+    assert_interpolation_current(points)
+    # Exclusion regions must be snapped to the updated spline.
+    xi, yi = points.interpolate()
+    for s, e in points.exclude:
+        assert tuple(s) in set(zip(xi, yi))
+        assert tuple(e) in set(zip(xi, yi))
+
+    points.remove_node(-90, -40)
+    assert_interpolation_current(points)
+    points.set_origin(-100, 0)
+    assert_interpolation_current(points)
+    points.set_state({'x': [0, 10, 20, 30, 40], 'y': [0, 5, 0, 5, 0]})
+    assert_interpolation_current(points)
+
+
+def test_tile_evict_restore(tmp_path):
+    image = np.random.default_rng(0).integers(0, 255, (64, 64, 4, 2), dtype='uint8')
+    tile = make_tile(image.copy())
+    norm = tile.get_image_norm()
+    filename = tmp_path / 'tile.npy'
+
+    tile.evict_image(filename)
+    assert tile.is_evicted()
+    assert filename.exists()
+    np.testing.assert_array_equal(tile.image, image)
+
+    tile.restore_image()
+    assert not tile.is_evicted()
+    assert not filename.exists()
+    np.testing.assert_array_equal(tile.image, image)
+    np.testing.assert_array_equal(tile.get_image_norm(), norm)
+
+
+def calculate_distance_baseline(cochlea, species='mouse', spiral='IHC'):
+    # Implementation of `Cochlea.calculate_distance` prior to `SpiralDistance`
+    xo, yo = 0, 0
+    results = []
+    for piece in cochlea.pieces:
+        s = piece.spirals[spiral]
+        x, y = s.interpolate(resolution=0.001)
+        x_norm = x - (x[0] - xo)
+        y_norm = y - (y[0] - yo)
+        xo = x_norm[-1]
+        yo = y_norm[-1]
+        i = np.arange(len(x)) / len(x)
+        result = pd.DataFrame({
+            'direction': s.direction(),
+            'i': i,
+            'x': x_norm,
+            'y': y_norm,
+            'x_orig': x,
+            'y_orig': y,
+            'piece': piece.piece,
+        }).set_index(['piece', 'i'])
+        results.append(result)
+    results = pd.concat(results).reset_index()
+    results['distance_mm'] = np.sqrt(results['x'].diff() ** 2 + results['y'].diff() ** 2).cumsum() * 1e-3
+    results['distance_mm'] = results['distance_mm'].fillna(0)
+    results['distance_norm'] = results['distance_mm'] / results['distance_mm'].max()
+    results['frequency'] = model.freq_fn[species](results['distance_norm'])
+    return results
+
+
+def make_spiral_cochlea():
+    pieces = []
+    for i, (start, sweep, radius) in enumerate([(0, 90, 1500), (200, -60, 1000), (30, 120, 600)]):
+        theta = np.deg2rad(start + np.linspace(0, sweep, 9))
+        piece = model.Piece([], i + 1, copied_from='')
+        piece.spirals['IHC'].set_nodes(radius * np.cos(theta) + 100 * i,
+                                       radius * np.sin(theta) - 50 * i)
+        pieces.append(piece)
+    return model.Cochlea(pieces)
+
+
+@pytest.mark.parametrize('species', ['mouse', 'gerbil'])
+def test_spiral_distance(species):
+    cochlea = make_spiral_cochlea()
+    expected = calculate_distance_baseline(cochlea, species)
+    actual = cochlea.calculate_distance(species)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    # Frequency map as generated prior to `SpiralDistance`.
+    info = cochlea.make_frequency_map(species=species)
+    for freq in octave_space(4, 64, 0.5):
+        idx = (expected['frequency'] - freq).abs().idxmin()
+        row = expected.loc[idx].to_dict()
+        assert info[freq] == pytest.approx(row)
+    for ix in (0, -1):
+        row = expected.iloc[ix].to_dict()
+        assert info[row['frequency']] == pytest.approx(row)
+
+    # The distance is recalculated once a spiral is edited.
+    distance = cochlea.get_spiral_distance()
+    assert cochlea.get_spiral_distance() is distance
+    spiral = cochlea.pieces[1].spirals['IHC']
+    spiral.set_nodes(np.array(spiral.x) * 1.1, spiral.y)
+    assert cochlea.get_spiral_distance() is not distance
+    expected = calculate_distance_baseline(cochlea, species)
+    actual = cochlea.calculate_distance(species)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
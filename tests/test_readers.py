@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+import pytest
+
+from cochleogram import readers
+
+
+@pytest.fixture
+def processed_dataset(tmp_path):
+    path = tmp_path / 'cochlea-CtBP2-MyosinVIIa'
+    path.mkdir()
+    rng = np.random.default_rng(0)
+    for name, x0 in (('piece_1', 0.0), ('piece_1b', 40.0), ('piece_2', 200.0)):
+        info = {
+            'lower': [x0, 0.0, 0.0],
+            'voxel_size': [0.5, 0.5, 1.0],
+            'channels': [{'name': 'CtBP2'}, {'name': 'MyosinVIIa'}],
+        }
+        image = rng.integers(0, 255, (128, 128, 4, 2), dtype='uint8')
+        np.save(path / f'{path.name}_{name}.npy', image)
+        (path / f'{path.name}_{name}.json').write_text(json.dumps(info))
+    return path
+
+
+def test_load_channels(processed_dataset):
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    cochlea = reader.load_collection(channels=['MyosinVIIa'])
+    assert cochlea.pieces[0].tiles[0].image.shape[-1] == 1
+    assert cochlea.channel_names == ['MyosinVIIa']
+    assert not reader.saved_channels_used
+
+    # The selection is reused and the reader reports that it was.
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    cochlea = reader.load_collection()
+    assert cochlea.channel_names == ['MyosinVIIa']
+    assert reader.saved_channels_used
+    assert reader.describe_channels() == 'MyosinVIIa'
+
+    # An invalid selection must not replace the saved selection.
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    with pytest.raises(ValueError, match='Select the channel by name'):
+        reader.load_collection(channels=[568])
+    assert reader.load_channels() == ['MyosinVIIa']
+
+
+def test_save_from_band(processed_dataset):
+    # Position the tiles and trace a spiral on the first tile of piece 1 only.
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    cochlea = reader.load_collection()
+    piece = cochlea.pieces[0]
+    piece.tiles[1].extent = [e + 1 for e in piece.tiles[1].extent]
+    piece.spirals['IHC'].set_nodes([5.0, 6.0, 7.0, 8.0], [10.0, 25.0, 40.0, 55.0])
+    for piece in cochlea:
+        reader.save_state(piece, {'data': piece.get_state()})
+    expected = {p.piece: p.get_state()['tiles'] for p in cochlea}
+
+    # Tiles that miss the band (including all tiles of piece 2, which has no
+    # spiral) are not loaded.
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    reader.spiral_band = 5
+    band = reader.load_collection()
+    assert [len(p.tiles) for p in band] == [1, 0]
+    band.pieces[0].spirals['IHC'].set_nodes([5.0, 6.0, 7.0, 9.0], [10.0, 25.0, 40.0, 55.0])
+    for piece in band:
+        assert piece.get_state()['tiles'] == expected[piece.piece]
+        reader.save_state(piece, {'data': piece.get_state()})
+
+    # The analysis saved from the band loads into the full tiles.
+    reader = readers.ProcessedCochleaReader(processed_dataset)
+    cochlea = reader.load_collection(raise_load_analysis_error=True)
+    for piece in cochlea:
+        assert piece.get_state()['tiles'] == expected[piece.piece]
+    assert cochlea.pieces[0].spirals['IHC'].x == [5, 6, 7, 9]
@@ -0,0 +1,178 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from cochleogram import util
+
+
+def sort_puncta(indices, intensity):
+    order = np.lexsort(indices.T)
+    return indices[order], intensity[order]
+
+
+def test_find_puncta_chunked():
+    # The image spans several chunks along each axis (including partial
+    # chunks) so that maxima fall on the seams between chunks.
+    rng = np.random.default_rng(0)
+    image = rng.random((150, 140, 30))
+    image = ndimage.gaussian_filter(image, 1) * 255
+    image = image.astype('uint8')
+    footprint = (11, 11, 5)
+    sigma = (2.5, 2.5, 0.83)
+    chunk_size = (32, 48, 8)
+
+    for s in (None, sigma):
+        expected = util.find_puncta(image, footprint, s, chunk_size=image.shape)
+        actual = util.find_puncta(image, footprint, s, chunk_size=chunk_size)
+        expected = sort_puncta(*expected)
+        actual = sort_puncta(*actual)
+        assert len(expected[0]) > 0
+        np.testing.assert_array_equal(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+
+
+def test_find_puncta_chunked_bounds():
+    rng = np.random.default_rng(1)
+    image = (rng.random((120, 120, 20)) * 255).astype('uint8')
+    bounds = (10, 110, 25, 95)
+    kw = dict(footprint=(5, 5, 3), sigma=(1.5, 1.5, 0.5), bounds=bounds)
+    expected = sort_puncta(*util.find_puncta(image, chunk_size=image.shape, **kw))
+    actual = sort_puncta(*util.find_puncta(image, chunk_size=(16, 16, 4), **kw))
+    np.testing.assert_array_equal(actual[0], expected[0])
+    np.testing.assert_array_equal(actual[1], expected[1])
+
+
+def test_register_overlap():
+    rng = np.random.default_rng(2)
+    image = ndimage.gaussian_filter(rng.random((600, 400)), 1)
+    voxel_size = np.array([0.5, 0.5])
+    ref = image[:400]
+    mov = image[250:]
+    # The predicted position of the moving image is off by a few pixels.
+    ref_origin = np.array([0, 0])
+    mov_origin = np.array([253, -4]) * voxel_size
+
+    origin, confidence = util.register_overlap(ref, ref_origin, mov,
+                                               mov_origin, voxel_size)
+    np.testing.assert_allclose(origin, np.array([250, 0]) * voxel_size)
+    assert confidence > 0.99
+
+    # Using cached spectra must give the same result.
+    cache = {}
+    def spectrum(image):
+        def fn(lb, n, factor):
+            key = id(image), tuple(lb), tuple(n), factor
+            if key not in cache:
+                cache[key] = util.coarse_spectrum(image, lb, n, factor)
+            return cache[key]
+        return fn
+    for i in range(2):
+        cached = util.register_overlap(ref, ref_origin, mov, mov_origin,
+                                       voxel_size, ref_spectrum=spectrum(ref),
+                                       mov_spectrum=spectrum(mov))
+        np.testing.assert_array_equal(cached[0], origin)
+        assert cached[1] == confidence
+    assert len(cache) == 2
+
+
+def test_get_channel_indices():
+    info = [
+        {'name': 'GluR2', 'emission': 520},
+        {'name': 'CtBP2', 'emission': 568},
+        {'name': 'MyosinVIIa', 'emission': 647},
+    ]
+    assert util.get_channel_indices(info) == [0, 1, 2]
+    assert util.get_channel_indices(info, ['MyosinVIIa', 'CtBP2']) == [1, 2]
+    assert util.get_channel_indices(info, [570, 'GluR2']) == [0, 1]
+    with pytest.raises(ValueError, match='Channel DAPI not found'):
+        util.get_channel_indices(info, ['DAPI'])
+    with pytest.raises(ValueError, match='Channel 600 not found'):
+        util.get_channel_indices(info, [600])
+
+    # Emission wavelength is not available for LIF files.
+    info = [{'name': 'CtBP2'}, {'name': 'MyosinVIIa'}]
+    assert util.get_channel_indices(info, ['MyosinVIIa']) == [1]
+    with pytest.raises(ValueError, match='Select the channel by name'):
+        util.get_channel_indices(info, [568])
+
+
+def make_arc(center, radius, start, sweep, n=101):
+    theta = np.deg2rad(start + np.linspace(0, sweep, n))
+    return center[0] + radius * np.cos(theta), center[1] + radius * np.sin(theta)
+
+
+@pytest.mark.parametrize('method', ['kasa', 'taubin'])
+@pytest.mark.parametrize('sweep', [20, 90, 270])
+def test_fit_circle(method, sweep):
+    x, y = make_arc((120, -40), 500, 30, sweep)
+    xo, yo, r = util.fit_circle(x, y, method)
+    np.testing.assert_allclose([xo, yo, r], [120, -40, 500], rtol=1e-6)
+
+    with pytest.raises(ValueError, match='collinear'):
+        util.fit_circle([0, 1, 2, 3], [0, 2, 4, 6], method)
+
+
+@pytest.mark.parametrize('sweep', [90, 270])
+def test_fit_circle_robust(sweep):
+    x, y = make_arc((120, -40), 500, 30, sweep, n=1001)
+    x[::50] += 100
+    xo, yo, r = util.fit_circle(x, y)
+    assert abs(r - 500) > 0.1
+    xo, yo, r = util.fit_circle(x, y, robust=True)
+    np.testing.assert_allclose([xo, yo, r], [120, -40, 500], rtol=1e-3)
+
+
+@pytest.mark.parametrize('sweep', [10, 90, 180, 300])
+@pytest.mark.parametrize('start', [0, 135, 250])
+def test_arc_direction(start, sweep):
+    x, y = make_arc((1000, 2000), 800, start, sweep)
+    assert util.arc_direction(x, y) == 1
+    assert util.arc_direction(x[::-1], y[::-1]) == -1
+    x, y = make_arc((1000, 2000), 800, start, -sweep)
+    assert util.arc_direction(x, y) == -1
+
+
+def test_arc_direction_undetermined():
+    with pytest.raises(ValueError):
+        util.arc_direction([0, 1, 2, 3], [0, 1, 2, 3])
+
+    # A shallow arc with deviations much larger than the sagitta.
+    x, y = make_arc((0, 0), 1000, 0, 5, n=1001)
+    t = np.linspace(0, 1, len(x))
+    r = 1 + 0.01 * np.sin(2 * np.pi * 3 * t)
+    with pytest.raises(ValueError):
+        util.arc_direction(x * r, y * r)
+
+    # The same deviations on a longer arc do not prevent determining the
+    # direction.
+    x, y = make_arc((0, 0), 1000, 0, 60, n=1001)
+    assert util.arc_direction(x * r, y * r) == 1
+
+
+def test_solve_tile_positions():
+    expected = np.array([[10, 20], [110, 25], [205, 18], [100, 120]], dtype=float)
+    positions = expected + [[0, 0], [7, -3], [-4, 9], [5, 5]]
+    constraints = [
+        (0, 1, expected[1] - expected[0], 1),
+        (1, 2, expected[2] - expected[1], 1),
+        (0, 3, expected[3] - expected[0], 1),
+        (1, 3, expected[3] - expected[1], 1),
+    ]
+    result = util.solve_tile_positions(positions, constraints)
+    np.testing.assert_allclose(result, expected, atol=1e-3)
+
+    # The anchor is held fixed and the remaining tiles are placed relative
+    # to it.
+    result = util.solve_tile_positions(positions, constraints, anchor=2)
+    np.testing.assert_allclose(result, expected - expected[2] + positions[2], atol=1e-3)
+
+    # Inconsistent offsets are resolved in favor of the higher weight.
+    constraints.append((0, 2, expected[2] - expected[0] + [30, 0], 0.01))
+    result = util.solve_tile_positions(positions, constraints)
+    np.testing.assert_allclose(result[2], expected[2], atol=0.5)
+
+    # Tiles without any constraints stay in place.
+    positions = np.vstack((positions, [[500, 500]]))
+    result = util.solve_tile_positions(positions, constraints[:4])
+    np.testing.assert_allclose(result[:4], expected, atol=1e-3)
+    np.testing.assert_allclose(result[4], [500, 500], atol=1e-3)